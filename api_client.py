@@ -14,6 +14,8 @@ import json
 from dataclasses import dataclass
 from dotenv import load_dotenv
 
+from khl import Backoff, RetryBudget, RetryError, RetryPolicy, parse_retry_after
+
 # 加载环境变量
 load_dotenv()
 
@@ -28,6 +30,7 @@ class ApiResponse:
     error: str = None
     status_code: int = None
     response_time: float = None
+    retry_after: float = None
 
 class ThirdPartyApiClient:
     """
@@ -42,6 +45,12 @@ class ThirdPartyApiClient:
         self.timeout = int(os.getenv("THIRD_PARTY_API_TIMEOUT", "30"))
         self.max_retries = int(os.getenv("THIRD_PARTY_API_MAX_RETRIES", "3"))
         self.session: Optional[aiohttp.ClientSession] = None
+        # 与 khl 请求器共用的重试策略：指数退避 + 抖动，遵循 Retry-After，独立的重试预算防止重试风暴
+        # 该 API 的 POST（LLM 补全、向量）没有副作用，和以前一样允许重试
+        self.retry_policy = RetryPolicy(max_attempts=self.max_retries + 1,
+                                        backoff=Backoff(base=1, cap=30),
+                                        methods=RetryPolicy.IDEMPOTENT_METHODS | {'POST'},
+                                        budget=RetryBudget())
         
     async def _get_session(self) -> aiohttp.ClientSession:
         """获取或创建 aiohttp 会话"""
@@ -116,7 +125,8 @@ class ThirdPartyApiClient:
                         success=False,
                         error=error_msg,
                         status_code=response.status,
-                        response_time=response_time
+                        response_time=response_time,
+                        retry_after=parse_retry_after(response.headers.get('Retry-After'))
                     )
                     
         except asyncio.TimeoutError:
@@ -144,34 +154,20 @@ class ThirdPartyApiClient:
                                      params: Optional[Dict] = None) -> ApiResponse:
         """
         带重试机制的请求方法
-        对 HTTP 500 错误进行最多 3 次重试，使用指数退避策略
+        由 retry_policy 决定：对 429/5xx、超时和连接错误进行最多 max_retries 次重试，使用带抖动的指数退避策略
         """
-        last_response = None
-        
-        for attempt in range(self.max_retries + 1):
+        async def attempt() -> ApiResponse:
             response = await self._make_request(method, endpoint, headers, data, params)
-            
-            # 请求成功或非 500 错误，直接返回
-            if response.success or (response.status_code and response.status_code != 500):
-                return response
-            
-            last_response = response
-            
-            # 如果是最后一次尝试，不再重试
-            if attempt == self.max_retries:
-                break
-            
-            # 指数退避：2^attempt 秒
-            wait_time = 2 ** attempt
-            logger.warning(f"HTTP 500 错误，{wait_time}秒后进行第{attempt + 2}次重试...")
-            await asyncio.sleep(wait_time)
-        
-        # 所有重试都失败
-        logger.error(f"API 请求在 {self.max_retries + 1} 次尝试后仍然失败")
-        return last_response or ApiResponse(
-            success=False,
-            error="所有重试尝试都失败"
-        )
+            if not response.success:
+                # 交给重试策略判断，status_code 为 None 表示超时/连接错误
+                raise RetryError(response.status_code, response.retry_after, payload=response)
+            return response
+
+        try:
+            return await self.retry_policy.run(method, endpoint, attempt)
+        except RetryError as e:
+            logger.error(f"API 请求失败，不再重试: {method} {endpoint} - {e.payload.error}")
+            return e.payload
     
     async def get(self, endpoint: str, 
                   headers: Optional[Dict[str, str]] = None,
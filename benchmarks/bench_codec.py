@@ -0,0 +1,44 @@
+"""
+khl.codec throughput of each installed backend over a frame corpus
+
+usage: python -m benchmarks.bench_codec [corpus.jsonl]
+"""
+import argparse
+import timeit
+
+from khl import codec
+
+from benchmarks import frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='?', help='recorded frames, JSON lines; generated if omitted')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    objs = frames.load(args.corpus)
+    codec.use('json')
+    texts = [codec.dumps(o) for o in objs]
+    raws = [t.encode() for t in texts]
+    size = sum(len(r) for r in raws) / 2**20
+
+    print(f'{len(objs)} frames, {size:.2f} MiB')
+    print(f'{"backend":>8} {"loads(bytes)":>14} {"loads(str)":>14} {"dumps":>14}')
+    for name in codec._BACKENDS:  # pylint: disable=protected-access
+        try:
+            codec.use(name)
+        except ImportError:
+            print(f'{name:>8} not installed')
+            continue
+        cases = (
+            lambda: [codec.loads(r) for r in raws],
+            lambda: [codec.loads(t) for t in texts],
+            lambda: [codec.dumps(o) for o in objs],
+        )
+        results = [size / min(timeit.repeat(case, number=1, repeat=args.repeat)) for case in cases]
+        print(f'{name:>8} ' + ' '.join(f'{r:>9.1f} MiB/s' for r in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+websocket frame decoding: zlib + JSON as the receiver does it, before and after decoding from bytes
+
+usage: python -m benchmarks.bench_frame_decode [corpus.jsonl] [--text]
+"""
+import argparse
+import json
+import timeit
+import zlib
+
+from khl import Cert, codec
+
+from benchmarks import frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='?', help='recorded frames, JSON lines; generated if omitted')
+    parser.add_argument('--text', action='store_true', help='uncompressed text frames, as with compress=0')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = [json.dumps(f, ensure_ascii=False).encode() for f in frames.load(args.corpus)]
+    if not args.text:
+        corpus = [zlib.compress(f) for f in corpus]
+    cert = Cert(token='t')
+
+    def before():  # the decode path of the baseline receiver and cert
+        for raw in corpus:
+            data = zlib.decompress(raw) if not args.text else raw
+            json.loads(str(data, encoding='utf-8'))
+
+    def after():
+        for raw in corpus:
+            cert.decode_raw(zlib.decompress(raw) if not args.text else raw)
+
+    print(f'{len(corpus)} frames, json backend: {codec.backend()}')
+    for name, func in (('before', before), ('after', after)):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f'{name:>6}: {best * 1000:8.2f} ms, {best / len(corpus) * 1e6:6.2f} us/frame')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+throughput of building a _Req with khl.api.req, against the old decorator which resolved the route
+and the param names on each call
+
+usage: python -m benchmarks.bench_req
+"""
+import argparse
+import functools
+import inspect
+import re
+import timeit
+
+from khl import api
+
+
+def _old_req(method: str, **http_fields):
+    """khl.api.req before routes and payload layouts were precomputed"""
+
+    def _method(func):
+
+        @functools.wraps(func)
+        def req_maker(*args, **kwargs):
+            route = re.compile(r'(?<!^)(?=[A-Z])').sub('-', func.__qualname__).lower().replace('.', '/')
+            param_names = list(inspect.signature(func).parameters.keys())
+            for i, arg in enumerate(args):
+                kwargs[param_names[i].lstrip('_')] = arg
+            return api._Req(method, route, {'json' if method == 'POST' else 'params': kwargs, **http_fields})
+
+        return req_maker
+
+    return _method
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--number', type=int, default=100_000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    new_create = api.Message.create
+    old_create = _old_req('POST')(new_create.__wrapped__)
+    new_view = api.Guild.view
+    old_view = _old_req('GET')(new_view.__wrapped__)
+    cases = {
+        'Message.create positional': lambda f: f('channel', 'content', 1),
+        'Message.create keyword': lambda f: f(target_id='channel', content='content', type=1),
+        'Guild.view positional': lambda f: f('guild'),
+    }
+    pairs = {'Message.create': (old_create, new_create), 'Guild.view': (old_view, new_view)}
+
+    print(f'{"case":>26} {"old":>14} {"new":>14} {"speedup":>8}')
+    for name, case in cases.items():
+        old, new = pairs[name.split()[0]]
+        rates = [
+            args.number / min(timeit.repeat(lambda: case(f), number=args.number, repeat=args.repeat))
+            for f in (old, new)
+        ]
+        print(f'{name:>26} {rates[0]:>10.0f} op/s {rates[1]:>10.0f} op/s {rates[1] / rates[0]:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
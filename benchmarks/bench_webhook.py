@@ -0,0 +1,55 @@
+"""
+webhook pkg decoding: decompress, decrypt and parse as WebhookReceiver does it, before and after Cert changes
+
+usage: python -m benchmarks.bench_webhook [corpus.jsonl] [--no-compress]
+"""
+import argparse
+import base64
+import json
+import timeit
+import zlib
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Util import Padding
+
+from khl import Cert, codec
+
+from benchmarks import frames
+
+KEY = 'encrypt_key'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='?', help='recorded frames, JSON lines; generated if omitted')
+    parser.add_argument('--no-compress', action='store_true', help='as with compress=0')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = []
+    for frame in frames.load(args.corpus):
+        body = json.dumps({'encrypt': frames.encrypt(KEY, json.dumps(frame).encode()).decode()}).encode()
+        corpus.append(body if args.no_compress else zlib.compress(body))
+    inflate = (lambda d: d) if args.no_compress else zlib.decompress
+    cert = Cert(token='t', verify_token='v', encrypt_key=KEY)
+
+    def before():  # the decode path of the baseline cert
+        for raw in corpus:
+            pkg = json.loads(str(inflate(raw), encoding='utf-8'))
+            data = base64.b64decode(pkg['encrypt'])
+            data = AES.new(key=KEY.encode().ljust(32, b'\x00'), mode=AES.MODE_CBC,
+                           iv=data[0:16]).decrypt(base64.b64decode(data[16:]))
+            json.loads(Padding.unpad(data, 16).decode('utf-8'))
+
+    def after():
+        for raw in corpus:
+            cert.decode_raw(inflate(raw))
+
+    print(f'{len(corpus)} pkgs, json backend: {codec.backend()}')
+    for name, func in (('before', before), ('after', after)):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f'{name:>6}: {len(corpus) / best:9.0f} pkgs/s, {best / len(corpus) * 1e6:6.2f} us/pkg')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+frame corpus shared by benchmarks: gateway frames as KOOK sends them
+
+``load(path)`` reads a recorded corpus, a JSON-lines file with one decoded frame per line,
+e.g. collected from the ``upcoming raw`` debug log of ``WebsocketReceiver``;
+without a path, frames shaped like the usual traffic of a bot are generated
+"""
+import json
+import random
+from typing import List, Optional
+
+
+def _text_event(sn: int, rand: random.Random) -> dict:
+    content = ''.join(rand.choice('abcdefghij klmnopqrstuvwxyz你好世界') for _ in range(rand.randint(4, 120)))
+    return {
+        's': 0,
+        'sn': sn,
+        'd': {
+            'channel_type': 'GROUP',
+            'type': 9,
+            'target_id': str(rand.randint(10**15, 10**16)),
+            'author_id': str(rand.randint(10**9, 10**10)),
+            'content': content,
+            'msg_id': f'{rand.getrandbits(128):032x}',
+            'msg_timestamp': 1700000000000 + sn,
+            'nonce': '',
+            'extra': {
+                'type': 9,
+                'guild_id': str(rand.randint(10**15, 10**16)),
+                'channel_name': 'general',
+                'mention': [],
+                'mention_all': False,
+                'mention_roles': [],
+                'mention_here': False,
+                'author': {
+                    'id': str(rand.randint(10**9, 10**10)),
+                    'username': 'someone',
+                    'identify_num': '1234',
+                    'online': True,
+                    'os': 'Websocket',
+                    'status': 1,
+                    'avatar': 'https://img.kookapp.cn/avatars/2021-08/someone.png',
+                    'nickname': 'someone',
+                    'roles': [rand.randint(1, 10**6) for _ in range(rand.randint(0, 3))],
+                    'bot': False,
+                },
+                'kmarkdown': {
+                    'raw_content': content,
+                    'mention_part': [],
+                    'mention_role_part': []
+                },
+            },
+        },
+    }
+
+
+def _system_event(sn: int, rand: random.Random) -> dict:
+    return {
+        's': 0,
+        'sn': sn,
+        'd': {
+            'channel_type': 'GROUP',
+            'type': 255,
+            'target_id': str(rand.randint(10**15, 10**16)),
+            'author_id': '1',
+            'content': '[系统消息]',
+            'msg_id': f'{rand.getrandbits(128):032x}',
+            'msg_timestamp': 1700000000000 + sn,
+            'nonce': '',
+            'extra': {
+                'type': 'added_reaction',
+                'body': {
+                    'channel_id': str(rand.randint(10**15, 10**16)),
+                    'emoji': {
+                        'id': '👍',
+                        'name': '👍'
+                    },
+                    'user_id': str(rand.randint(10**9, 10**10)),
+                    'msg_id': f'{rand.getrandbits(128):032x}',
+                },
+            },
+        },
+    }
+
+
+def generate(n: int = 1000, seed: int = 233) -> List[dict]:
+    """``n`` frames: mostly text events, some system events and pongs"""
+    rand = random.Random(seed)
+    frames = []
+    for sn in range(1, n + 1):
+        kind = rand.random()
+        if kind < 0.75:
+            frames.append(_text_event(sn, rand))
+        elif kind < 0.95:
+            frames.append(_system_event(sn, rand))
+        else:
+            frames.append({'s': 3})
+    return frames
+
+
+def load(path: Optional[str] = None, n: int = 1000) -> List[dict]:
+    """frames recorded in ``path``, or ``n`` generated ones"""
+    if not path:
+        return generate(n)
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def encrypt(key: str, data: bytes) -> bytes:
+    """encrypt ``data`` the way KOOK does for webhooks: base64(iv + base64(AES-CBC(data)))"""
+    import base64  # pylint: disable=import-outside-toplevel
+    import os  # pylint: disable=import-outside-toplevel
+
+    from Cryptodome.Cipher import AES  # pylint: disable=import-outside-toplevel
+    from Cryptodome.Util import Padding  # pylint: disable=import-outside-toplevel
+
+    iv = os.urandom(16)
+    cipher = AES.new(key.encode().ljust(32, b'\x00'), AES.MODE_CBC, iv=iv)
+    return base64.b64encode(iv + base64.b64encode(cipher.encrypt(Padding.pad(data, 16))))
@@ -1,13 +1,12 @@
 import os
 import random
-import json
 import time
 import datetime
 import re
 import asyncio
 import aiohttp
 import numpy as np
-from khl import Bot, Message, EventTypes, Event
+from khl import Bot, Message, EventTypes, Event, codec, tracing
 from rich.console import Console
 from rich.markup import escape
 from dotenv import load_dotenv
@@ -31,7 +30,7 @@ START_TIME = time.time()
 
 # 基本配置
 BOT_TOKEN      = os.getenv("KOOK_WS_TOKEN")
-BOT_ID         = os.getenv("KOOK_BOT_ID")
+BOT_ID         = os.getenv("KOOK_BOT_ID", "")  # 可选，启动后以 bot.client.me_id 为准
 OTHER_BOT_ID   = os.getenv("OTHER_BOT_ID")
 KOOK_CHANNEL_ID = os.getenv("KOOK_CHANNEL_ID", "")
 
@@ -59,6 +58,12 @@ MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "5"))
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "60"))
 MAX_HISTORY_LENGTH = int(os.getenv("MAX_HISTORY_LENGTH", "20"))
 
+# 链路追踪配置（TRACE_FILE 为空则关闭）
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_OTLP = os.getenv("TRACE_OTLP", "false").lower() == "true"
+tracing.configure(TRACE_FILE, sample_rate=TRACE_SAMPLE_RATE, otlp=TRACE_OTLP)
+
 # 全局并发信号量，用于限制并发处理
 message_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
 
@@ -138,13 +143,13 @@ os.makedirs(os.path.dirname(USERS_FILE), exist_ok=True)
 # 加载或初始化数据
 if os.path.exists(USERS_FILE):
     with open(USERS_FILE, 'r', encoding='utf-8') as f:
-        users_data = json.load(f)
+        users_data = codec.loads(f.read())
 else:
     users_data = {}
 
 if os.path.exists(KB_FILE):
     with open(KB_FILE, 'r', encoding='utf-8') as f:
-        knowledge_store = json.load(f)
+        knowledge_store = codec.loads(f.read())
 else:
     knowledge_store = []
 
@@ -153,11 +158,11 @@ MAX_HISTORY = MAX_HISTORY_LENGTH
 # 保存数据函数
 def save_knowledge():
     with open(KB_FILE, 'w', encoding='utf-8') as f:
-        json.dump(knowledge_store, f, ensure_ascii=False, indent=2)
+        f.write(codec.dumps(knowledge_store, indent=True))
 
 async def save_history():
     with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users_data, f, ensure_ascii=False, indent=2)
+        f.write(codec.dumps(users_data, indent=True))
 
 async def safe_reply(msg: Message, text: str):
     try:
@@ -184,7 +189,9 @@ class LLMClient:
         self.model = model
         self.session = None
 
+    @tracing.traced('LLMClient.chat')
     async def chat(self, messages):
+        tracing.current_span().set_attribute('model', self.model)
         # 设置请求超时，防止长时间挂起
         timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
         if self.session is None:
@@ -200,7 +207,7 @@ class LLMClient:
             # 使用超时保护，防止请求无限挂起
             async with self.session.post(f"{self.url}/chat/completions", headers=headers, json=payload) as resp:
                 resp.raise_for_status()
-                return await resp.json()
+                return await resp.json(loads=codec.loads)
         except asyncio.TimeoutError:
             console.print(f"[red]模型请求超时（>60s），跳过本次调用[/red]")
             raise
@@ -328,7 +335,8 @@ class EnhancedDispatcher:
         try:
             # 1. 高级情感分析
             console.print("[cyan]📊 开始情感分析...[/cyan]")
-            emotion_result = await self.agents['emotion'].handle({'user': uid, 'text': text})
+            with tracing.span('dispatcher.emotion'):
+                emotion_result = await self.agents['emotion'].handle({'user': uid, 'text': text})
             emotion = emotion_result.get('emotion', 'neutral')
             emoji = emotion_result.get('emoji', '')
             intensity = emotion_result.get('intensity', 0.7)
@@ -350,7 +358,8 @@ class EnhancedDispatcher:
             
             # 2. 生成思考链
             console.print("[cyan]🤔 开始思考过程生成...[/cyan]")
-            thinking_result = await self.agents['thinking'].handle({'text': text})
+            with tracing.span('dispatcher.thinking'):
+                thinking_result = await self.agents['thinking'].handle({'text': text})
             thinking_process = thinking_result.get('thinking_process', '')
             conclusion = thinking_result.get('conclusion', '')
             
@@ -358,15 +367,17 @@ class EnhancedDispatcher:
             
             # 3. 知识检索
             console.print("[cyan]🔍 开始知识检索...[/cyan]")
-            ctx = await self.agents['retrieval'].handle({'text': text})
+            with tracing.span('dispatcher.retrieval'):
+                ctx = await self.agents['retrieval'].handle({'text': text})
             
             # 4. 获取人格指令
             console.print("[cyan]👤 获取人格指令...[/cyan]")
-            personality_result = await self.agents['personality'].handle({
-                'user': uid,
-                'text': text,
-                'emotion': emotion
-            })
+            with tracing.span('dispatcher.personality'):
+                personality_result = await self.agents['personality'].handle({
+                    'user': uid,
+                    'text': text,
+                    'emotion': emotion
+                })
             persona_instruction = personality_result.get('persona', '')
             persona_name = personality_result.get('name', '麦麦')
             
@@ -374,17 +385,18 @@ class EnhancedDispatcher:
             
             # 5. 增强对话生成
             console.print("[cyan]💬 开始增强对话生成...[/cyan]")
-            res = await self.agents['generation'].handle({
-                'contexts': ctx['contexts'],
-                'history': history,
-                'text': text,
-                'emotion': emotion,
-                'emoji': emoji,
-                'intensity': intensity,
-                'thinking_process': thinking_process,
-                'conclusion': conclusion,
-                'persona': persona_instruction
-            })
+            with tracing.span('dispatcher.generation'):
+                res = await self.agents['generation'].handle({
+                    'contexts': ctx['contexts'],
+                    'history': history,
+                    'text': text,
+                    'emotion': emotion,
+                    'emoji': emoji,
+                    'intensity': intensity,
+                    'thinking_process': thinking_process,
+                    'conclusion': conclusion,
+                    'persona': persona_instruction
+                })
             
             # 6. 知识存储处理
             if text.startswith('记住'):
@@ -464,10 +476,12 @@ dispatcher = EnhancedDispatcher(agents)
 
 # 消息处理函数
 @bot.on_message()
+@tracing.traced('handle_message')
 async def handle_message(msg: Message):
     """处理所有文本消息"""
+    bot_id = bot.client.me_id or BOT_ID
     # 过滤条件
-    if msg.author_id == BOT_ID:  # 忽略自己的消息
+    if msg.author_id == bot_id:  # 忽略自己的消息
         return
     
     if OTHER_BOT_ID and msg.author_id == OTHER_BOT_ID:  # 忽略其他机器人
@@ -483,7 +497,7 @@ async def handle_message(msg: Message):
       # 添加调试信息 - 显示频道类型
     console.print(f"[cyan]消息类型: {msg.channel_type}, 消息内容: {text[:30]}...[/cyan]")
         # 检查触发条件
-    is_mentioned = f"(met){BOT_ID}(met)" in msg.content
+    is_mentioned = f"(met){bot_id}(met)" in msg.content
     # 两种方式判断是否是私信
     is_private = str(msg.channel_type) == "ChannelPrivacyTypes.PERSON" or msg.channel_type == "PERSON"
     is_wakeword = "麦麦" in text
@@ -525,14 +539,15 @@ async def handle_message(msg: Message):
         console.print(f"[green]💌 私聊模式: 用户 {uid} (持续响应)[/green]")
     
     # 清理@标记
-    text = text.replace(f"(met){BOT_ID}(met)", "").strip()
+    text = text.replace(f"(met){bot_id}(met)", "").strip()
       # 使用并发控制
     async with message_semaphore:
         try:
             console.print(f"[blue]收到消息: {text} (来自: {msg.author_id})[/blue]")
             
             # 首先检测是否包含辱骂
-            insult_result = await agents['insult_detection'].handle({'text': text})
+            with tracing.span('dispatcher.insult_detection'):
+                insult_result = await agents['insult_detection'].handle({'text': text})
             
             if insult_result['is_insult']:
                 console.print(f"[red]检测到辱骂行为，反击等级: {insult_result['insult_level']}[/red]")
@@ -17,10 +17,20 @@ from ._types import (
     FriendTypes
 )
 from .cert import Cert
+from .tracing import Tracer, Span, JsonLinesExporter
+from .pkg_queue import PkgQueue
 from .receiver import Receiver, WebhookReceiver, WebsocketReceiver
+from .backoff import Backoff
+from .retry import RetryPolicy, RetryBudget, RetryError, parse_retry_after
+from .session import HTTPSession
 from .requester import HTTPRequester
+from .ratelimit_backend import RateLimitBackend, MemoryBackend, MmapBackend, RedisBackend
 from .ratelimiter import RateLimiter
+from .cache import TTLCache, EntityCache
 from .gateway import Gateway, Requestable
+from .state import GuildState
+from .bulk import BulkOperation, BulkResult, BulkItem
+from .asset import AssetUploader
 from .client import Client
 
 # concepts
@@ -6,7 +6,7 @@ import inspect
 import logging
 import re
 from collections import namedtuple
-from typing import Callable, Tuple
+from typing import Any, Callable, Optional, Tuple
 
 import aiohttp
 
@@ -20,20 +20,30 @@ _Req = namedtuple('_Req', ['method', 'route', 'params'])
 def req(method: str, **http_fields):
     """meta-decorator
 
+    route, param names and payload layout are resolved once here, when decorating;
+    building a _Req on each call is then just filling a dict
+
     :returns a decorator to fill func with boilerplate"""
 
     def _method(func: Callable):
+        route = _RE_ROUTE.sub('-', func.__qualname__).lower().replace('.', '/')
+        param_names = tuple(name.lstrip('_') for name in inspect.signature(func).parameters)
+        payload_key, build_payload, fields = _payload_layout(method, http_fields)
+        headers = fields.pop('headers', None)
 
         @functools.wraps(func)
         def req_maker(*args, **kwargs) -> _Req:
-            route = _RE_ROUTE.sub('-', func.__qualname__).lower().replace('.', '/')
-
-            # dump args into kwargs
-            param_names = list(inspect.signature(func).parameters.keys())
-            for i, arg in enumerate(args):
-                kwargs[param_names[i].lstrip('_')] = arg
-
-            params = _merge_params(method, http_fields, kwargs)
+            if args:  # dump args into kwargs
+                if len(args) > len(param_names):
+                    raise TypeError(f'{func.__qualname__}() takes {len(param_names)} positional arguments '
+                                    f'but {len(args)} were given')
+                kwargs.update(zip(param_names, args))
+
+            params = {payload_key: build_payload(kwargs) if build_payload else kwargs}
+            if fields:
+                params.update(fields)
+            if headers is not None:  # the requester adds to headers: never share the dict between requests
+                params['headers'] = dict(headers)
             return _Req(method, route, params)
 
         return req_maker
@@ -41,23 +51,23 @@ def req(method: str, **http_fields):
     return _method
 
 
-def _merge_params(method: str, http_fields: dict, req_args: dict) -> dict:
-    payload = req_args
+def _payload_layout(method: str, http_fields: dict) -> Tuple[str, Optional[Callable[[dict], Any]], dict]:
+    """:returns (payload_key, payload builder or None to send req args as is, http fields to send with)"""
     payload_key = 'params'  # default payload_key: params=
+    build_payload = None
     if method == 'POST':
         payload_key = 'json'  # POST: in default json=
 
         content_type = http_fields.get('headers', {}).get('Content-Type', None)
         if content_type == 'multipart/form-data':
-            payload_key, payload = _build_form_payload(req_args)
+            payload_key, build_payload = 'data', _build_form_payload
             # headers of form-data req are delegated to aiohttp
             http_fields = _remove_content_type(http_fields)
+            if not http_fields.get('headers'):
+                http_fields = {k: v for k, v in http_fields.items() if k != 'headers'}
         elif content_type is not None:
             raise ValueError(f'unrecognized Content-Type {content_type}')
-
-    params = {payload_key: payload}
-    params.update(http_fields)
-    return params
+    return payload_key, build_payload, dict(http_fields)
 
 
 def _remove_content_type(http_fields: dict) -> dict:
@@ -72,11 +82,11 @@ def _remove_content_type(http_fields: dict) -> dict:
     return http_fields
 
 
-def _build_form_payload(req_args: dict) -> Tuple[str, aiohttp.FormData]:
+def _build_form_payload(req_args: dict) -> aiohttp.FormData:
     data = aiohttp.FormData()
     for name, value in req_args.items():
         data.add_field(name, value)
-    return 'data', data
+    return data
 
 
 class Guild:
@@ -0,0 +1,210 @@
+"""asset upload: stream files to khl off the event loop, a bounded pool of uploads, urls cached by content hash"""
+import asyncio
+import hashlib
+import io
+import logging
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterable, Optional, Tuple, Union
+
+from aiohttp import payload
+
+from . import api, metrics
+from .bulk import BulkOperation
+from .cache import TTLCache
+from .gateway import Gateway
+
+log = logging.getLogger(__name__)
+
+TypeProgress = Callable[[int, Optional[int]], None]  # (bytes sent, total bytes or None if unknown)
+_HASH_CHUNK = 1024 * 1024
+
+
+class _ProgressFile(io.BufferedIOBase):
+    """delegates to a binary file, reports bytes read, i.e. sent: aiohttp reads the file chunk by chunk while sending
+
+    reads happen in aiohttp's executor threads, so ``progress`` is called back in the loop thread"""
+
+    def __init__(self, raw: IO[bytes], progress: TypeProgress, total: Optional[int],
+                 loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self._raw = raw
+        self._progress = progress
+        self._total = total
+        self._loop = loop
+        self._sent = 0
+
+    @property
+    def name(self):
+        return getattr(self._raw, 'name', None)
+
+    @property
+    def size(self) -> Optional[int]:
+        """bytes to send, from the position at wrapping"""
+        return self._total
+
+    def fileno(self) -> int:
+        return self._raw.fileno()
+
+    def seekable(self) -> bool:
+        return self._raw.seekable()
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._raw.tell()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        pos = self._raw.seek(offset, whence)
+        self._sent = 0  # rewound to resend
+        return pos
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        chunk = self._raw.read(size)
+        if chunk:
+            self._sent += len(chunk)
+            self._loop.call_soon_threadsafe(self._progress, self._sent, self._total)
+        return chunk
+
+    def close(self):
+        super().close()
+        self._raw.close()
+
+
+@payload.payload_type(_ProgressFile, order=payload.Order.try_first)
+class _ProgressFilePayload(payload.IOBasePayload):
+    """sent with Content-Length: the size is known ahead, while aiohttp can't tell it from a generic IO wrapper"""
+
+    @property
+    def size(self) -> Optional[int]:
+        return self._value.size
+
+
+class AssetUploader:
+    """
+    upload files as assets of khl, which are referred by url in messages
+
+    - files are streamed: aiohttp sends them chunk by chunk, read in executor threads, never loaded in memory at once
+    - paths are opened and hashed in executor threads, the event loop is never blocked by disk IO
+    - at most ``concurrency`` uploads run at the same time, others wait in line
+    - the url of an upload is cached by the SHA-256 of the content, uploading the same content again returns it
+      without a request; concurrent uploads of the same content share one.
+      hashing reads the file once before it's sent, so with the cache disabled it's skipped, along with the sharing
+
+    :param concurrency: max uploads at the same time, shared by all uploads through this uploader
+    :param cache_size: count of urls kept, <= 0 disables the cache
+    :param cache_ttl: seconds a url is kept, <= 0 means until evicted
+    """
+
+    def __init__(self, gate: Gateway, *, concurrency: int = 4, cache_size: int = 1024, cache_ttl: float = 0):
+        self.gate = gate
+        self.urls = TTLCache('assets', cache_size, cache_ttl)
+        self._sem = asyncio.Semaphore(max(concurrency, 1))
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._uploads = metrics.counter('asset.uploads')
+        self._uploaded_bytes = metrics.counter('asset.uploaded_bytes')
+
+    async def upload(self,
+                     file: Union[IO, str, Path],
+                     *,
+                     progress: Optional[TypeProgress] = None,
+                     bypass_cache: bool = False) -> str:
+        """
+        upload ``file``, return the url to it
+
+        :param file: a path, or a file opened in binary mode(read from its current position, which is restored
+            after hashing), other IOs are sent as is, without caching
+        :param progress: called with (bytes sent, total bytes) as the upload goes on, not called on cache hits
+        :param bypass_cache: upload even if the same content has been uploaded, the new url is cached
+        """
+        loop = asyncio.get_event_loop()
+        own = isinstance(file, (str, Path))
+        f = await loop.run_in_executor(None, open, file, 'rb') if own else file
+        handed_over = False  # the file is closed by the upload task, which may outlive this call if cancelled
+        try:
+            if self.urls.max_size > 0:
+                digest, size = await loop.run_in_executor(None, _digest, f)
+            else:  # nothing to look up: don't read the file one more time just to hash it
+                digest, size = None, await loop.run_in_executor(None, _size, f)
+            if digest is None:
+                return await self._upload(f, size, progress)
+
+            url = None if bypass_cache else self.urls.get(digest)
+            if url is not None:
+                log.debug(f'asset {digest[:12]} uploaded before: {url}')
+                return url
+            task = None if bypass_cache else self._inflight.get(digest)
+            if task is None:
+                task = asyncio.ensure_future(self._upload(f, size, progress, close=own))
+                handed_over = True
+                self._inflight[digest] = task
+                task.add_done_callback(lambda t: self._on_done(digest, t))
+            return await asyncio.shield(task)
+        finally:
+            if own and not handed_over:
+                await loop.run_in_executor(None, f.close)
+
+    def upload_many(self,
+                    files: Iterable[Union[IO, str, Path]],
+                    *,
+                    concurrency: int = 4,
+                    bypass_cache: bool = False) -> BulkOperation:
+        """
+        upload each of ``files``, see :class:`BulkOperation` for how to wait or stream the outcomes,
+        each result is the url of the file
+
+        uploads are bounded by both ``concurrency`` and the uploader's own
+        """
+        return BulkOperation(lambda f: self.upload(f, bypass_cache=bypass_cache), files, concurrency=concurrency)
+
+    async def _upload(self, f: IO, size: Optional[int], progress: Optional[TypeProgress], close: bool = False) -> str:
+        loop = asyncio.get_event_loop()
+        try:
+            async with self._sem:
+                body = _ProgressFile(f, progress, size, loop) if progress and size is not None else f
+                url = (await self.gate.exec_req(api.Asset.create(file=body)))['url']
+        finally:
+            if close:
+                await loop.run_in_executor(None, f.close)
+        self._uploads.inc()
+        if size:
+            self._uploaded_bytes.inc(size)
+        return url
+
+    def _on_done(self, digest: str, task: asyncio.Future):
+        if self._inflight.get(digest) is task:
+            self._inflight.pop(digest)
+        if not task.cancelled() and task.exception() is None:  # retrieved anyway: no warning if none waits
+            self.urls.set(digest, task.result())
+
+
+def _size(f: IO) -> Optional[int]:
+    """size of the rest of a binary file, without reading it, the position is restored; None if not possible"""
+    try:
+        start = f.tell()
+        end = f.seek(0, io.SEEK_END)
+        f.seek(start)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return end - start
+
+
+def _digest(f: IO) -> Tuple[Optional[str], Optional[int]]:
+    """(SHA-256 hex, size) of the rest of a binary file, the position is restored; (None, None) if not possible"""
+    try:
+        if not f.seekable():
+            return None, None
+        start = f.tell()
+    except (AttributeError, OSError, ValueError):
+        return None, None
+    h = hashlib.sha256()
+    size = 0
+    try:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+            if not isinstance(chunk, bytes):  # text mode
+                return None, None
+            h.update(chunk)
+            size += len(chunk)
+    finally:
+        f.seek(start)
+    return h.hexdigest(), size
@@ -0,0 +1,39 @@
+"""backoff: growing delays between attempts, shared by reconnects and retries"""
+import random
+
+
+class Backoff:
+    """
+    exponential backoff with jitter
+
+    the n-th delay is ``min(cap, base * factor ** n)``, with jitter it's drawn from [delay/2, delay],
+    so a crowd of clients failing at the same time won't come back at the same time
+
+    :param base: the first delay, seconds
+    :param cap: upper bound of delays, seconds
+    :param factor: growth of delays
+    :param jitter: randomize delays or not
+    """
+
+    def __init__(self, base: float = 1.0, cap: float = 60.0, factor: float = 2.0, jitter: bool = True):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def peek(self) -> float:
+        """the upper bound of the next delay, without consuming an attempt"""
+        return min(self.cap, self.base * self.factor**min(self.attempts, 64))  # bounded exponent: no overflow
+
+    def next_delay(self) -> float:
+        """get the delay before the next attempt, seconds"""
+        delay = self.peek()
+        self.attempts += 1
+        if self.jitter:
+            delay = random.uniform(delay / 2, delay)
+        return delay
+
+    def reset(self):
+        """start over from ``base``, usually after a success"""
+        self.attempts = 0
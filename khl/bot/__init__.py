@@ -1,2 +1,3 @@
 """bot is a virtual entity that provides a high-level view to code-user reaction workflow"""
 from .bot import Bot
+from .shard import ShardedRunner
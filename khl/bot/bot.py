@@ -3,7 +3,7 @@ import asyncio
 import logging
 import warnings
 from pathlib import Path
-from typing import Dict, Callable, List, Optional, Union, Coroutine, IO
+from typing import Dict, Callable, List, Optional, Union, Coroutine, IO, Iterable
 
 from .. import AsyncRunnable  # interfaces
 from .. import Cert, HTTPRequester, RateLimiter, WebhookReceiver, WebsocketReceiver, Gateway, Client  # net related
@@ -11,6 +11,7 @@ from .. import MessageTypes, EventTypes, SlowModeTypes, SoftwareTypes  # types
 from .. import User, Channel, PublicChannel, Guild, Event, Message  # concepts
 from ..command import CommandManager
 from ..game import Game
+from ..pkg_queue import PkgQueue
 from ..task import TaskManager
 
 log = logging.getLogger(__name__)
@@ -50,7 +51,15 @@ class Bot(AsyncRunnable):
                  compress: bool = True,
                  port=5000,
                  route='/khl-wh',
-                 ratelimiter: Optional[RateLimiter] = RateLimiter(start=80)):
+                 ratelimiter: Optional[RateLimiter] = RateLimiter(start=80),
+                 pkg_queue_size: int = 1024,
+                 shard_queue_size: int = 64,
+                 pkg_overflow: PkgQueue.Overflow = PkgQueue.Overflow.BLOCK,
+                 pkg_drop_types: Iterable[MessageTypes] = (),
+                 max_handlers: int = 256,
+                 pkg_consumers: int = 1,
+                 fast_ack: bool = False,
+                 reuse_port: bool = False):
         """
         The most common usage: ``Bot(token='xxxxxx')``
 
@@ -63,11 +72,29 @@ class Bot(AsyncRunnable):
         :param compress: used to tune the receiver
         :param port: used to tune the WebhookReceiver
         :param route: used to tune the WebhookReceiver
+        :param pkg_queue_size: used to tune the Client, capacity of the pkg_queue
+        :param shard_queue_size: used to tune the Client, capacity of the queue of each pkg consumer
+        :param pkg_overflow: used to tune the Client, policy when the pkg_queue is full
+        :param pkg_drop_types: used to tune the Client, droppable pkg types under ``PkgQueue.Overflow.DROP_TYPES``
+        :param max_handlers: used to tune the Client, max count of handlers running at the same time
+        :param pkg_consumers: used to tune the Client, count of concurrent pkg consumers(sharded by channel)
+        :param fast_ack: used to tune the WebhookReceiver, acknowledge requests after O(1) checks, decode them later
+        :param reuse_port: used to tune the WebhookReceiver, share the port with other bot processes
         """
         if not token and not cert:
             raise ValueError('require token or cert')
 
-        self._init_client(cert or Cert(token=token), client, gate, out, compress, port, route, ratelimiter)
+        client_args = {
+            'pkg_queue_size': pkg_queue_size,
+            'shard_queue_size': shard_queue_size,
+            'pkg_overflow': pkg_overflow,
+            'pkg_drop_types': pkg_drop_types,
+            'max_handlers': max_handlers,
+            'pkg_consumers': pkg_consumers
+        }
+        webhook_args = {'fast_ack': fast_ack, 'reuse_port': reuse_port}
+        self._init_client(cert or Cert(token=token), client, gate, out, compress, port, route, ratelimiter,
+                          client_args, webhook_args)
         self._register_client_handler()
 
         self.command = CommandManager()
@@ -80,12 +107,13 @@ class Bot(AsyncRunnable):
         self._shutdown_index = []
 
     def _init_client(self, cert: Cert, client: Client, gate: Gateway, out: HTTPRequester, compress: bool, port, route,
-                     ratelimiter):
+                     ratelimiter, client_args: Dict, webhook_args: Dict):
         """
         construct self.client from args.
 
         you can init client with kinds of filling ways,
-        so there is a priority in the rule: client > gate > out = compress = port = route
+        so there is a priority in the rule: client > gate > out = compress = port = route,
+        ``client_args`` are applied unless ``client`` is given
 
         :param cert: used to build requester and receiver
         :param client: the bot relies on
@@ -94,13 +122,15 @@ class Bot(AsyncRunnable):
         :param compress: used to tune the receiver
         :param port: used to tune the WebhookReceiver
         :param route: used to tune the WebhookReceiver
+        :param client_args: kwargs used to construct the Client
+        :param webhook_args: extra kwargs used to construct the WebhookReceiver
         :return:
         """
         if client:
             self.client = client
             return
         if gate:
-            self.client = Client(gate)
+            self.client = Client(gate, **client_args)
             return
 
         # client and gate not in args, build them
@@ -108,11 +138,11 @@ class Bot(AsyncRunnable):
         if cert.type == Cert.Types.WEBSOCKET:
             _in = WebsocketReceiver(cert, compress)
         elif cert.type == Cert.Types.WEBHOOK:
-            _in = WebhookReceiver(cert, port=port, route=route, compress=compress)
+            _in = WebhookReceiver(cert, port=port, route=route, compress=compress, **webhook_args)
         else:
             raise ValueError(f'cert type: {cert.type} not supported')
 
-        self.client = Client(Gateway(_out, _in))
+        self.client = Client(Gateway(_out, _in), **client_args)
 
     def _register_client_handler(self):
         # text and kmd -> msg
@@ -478,6 +508,7 @@ class Bot(AsyncRunnable):
         await self.client.update_channel(channel, name, topic, slow_mode)
 
     async def start(self):
+        await self.client.gate.requester.warm_up()  # connections are ready when startup handlers make requests
         for func in self._startup_index:
             await func(self)
         if self._is_running:
@@ -494,4 +525,5 @@ class Bot(AsyncRunnable):
         except KeyboardInterrupt:
             for func in self._shutdown_index:
                 self.loop.run_until_complete(func(self))
+            self.loop.run_until_complete(self.client.gate.requester.close())
             log.info('see you next time')
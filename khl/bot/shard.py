@@ -0,0 +1,237 @@
+"""sharded runtime: one ingress process receives pkgs, worker processes run the bot and handle them"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import tempfile
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional
+
+from .. import metrics, tracing
+from ..client import Client
+from ..pkg_queue import PkgQueue
+from ..ratelimit_backend import MmapBackend
+from ..receiver import Receiver
+from .bot import Bot
+
+log = logging.getLogger(__name__)
+
+TypeBotFactory = Callable[[], Bot]
+
+
+class _IPCReceiver(Receiver):
+    """worker side receiver: pkgs come in batches from the ingress process, None means to stop"""
+
+    def __init__(self, ipc_queue: multiprocessing.Queue):
+        super().__init__()
+        self._ipc_queue = ipc_queue
+        self.closed = asyncio.Event()
+
+    @property
+    def type(self) -> str:
+        return 'ipc'
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await loop.run_in_executor(None, self._ipc_queue.get)
+            if batch is None:
+                self.closed.set()
+                return
+            for pkg in batch:
+                await self.pkg_queue.put(pkg)
+
+
+async def _run_worker(worker_id: int, bot_factory: TypeBotFactory, ipc_queue, report_queue, ratelimit_path: str,
+                      metrics_interval: float):
+    bot = bot_factory()
+    receiver = _IPCReceiver(ipc_queue)
+    bot.client.gate.receiver = receiver
+    requester = bot.client.gate.requester
+    if requester.ratelimiter is not None and ratelimit_path:
+        requester.ratelimiter.backend = MmapBackend(ratelimit_path)
+
+    async def report():
+        while True:
+            await asyncio.sleep(metrics_interval)
+            report_queue.put((worker_id, metrics.snapshot()))
+
+    main = asyncio.ensure_future(bot.start())
+    reporter = asyncio.ensure_future(report())
+    log.info(f'[ shard ] worker {worker_id} launched, pid: {os.getpid()}')
+    await asyncio.wait([main, asyncio.ensure_future(receiver.closed.wait())], return_when=asyncio.FIRST_COMPLETED)
+    if main.done():  # the bot exited by itself, e.g. errors in startup handlers
+        main.result()
+
+    await bot.client.drain()
+    for func in bot._shutdown_index:  # pylint: disable=protected-access
+        await func(bot)
+    report_queue.put((worker_id, metrics.snapshot()))
+    reporter.cancel()
+    main.cancel()
+    await asyncio.gather(main, reporter, return_exceptions=True)
+    await requester.close()
+    if requester.ratelimiter is not None:
+        await requester.ratelimiter.backend.close()
+
+
+def _worker_main(worker_id: int, bot_factory: TypeBotFactory, ipc_queue, report_queue, ratelimit_path: str,
+                 metrics_interval: float):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C hits the whole process group, the ingress drives the stop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(
+            _run_worker(worker_id, bot_factory, ipc_queue, report_queue, ratelimit_path, metrics_interval))
+    finally:
+        loop.close()
+
+
+class ShardedRunner:
+    """
+    run one bot across processes, to use more than one core
+
+    the ingress(the current process) runs ``receiver`` and routes pkgs to ``workers`` worker processes,
+    by the hash of the channel(``shard_by='channel'``) or the guild(``shard_by='guild'``),
+    so pkgs of one channel/guild are always handled in order by the same worker.
+
+    each worker builds its own bot with ``bot_factory``, which registers handlers as usual,
+    it must be picklable(a module-level function) since workers are spawned.
+    workers share the rate limit state through a ``MmapBackend``, and report their metrics
+    to the ingress every ``metrics_interval`` seconds, read them with ``worker_metrics``
+
+    :param receiver: the ingress receiver, e.g. ``WebsocketReceiver(cert, compress=True)``
+    :param ratelimit_path: the rate limit state file shared by workers, a temp file if empty,
+        set it to keep the state across restarts
+    """
+
+    _MAX_BATCH = 64
+    _IPC_QUEUE_SIZE = 256  # in batches
+
+    def __init__(self,
+                 bot_factory: TypeBotFactory,
+                 receiver: Receiver,
+                 *,
+                 workers: Optional[int] = None,
+                 shard_by: str = 'channel',
+                 share_ratelimit: bool = True,
+                 ratelimit_path: str = '',
+                 metrics_interval: float = 10,
+                 mp_context: str = 'spawn'):
+        if shard_by not in ('channel', 'guild'):
+            raise ValueError(f'shard_by must be channel or guild, got: {shard_by}')
+        self.bot_factory = bot_factory
+        self.receiver = receiver
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_by = shard_by
+        self.share_ratelimit = share_ratelimit
+        self.ratelimit_path = ratelimit_path
+        self.metrics_interval = metrics_interval
+        self.worker_metrics: Dict[int, Dict] = {}
+
+        self._ctx = multiprocessing.get_context(mp_context)
+        self._temp_ratelimit_path = ''
+        self._ipc_queues: List[multiprocessing.Queue] = []
+        self._report_queue: Optional[multiprocessing.Queue] = None
+        self._report_thread: Optional[threading.Thread] = None
+        self._processes: List[multiprocessing.Process] = []
+        self._routed = [metrics.counter(f'shard.worker.{i}.routed') for i in range(self.workers)]
+
+    def shard_of(self, pkg: Dict) -> int:
+        """index of the worker that ``pkg`` goes to, by the same channel key as ``Client`` shards its consumers"""
+        key = Client._shard_key(pkg)  # pylint: disable=protected-access
+        if self.shard_by == 'guild':
+            key = (pkg.get('extra') or {}).get('guild_id') or key
+        return zlib.crc32(str(key).encode()) % self.workers  # stable across processes, unlike hash()
+
+    def _spawn_workers(self):
+        ratelimit_path = ''
+        if self.share_ratelimit:
+            ratelimit_path = self.ratelimit_path
+            if not ratelimit_path:
+                fd, ratelimit_path = tempfile.mkstemp(prefix='khl-ratelimit-')
+                os.close(fd)
+                self._temp_ratelimit_path = ratelimit_path
+        self._report_queue = self._ctx.Queue()
+        self._report_thread = threading.Thread(target=self._collect_metrics, name='khl-shard-metrics', daemon=True)
+        self._report_thread.start()
+        for i in range(self.workers):
+            ipc_queue = self._ctx.Queue(self._IPC_QUEUE_SIZE)
+            p = self._ctx.Process(target=_worker_main,
+                                  args=(i, self.bot_factory, ipc_queue, self._report_queue, ratelimit_path,
+                                        self.metrics_interval),
+                                  name=f'khl-shard-{i}',
+                                  daemon=True)
+            p.start()
+            self._ipc_queues.append(ipc_queue)
+            self._processes.append(p)
+            metrics.gauge(f'shard.worker.{i}.ipc_depth', ipc_queue.qsize)
+
+    async def start(self):
+        """spawn workers, run the receiver and route pkgs"""
+        self._spawn_workers()
+        self.receiver.pkg_queue = PkgQueue(self._IPC_QUEUE_SIZE * self._MAX_BATCH)
+        await asyncio.gather(self.receiver.start(), self._route())
+
+    async def _route(self):
+        loop = asyncio.get_event_loop()
+        pkg_queue = self.receiver.pkg_queue
+        while True:
+            batches = [[] for _ in range(self.workers)]
+            pkg = await pkg_queue.get()
+            count = 0
+            while True:  # drain what's already queued, one IPC message carries a batch
+                tracing.detach(pkg)  # spans are process-local
+                batches[self.shard_of(pkg)].append(pkg)
+                pkg_queue.task_done()
+                count += 1
+                if count >= self._MAX_BATCH or pkg_queue.empty():
+                    break
+                pkg = pkg_queue.get_nowait()
+
+            for i, batch in enumerate(batches):
+                if not batch:
+                    continue
+                self._routed[i].inc(len(batch))
+                try:
+                    self._ipc_queues[i].put_nowait(batch)
+                except queue.Full:  # the worker falls behind, wait without blocking the loop
+                    await loop.run_in_executor(None, self._ipc_queues[i].put, batch)
+
+    def _collect_metrics(self):
+        while True:
+            report = self._report_queue.get()
+            if report is None:
+                return
+            worker_id, snapshot = report
+            self.worker_metrics[worker_id] = snapshot
+
+    def stop(self, timeout: float = 10):
+        """let workers finish queued pkgs and exit, terminate those not exited in ``timeout`` seconds"""
+        for q in self._ipc_queues:
+            q.put(None)
+        deadline = time.monotonic() + timeout
+        for p in self._processes:
+            p.join(max(deadline - time.monotonic(), 0))
+            if p.is_alive():
+                log.warning(f'[ shard ] {p.name} not exited in time, terminate it')
+                p.terminate()
+        if self._report_queue is not None:
+            self._report_queue.put(None)
+            self._report_thread.join()
+        if self._temp_ratelimit_path:
+            os.remove(self._temp_ratelimit_path)
+
+    def run(self):
+        """run in blocking mode, stop on KeyboardInterrupt"""
+        loop = asyncio.get_event_loop()
+        try:
+            loop.run_until_complete(self.start())
+        except KeyboardInterrupt:
+            log.info('[ shard ] stopping workers')
+        finally:
+            self.stop()
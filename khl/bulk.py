@@ -0,0 +1,152 @@
+"""bulk operations: one API call for each of many items, with bounded concurrency, partial failures and progress"""
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Generator, Iterable, List, NamedTuple, Optional
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+
+class BulkItem(NamedTuple):
+    """outcome of the call for one item"""
+    item: Any
+    result: Any
+    error: Optional[Exception]
+
+    @property
+    def ok(self) -> bool:
+        """the call succeeded"""
+        return self.error is None
+
+
+class BulkResult:
+    """outcomes of all items, in the order they completed"""
+
+    def __init__(self, items: List[BulkItem]):
+        self.items = items
+
+    @property
+    def succeeded(self) -> List[BulkItem]:
+        """items whose call succeeded"""
+        return [i for i in self.items if i.ok]
+
+    @property
+    def failed(self) -> List[BulkItem]:
+        """items whose call raised, the exception is in ``.error``"""
+        return [i for i in self.items if not i.ok]
+
+    @property
+    def ok(self) -> bool:
+        """all calls succeeded"""
+        return all(i.ok for i in self.items)
+
+    def __repr__(self):
+        return f'<BulkResult succeeded: {len(self.items) - len(self.failed)}, failed: {len(self.failed)}>'
+
+
+class BulkOperation:
+    """
+    call ``func(item)`` for each of ``items``, at most ``concurrency`` calls at the same time
+
+    calls go through the requester as usual, so each one still waits for the ratelimiter;
+    the concurrency bound keeps a large batch from flooding the ratelimiter queue and the connection pool.
+    a failed call does not stop others, its exception is reported with the item.
+
+    run it once, in either way::
+
+        result = await guild.grant_role_bulk(role, users)    # wait for all, get a BulkResult
+
+        op = guild.grant_role_bulk(role, users)
+        async for done in op:  # stream outcomes as calls complete
+            print(f'{op.done}/{op.total}', done.item, done.ok)
+
+    breaking out of the loop stops starting calls, those already in flight run to their end:
+    their outcomes are not yielded but still counted in ``done`` and ``failed``.
+    cancelling the iterating task cancels the calls in flight.
+
+    :param concurrency: max calls in flight
+    """
+
+    def __init__(self, func: Callable[[Any], Awaitable], items: Iterable, *, concurrency: int = 4):
+        self._func = func
+        self._items = list(items)
+        self._concurrency = max(concurrency, 1)
+        self._outcomes: List[BulkItem] = []
+        self._started = False
+        self._ok = metrics.counter('bulk.ok')
+        self._failed = metrics.counter('bulk.failed')
+
+    @property
+    def total(self) -> int:
+        """count of items"""
+        return len(self._items)
+
+    @property
+    def done(self) -> int:
+        """count of items whose call completed, succeeded or failed"""
+        return len(self._outcomes)
+
+    @property
+    def failed(self) -> int:
+        """count of items whose call failed so far"""
+        return sum(1 for i in self._outcomes if not i.ok)
+
+    async def _call(self, item) -> BulkItem:
+        try:
+            return BulkItem(item, await self._func(item), None)
+        except Exception as e:  # pylint: disable=broad-except
+            log.debug(f'bulk: call failed on {item}: {e}')
+            return BulkItem(item, None, e)
+
+    async def __aiter__(self) -> AsyncIterator[BulkItem]:
+        if self._started:
+            raise RuntimeError('a BulkOperation can run only once')
+        self._started = True
+
+        pending = iter(self._items)
+        completed: asyncio.Queue = asyncio.Queue()
+
+        stopped = False
+
+        async def worker():
+            for item in pending:  # shared by workers, next() never interleaves: no await inside
+                if stopped:
+                    break
+                await completed.put(await self._call(item))
+            await completed.put(None)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(self._concurrency, self.total))]
+        running = len(workers)
+        try:
+            while running:
+                outcome = await completed.get()
+                if outcome is None:
+                    running -= 1
+                    continue
+                self._record(outcome)
+                yield outcome
+        except asyncio.CancelledError:
+            for w in workers:
+                w.cancel()
+            raise
+        finally:  # the caller stops iterating: calls not started yet are dropped, those in flight finish
+            stopped = True
+            await asyncio.gather(*workers, return_exceptions=True)
+            while not completed.empty():
+                outcome = completed.get_nowait()
+                if outcome is not None:
+                    self._record(outcome)
+
+    def _record(self, outcome: BulkItem):
+        self._outcomes.append(outcome)
+        (self._ok if outcome.ok else self._failed).inc()
+
+    async def wait(self) -> BulkResult:
+        """run all calls, return the outcomes"""
+        async for _ in self:
+            pass
+        return BulkResult(self._outcomes)
+
+    def __await__(self) -> Generator[Any, None, BulkResult]:
+        return self.wait().__await__()
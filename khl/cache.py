@@ -0,0 +1,243 @@
+"""entity cache: raw data of users, channels, guilds and roles kept by id, with TTL and LRU eviction"""
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional
+
+from . import metrics
+from ._types import EventTypes, MessageTypes
+
+
+class EventPatch(NamedTuple):
+    """
+    what a system event changes, shared by ``EntityCache`` and ``GuildState`` so both read events the same way
+
+    :param kind: ``guild``, ``channel``, ``role``, ``guild_user`` or ``user``
+    :param guild_id: the guild the entity belongs to, None for ``user``
+    :param id: id of the entity, e.g. the role_id for ``role``, the guild_id for ``guild``
+    :param data: fields to put, None if the entity is gone
+    """
+    kind: str
+    guild_id: Optional[str]
+    id: Optional[Any]
+    data: Optional[Dict]
+
+
+def event_patch(event_type: EventTypes, target_id: str, body: Dict) -> Optional[EventPatch]:
+    """the change the event brings, None if it changes no entity"""
+    # pylint: disable=too-many-return-statements
+    if event_type == EventTypes.UPDATED_GUILD:
+        guild_id = body.get('id', target_id)
+        return EventPatch('guild', guild_id, guild_id, body)
+    if event_type in (EventTypes.DELETED_GUILD, EventTypes.SELF_EXITED_GUILD):
+        guild_id = body.get('id', body.get('guild_id', target_id))  # target_id of self_exited_guild is not the guild
+        return EventPatch('guild', guild_id, guild_id, None)
+    if event_type in (EventTypes.ADDED_CHANNEL, EventTypes.UPDATED_CHANNEL):
+        return EventPatch('channel', body.get('guild_id', target_id), body.get('id'), body)
+    if event_type == EventTypes.DELETED_CHANNEL:
+        return EventPatch('channel', target_id, body.get('id'), None)
+    if event_type in (EventTypes.ADDED_ROLE, EventTypes.UPDATED_ROLE):
+        return EventPatch('role', target_id, body.get('role_id'), body)
+    if event_type == EventTypes.DELETED_ROLE:
+        return EventPatch('role', target_id, body.get('role_id'), None)
+    if event_type == EventTypes.UPDATED_GUILD_MEMBER:
+        return EventPatch('guild_user', target_id, body.get('user_id'), {'nickname': body.get('nickname')})
+    if event_type == EventTypes.EXITED_GUILD:
+        return EventPatch('guild_user', target_id, body.get('user_id'), None)
+    if event_type == EventTypes.USER_UPDATED:
+        return EventPatch('user', None, body.get('user_id'), {k: v for k, v in body.items() if k != 'user_id'})
+    return None
+
+
+class TTLCache:
+    """
+    LRU cache whose entries expire ``ttl`` seconds after being set
+
+    :param name: used in metric names: ``cache.{name}.hits/misses/size``
+    :param max_size: beyond it, the least recently used entry is evicted, <= 0 disables the cache
+    :param ttl: seconds an entry lives, <= 0 means until evicted
+    """
+
+    def __init__(self, name: str, max_size: int = 1024, ttl: float = 300):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: 'OrderedDict[Hashable, List]' = OrderedDict()  # key -> [expires_at, value]
+        self._hits = metrics.counter(f'cache.{name}.hits')
+        self._misses = metrics.counter(f'cache.{name}.misses')
+        metrics.gauge(f'cache.{name}.size', self.__len__)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.peek(key) is not None
+
+    def peek(self, key: Hashable) -> Any:
+        """the live value of ``key`` or None, without touching the LRU order or the hit counters"""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] and entry[0] < time.monotonic():
+            del self._data[key]
+            return None
+        return entry[1]
+
+    def get(self, key: Hashable) -> Any:
+        """the live value of ``key``, None if missing or expired"""
+        value = self.peek(key)
+        if value is None:
+            self._misses.inc()
+            return None
+        self._data.move_to_end(key)
+        self._hits.inc()
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """put ``value``, evict the least recently used entry if full"""
+        if self.max_size <= 0:
+            return
+        self._data[key] = [time.monotonic() + self.ttl if self.ttl > 0 else 0, value]
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Any:
+        """remove ``key``, return its value or None"""
+        entry = self._data.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def clear(self):
+        """remove all entries"""
+        self._data.clear()
+
+
+class EntityCache:
+    """
+    raw data(as khl server sends) of entities, objects are built from it on each fetch,
+    so a cached entity is never shared and mutated by two handlers
+
+    - ``users``: user_id -> user
+    - ``guild_users``: (guild_id, user_id) -> user in the guild, with nickname and roles
+    - ``channels``: channel_id -> channel
+    - ``guilds``: guild_id -> guild
+    - ``roles``/``channel_lists``: guild_id -> list of roles/channels in the guild
+    - ``authors``: (guild_id, user_id) -> ``extra.author`` of the latest message, a partial member payload,
+      never returned by fetches
+
+    entries are populated by fetch results, kept fresh by system events(update/delete of guilds, channels, roles
+    and members), and dropped by writes through this library(e.g. ``Guild.grant_role()``), which khl sends no
+    event for
+
+    :param max_size: capacity of each kind of entities
+    :param ttl: seconds an entry lives, an entry refreshed by an event lives another ``ttl``
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 300):
+        self.users = TTLCache('users', max_size, ttl)
+        self.guild_users = TTLCache('guild_users', max_size, ttl)
+        self.channels = TTLCache('channels', max_size, ttl)
+        self.guilds = TTLCache('guilds', max_size, ttl)
+        self.roles = TTLCache('roles', max_size, ttl)
+        self.channel_lists = TTLCache('channel_lists', max_size, ttl)
+        self.authors = TTLCache('authors', max_size, ttl)
+
+    def clear(self):
+        """drop all entries"""
+        for c in (self.users, self.guild_users, self.channels, self.guilds, self.roles, self.channel_lists,
+                  self.authors):
+            c.clear()
+
+    def forget_guild_user(self, guild_id: str, user_id: str):
+        """drop the member, after its roles or nickname are changed"""
+        self.guild_users.pop((guild_id, user_id))
+        self.authors.pop((guild_id, user_id))
+
+    def forget_roles(self, guild_id: str):
+        """drop the role list of the guild, after a role is created, updated or deleted"""
+        self.roles.pop(guild_id)
+
+    def forget_channel(self, guild_id: Optional[str], channel_id: Optional[str] = None):
+        """drop the channel and the channel list of the guild, after a channel is created, updated or deleted"""
+        if channel_id is not None:
+            self.channels.pop(channel_id)
+        if guild_id is not None:
+            self.channel_lists.pop(guild_id)
+
+    @staticmethod
+    async def fetch(kind: TTLCache, key: Hashable, load: Callable[[], Awaitable[Any]], bypass: bool = False) -> Any:
+        """
+        the cached data of ``key`` in ``kind``(e.g. ``cache.users``), or ``await load()`` and cache it
+
+        :param bypass: skip the lookup and always ``load()``, the result is still cached
+        """
+        data = None if bypass else kind.get(key)
+        if data is None:
+            data = await load()
+            kind.set(key, data)
+        return data
+
+    def feed(self, pkg: Dict):
+        """learn from an inbound pkg, called by ``Client`` on every pkg before dispatching"""
+        extra = pkg.get('extra')
+        if not isinstance(extra, dict):
+            return
+        if pkg.get('type') == MessageTypes.SYS.value:
+            try:
+                patch = event_patch(EventTypes(extra.get('type')), pkg.get('target_id'), extra.get('body') or {})
+            except ValueError:  # event types not known yet
+                return
+            if patch is not None:
+                self.apply(patch)
+            return
+        # the author is a partial member payload(nickname, roles in the guild): not a ``user/view`` result,
+        # kept apart from ``guild_users``
+        author = extra.get('author')
+        guild_id = extra.get('guild_id')
+        if author and 'id' in author and guild_id:
+            self.authors.set((guild_id, author['id']), author)
+
+    def apply(self, patch: EventPatch):
+        """apply the change of a system event to cached entries"""
+        # pylint: disable=too-many-branches
+        if patch.kind == 'guild':
+            if patch.data is not None:
+                _patch(self.guilds, patch.id, patch.data)
+            else:
+                for c in (self.guilds, self.roles, self.channel_lists):
+                    c.pop(patch.id)
+        elif patch.kind == 'channel':
+            if patch.id is None:
+                return
+            if patch.data is not None:
+                self.channels.set(patch.id, patch.data)
+            else:
+                self.channels.pop(patch.id)
+            _patch_list(self.channel_lists, patch.guild_id, 'id', patch.id, patch.data)
+        elif patch.kind == 'role':
+            _patch_list(self.roles, patch.guild_id, 'role_id', patch.id, patch.data)
+        elif patch.kind == 'guild_user':
+            if patch.data is not None:
+                _patch(self.guild_users, (patch.guild_id, patch.id), patch.data)
+                _patch(self.authors, (patch.guild_id, patch.id), patch.data)
+            else:
+                self.forget_guild_user(patch.guild_id, patch.id)
+        elif patch.kind == 'user':
+            _patch(self.users, patch.id, patch.data)
+
+
+def _patch(cache: TTLCache, key: Hashable, fields: Dict):
+    """update fields of the cached entity in place, not cached: nothing to do, partial data is not cached"""
+    data = cache.peek(key)
+    if data is not None:
+        cache.set(key, {**data, **fields})
+
+
+def _patch_list(cache: TTLCache, key: Hashable, id_field: str, id_value: Optional[Any], item: Optional[Dict]):
+    """replace/append/remove(``item=None``) the item with ``id_value`` in the cached list"""
+    items = cache.peek(key)
+    if items is None or id_value is None:
+        return
+    items = [i for i in items if i.get(id_field) != id_value]
+    if item is not None:
+        items.append(item)
+    cache.set(key, items)
@@ -1,11 +1,13 @@
 """authorization/encrypt/decrypt works in khl"""
 import base64
-import json
 from enum import Enum
+from typing import Union
 
 from Cryptodome.Cipher import AES
 from Cryptodome.Util import Padding
 
+from . import codec
+
 
 class Cert:
     """
@@ -45,6 +47,18 @@ class Cert:
         self.verify_token = verify_token
         self.encrypt_key = encrypt_key
 
+    @property
+    def encrypt_key(self) -> str:
+        """key to decrypt webhook pkgs, empty if encryption is off"""
+        return self._encrypt_key
+
+    @encrypt_key.setter
+    def encrypt_key(self, key: str):
+        self._encrypt_key = key
+        # only the padded key is precomputed, the cipher is not: CBC ciphers are stateful, one is built per pkg;
+        # plain bytes also keep Cert picklable, e.g. passed to shard workers
+        self._key_bytes = key.encode().ljust(32, b'\x00') if key else b''
+
     def decrypt(self, data: bytes) -> str:
         """ decrypt data
 
@@ -53,13 +67,19 @@ class Cert:
         """
         if not self.encrypt_key:
             return ''
-        data = base64.b64decode(data)
-        data = AES.new(key=self.encrypt_key.encode().ljust(32, b'\x00'), mode=AES.MODE_CBC,
-                       iv=data[0:16]).decrypt(base64.b64decode(data[16:]))
-        data = Padding.unpad(data, 16)
-        return data.decode('utf-8')
+        return self._decrypt_bytes(data).decode('utf-8')
+
+    def _decrypt_bytes(self, data: Union[bytes, str]) -> bytes:
+        """decrypt into bytes, iv and ciphertext are sliced from a memoryview without copies
+
+        ``AES.new()``(key expansion included) still runs for every pkg"""
+        data = memoryview(base64.b64decode(data))  # layout: iv(16 bytes) + base64(ciphertext)
+        plain = AES.new(self._key_bytes, AES.MODE_CBC, iv=data[:16]).decrypt(base64.b64decode(data[16:]))
+        return Padding.unpad(plain, 16)
 
-    def decode_raw(self, raw: bytes) -> dict:
+    def decode_raw(self, raw: Union[bytes, str]) -> dict:
         """decode raw package into plaintext data"""
-        raw = json.loads(str(raw, encoding='utf-8'))
-        return json.loads(self.decrypt(raw['encrypt'])) if ('encrypt' in raw.keys()) else raw
+        pkg = codec.loads(raw)
+        if not self.encrypt_key:  # websocket and non-encrypted webhook: no decryption at all
+            return pkg
+        return codec.loads(self._decrypt_bytes(pkg['encrypt'])) if 'encrypt' in pkg else pkg
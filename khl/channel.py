@@ -1,10 +1,10 @@
 """abstraction of khl concept channel: where messages flow in"""
-import json
 from abc import ABC, abstractmethod
-from typing import Union, List, Dict
+from typing import AsyncIterator, Iterable, Union, List, Dict
 
-from . import api
+from . import api, codec, tracing
 from ._types import MessageTypes, ChannelTypes, SlowModeTypes, MessageFlagModes
+from .bulk import BulkOperation
 from .gateway import Requestable, Gateway
 from .interface import LazyLoadable
 from .permission import ChannelPermission, PermissionHolder
@@ -82,6 +82,7 @@ class PublicChannel(Channel, PermissionHolder, ABC):
         if slow_mode is not None:
             params['slow_mode'] = unpack_value(slow_mode)
         rt = await self.gate.exec_req(api.Channel.update(**params))
+        self.gate.cache.forget_channel(self.guild_id, self.id)
         await self.load()
         return rt
 
@@ -95,7 +96,23 @@ class PublicChannel(Channel, PermissionHolder, ABC):
                          page_size: int = 50,
                          filter_user_id: str = None) -> List[User]:
         """list the users who can see this channel"""
-        params = {'guild_id': self.guild_id, 'channel_id': self.id, 'page': page, 'page_size': page_size}
+        return [
+            u async for u in self.iter_users(search, role, mobile_verified, active_time, joined_at, page, page_size,
+                                             filter_user_id)
+        ]
+
+    async def iter_users(self,
+                         search: str = None,
+                         role: Union[Role, str, int] = None,
+                         mobile_verified: bool = None,
+                         active_time: int = None,
+                         joined_at: int = None,
+                         page: int = 1,
+                         page_size: int = 50,
+                         filter_user_id: str = None) -> AsyncIterator[User]:
+        """iterate over the users who can see this channel, from ``page`` to the end,
+        pages are fetched ahead while the caller consumes"""
+        params = {'guild_id': self.guild_id, 'channel_id': self.id}
         if search is not None:
             params['search'] = search
         if role is not None:
@@ -108,8 +125,8 @@ class PublicChannel(Channel, PermissionHolder, ABC):
             params['joined_at'] = joined_at
         if filter_user_id is not None:
             params['filter_user_id'] = filter_user_id
-        users = await self.gate.exec_paged_req(api.Guild.userList(**params))
-        return [User(_gate_=self.gate, _lazy_loaded_=True, **i) for i in users]
+        async for i in self.gate.iter_paged_req(api.Guild.userList(**params), begin_page=page, page_size=page_size):
+            yield User(_gate_=self.gate, _lazy_loaded_=True, **i)
 
     async def list_messages(self,
                             page_size: int = None,
@@ -150,7 +167,7 @@ class PublicTextChannel(PublicChannel):
         # if content is card msg, then convert it to plain str
         if isinstance(content, List):
             type = MessageTypes.CARD
-            content = json.dumps(content)
+            content = codec.dumps(content)
         type = type if type is not None else MessageTypes.KMD
 
         # merge params
@@ -160,7 +177,22 @@ class PublicTextChannel(PublicChannel):
         if temp_target_id:
             kwargs['temp_target_id'] = temp_target_id
 
-        return await self.gate.exec_req(api.Message.create(**kwargs))
+        with tracing.span('channel.send', channel_id=self.id, type=type.name):
+            return await self.gate.exec_req(api.Message.create(**kwargs))
+
+    def delete_messages(self, msg_ids: Iterable[str], *, concurrency: int = 4) -> BulkOperation:
+        """delete each of messages ``msg_ids`` in this channel,
+        await it or iterate over it, refer to ``BulkOperation``"""
+        return BulkOperation(lambda msg_id: self.gate.exec_req(api.Message.delete(msg_id=msg_id)),
+                             msg_ids,
+                             concurrency=concurrency)
+
+    def add_reaction_bulk(self, msg_ids: Iterable[str], emoji: str, *, concurrency: int = 4) -> BulkOperation:
+        """add reaction ``emoji`` to each of messages ``msg_ids`` in this channel,
+        await it or iterate over it, refer to ``BulkOperation``"""
+        return BulkOperation(lambda msg_id: self.gate.exec_req(api.Message.addReaction(msg_id=msg_id, emoji=emoji)),
+                             msg_ids,
+                             concurrency=concurrency)
 
 
 class PublicVoiceChannel(PublicChannel):
@@ -4,15 +4,19 @@ import inspect
 import logging
 import time
 from pathlib import Path
-from typing import Dict, List, Callable, Coroutine, Union, IO, Optional
+from typing import AsyncIterator, Dict, List, Callable, Coroutine, Union, IO, Optional, Iterable
 
-from . import api
+from . import api, metrics, tracing
+from .asset import AssetUploader, TypeProgress
+from .bulk import BulkOperation
 from .channel import public_channel_factory, PublicChannel, Channel, PublicTextChannel, PublicVoiceChannel
 from .game import Game
 from .gateway import Gateway, Requestable
 from .guild import Guild, GuildBoost, ChannelCategory
 from .interface import AsyncRunnable
 from .message import RawMessage, Message, Event, PublicMessage, PrivateMessage
+from .pkg_queue import PkgQueue
+from .state import GuildState
 from ._types import SoftwareTypes, MessageTypes, SlowModeTypes, GameTypes
 from .user import User, Friend, FriendRequest
 from .util import unpack_id, unpack_value
@@ -33,13 +37,43 @@ class Client(Requestable, AsyncRunnable):
     """
     _handler_map: Dict[MessageTypes, List[TypeHandler]]
 
-    def __init__(self, gate: Gateway):
+    def __init__(self,
+                 gate: Gateway,
+                 *,
+                 pkg_queue_size: int = 1024,
+                 shard_queue_size: int = 64,
+                 pkg_overflow: PkgQueue.Overflow = PkgQueue.Overflow.BLOCK,
+                 pkg_drop_types: Iterable[MessageTypes] = (),
+                 max_handlers: int = 256,
+                 pkg_consumers: int = 1):
+        """
+        :param gate: the gateway to khl server
+        :param pkg_queue_size: capacity of the pkg_queue between receiver and client, <= 0 means unbounded
+        :param shard_queue_size: capacity of the queue of each consumer when ``pkg_consumers > 1``,
+            <= 0 means unbounded
+        :param pkg_overflow: what to do when the pkg_queue is full, refer to ``PkgQueue.Overflow``
+        :param pkg_drop_types: used with ``PkgQueue.Overflow.DROP_TYPES``, pkgs of these types are droppable
+        :param max_handlers: max count of handlers running at the same time, <= 0 means unlimited
+        :param pkg_consumers: count of concurrent pkg consumers, pkgs are sharded among them by channel id,
+            so pkgs in the same channel are still consumed in order
+        """
         self.gate = gate
+        self.state = GuildState(gate)
+        self.assets = AssetUploader(gate)
         self.ignore_self_msg = True
         self._me = None
+        self._me_id = ''
+        self._me_task: Optional[asyncio.Future] = None
 
         self._handler_map = {}
-        self._pkg_queue = asyncio.Queue()
+        self._pkg_queue = PkgQueue(pkg_queue_size, pkg_overflow, pkg_drop_types)
+        self._pkg_consumers = max(pkg_consumers, 1)
+        self._shard_queue_size = shard_queue_size
+        self._shards: List[asyncio.Queue] = []
+        self._handler_tasks = set()
+        self._handler_sem = asyncio.Semaphore(max_handlers) if max_handlers > 0 else None
+        self._handlers_running = metrics.gauge('client.handlers.running')
+        self._handlers_waiting = metrics.gauge('client.handlers.waiting')
 
     def register(self, type: MessageTypes, handler: TypeHandler):
         """register handler to handle messages of type"""
@@ -55,17 +89,61 @@ class Client(Requestable, AsyncRunnable):
         self._handler_map[type].append(handler)
 
     async def handle_pkg(self):
-        """consume `pkg` from `event_queue`"""
+        """consume `pkg` from `event_queue`
+
+        with multiple consumers, pkgs are routed to per-consumer shards by channel, see ``_shard_key()``,
+        channels are consumed in parallel while pkgs in one channel keep their order"""
+        if self._pkg_consumers == 1:
+            await self._consume_queue(self._pkg_queue)
+            return
+
+        shards = [asyncio.Queue(self._shard_queue_size) for _ in range(self._pkg_consumers)]
+        for i, shard in enumerate(shards):
+            metrics.gauge(f'client.consumer.{i}.depth', shard.qsize)
+        self._shards = shards
+        await asyncio.gather(self._route_pkg(shards), *[self._consume_queue(shard) for shard in shards])
+
+    async def drain(self):
+        """wait until every pkg queued so far is consumed and the handlers spawned for them have finished
+
+        pkgs are done in the pkg_queue once routed to a shard, so the shards are waited for after it"""
+        await self._pkg_queue.join()
+        for shard in self._shards:
+            await shard.join()
+        while self._handler_tasks:
+            await asyncio.wait(list(self._handler_tasks))
+
+    async def _route_pkg(self, shards: List[asyncio.Queue]):
+        """move pkgs from `event_queue` to the shard their channel belongs to"""
         while True:
             pkg: Dict = await self._pkg_queue.get()
+            await shards[hash(self._shard_key(pkg)) % len(shards)].put(pkg)
+            self._pkg_queue.task_done()
+
+    @staticmethod
+    def _shard_key(pkg: Dict) -> str:
+        """the channel of ``pkg``: ``target_id``, or the chat code for private ones, their target is the bot itself"""
+        if pkg.get('channel_type') == 'PERSON':
+            code = (pkg.get('extra') or {}).get('code')
+            if code:
+                return code
+            return pkg.get('author_id', '')
+        return pkg.get('target_id', '')
+
+    async def _consume_queue(self, queue: asyncio.Queue):
+        while True:
+            pkg: Dict = await queue.get()
+            span = tracing.get_tracer().start_span('client.consume_pkg', parent=tracing.detach(pkg))
             log.debug(f'upcoming pkg: {pkg}')
 
-            try:
-                await self._consume_pkg(pkg)
-            except Exception as e:
-                log.exception(e)
+            with span:
+                try:
+                    await self._consume_pkg(pkg)
+                except Exception as e:
+                    span.set_error(e)
+                    log.exception(e)
 
-            self._pkg_queue.task_done()
+            queue.task_done()
 
     async def _consume_pkg(self, pkg: Dict):
         """
@@ -73,11 +151,12 @@ class Client(Requestable, AsyncRunnable):
         check if ignore msgs from self
         pass `msg` to corresponding handlers defined in `_handler_map`
         """
+        self.gate.cache.feed(pkg)
         msg = self._make_msg(pkg)
         if self.ignore_self_msg and msg.type != MessageTypes.SYS:
-            if msg.author.id == (await self.fetch_me()).id:
+            if msg.author_id == (self._me_id or (await self.fetch_me()).id):
                 return
-        self._dispatch_msg(msg)
+        await self._dispatch_msg(msg)
 
     def _make_msg(self, pkg: Dict):
         if pkg.get('type') == MessageTypes.SYS.value:
@@ -97,40 +176,100 @@ class Client(Requestable, AsyncRunnable):
             log.error(f'can not make msg from pkg: {pkg}')
         return msg
 
-    def _dispatch_msg(self, msg):
+    async def _dispatch_msg(self, msg):
         if not msg:
             return
+        if isinstance(msg, Event):  # before handlers: they see the state after the event
+            self.state.apply(msg)
         handlers = self._handler_map.get(msg.type, ())
         for handler in handlers:
-            asyncio.ensure_future(self._handle_safe(handler)(msg), loop=self.loop)
+            await self._spawn_handler(self._handle_safe(handler)(msg))
+
+    async def _spawn_handler(self, coro: Coroutine):
+        """run ``coro`` in background, wait for a free slot first if ``max_handlers`` reached
+
+        waiting here stalls the pkg consumer, thus the pkg_queue fills up and its overflow policy takes over"""
+        if self._handler_sem is None:
+            self._track_handler(asyncio.ensure_future(coro, loop=self.loop))
+            return
+
+        self._handlers_waiting.inc()
+        try:
+            await self._handler_sem.acquire()
+        except asyncio.CancelledError:
+            coro.close()
+            raise
+        finally:
+            self._handlers_waiting.dec()
+        self._handlers_running.inc()
+        self._track_handler(asyncio.ensure_future(coro, loop=self.loop)).add_done_callback(self._on_handler_done)
+
+    def _track_handler(self, task: asyncio.Future) -> asyncio.Future:
+        self._handler_tasks.add(task)
+        task.add_done_callback(self._handler_tasks.discard)
+        return task
+
+    def _on_handler_done(self, _):
+        self._handlers_running.dec()
+        self._handler_sem.release()
 
     @staticmethod
     def _handle_safe(handler: TypeHandler):
 
         async def safe_handler(msg):
-            try:
-                await handler(msg)
-            except Exception as e:
-                log.exception('error raised during message handling', exc_info=e)
+            with tracing.span('client.handle', handler=handler.__qualname__, msg_type=msg.type.name) as span:
+                try:
+                    await handler(msg)
+                except Exception as e:
+                    span.set_error(e)
+                    log.exception('error raised during message handling', exc_info=e)
 
         return safe_handler
 
-    async def create_asset(self, file: Union[IO, str, Path]) -> str:
+    async def create_asset(self,
+                           file: Union[IO, str, Path],
+                           *,
+                           progress: Optional[TypeProgress] = None,
+                           bypass_cache: bool = False) -> str:
         """upload ``file`` to khl, and return the url to the file
 
-        if ``file`` is a str or Path, ``open(file, 'rb')`` will be called to convert it into IO
+        if ``file`` is a str or Path, it's opened in an executor thread; the file is streamed, not loaded in memory.
+        the same content uploaded before is not uploaded again, refer to :class:`AssetUploader`
+
+        :param progress: called with (bytes sent, total bytes) as the upload goes on
+        :param bypass_cache: upload even if the same content has been uploaded
         """
-        if not isinstance(file, (str, Path)):
-            return (await self.gate.exec_req(api.Asset.create(file=file)))['url']
-        with open(file, 'rb') as f:
-            return (await self.gate.exec_req(api.Asset.create(file=f)))['url']
+        return await self.assets.upload(file, progress=progress, bypass_cache=bypass_cache)
+
+    def create_assets(self, files: Iterable[Union[IO, str, Path]], *, concurrency: int = 4) -> BulkOperation:
+        """upload each of ``files``, at most ``concurrency`` at the same time, results are urls
+
+        await it for a ``BulkResult``, or ``async for`` it to get urls as uploads complete"""
+        return self.assets.upload_many(files, concurrency=concurrency)
 
     async def fetch_me(self, force_update: bool = False) -> User:
-        """fetch detail of the ``User`` on the client"""
+        """fetch detail of the ``User`` on the client
+
+        concurrent calls share one in-flight request"""
         if force_update or not self._me or not self._me.is_loaded():
-            self._me = User(_gate_=self.gate, _lazy_loaded_=True, **(await self.gate.exec_req(api.User.me())))
+            if self._me_task is None or self._me_task.done():
+                self._me_task = asyncio.ensure_future(self._load_me(), loop=self.loop)
+            await asyncio.shield(self._me_task)
         return self._me
 
+    async def _load_me(self):
+        self._me = User(_gate_=self.gate, _lazy_loaded_=True, **(await self.gate.exec_req(api.User.me())))
+        self._me_id = self._me.id
+
+    @property
+    def me_id(self) -> str:
+        """
+        id of the ``User`` on the client, resolved once the client starts
+
+        empty str if not resolved yet, no network involved, cheap to call in hot path
+        """
+        return self._me_id
+
     @property
     def me(self) -> User:
         """
@@ -148,23 +287,35 @@ class Client(Requestable, AsyncRunnable):
             return self._me
         raise ValueError('not loaded, please call `await fetch_me()` first')
 
-    async def fetch_user(self, user: Union[User, str]) -> User:
-        """fetch detail of the specific user"""
+    async def fetch_user(self, user: Union[User, str], *, bypass_cache: bool = False) -> User:
+        """fetch detail of the specific user
+
+        :param bypass_cache: always request khl server instead of using the entity cache"""
         user_id = unpack_id(user)
-        return User(_gate_=self.gate, _lazy_loaded_=True, **(await self.gate.exec_req(api.User.view(user_id))))
+        data = await self.gate.cache.fetch(self.gate.cache.users, user_id,
+                                           lambda: self.gate.exec_req(api.User.view(user_id)), bypass_cache)
+        return User(_gate_=self.gate, _lazy_loaded_=True, **data)
 
-    async def fetch_guild(self, guild_id: str) -> Guild:
-        """fetch details of a guild from khl"""
-        guild = Guild(_gate_=self.gate, id=guild_id)
-        await guild.load()
-        return guild
+    async def fetch_guild(self, guild_id: str, *, bypass_cache: bool = False) -> Guild:
+        """fetch details of a guild from khl
+
+        :param bypass_cache: always request khl server instead of using the entity cache"""
+        data = await self.gate.cache.fetch(self.gate.cache.guilds, guild_id,
+                                           lambda: self.gate.exec_req(api.Guild.view(guild_id)), bypass_cache)
+        return Guild(_gate_=self.gate, _lazy_loaded_=True, **data)
 
     async def fetch_guild_list(self, **kwargs) -> List[Guild]:
         """list guilds which the client joined
 
         paged req, support standard pagination args"""
-        guilds_data = (await self.gate.exec_paged_req(api.Guild.list(), **kwargs))
-        return [Guild(_gate_=self.gate, _lazy_loaded_=True, **i) for i in guilds_data]
+        return [g async for g in self.iter_guilds(**kwargs)]
+
+    async def iter_guilds(self, **kwargs) -> AsyncIterator[Guild]:
+        """iterate over guilds which the client joined, pages are fetched ahead while the caller consumes
+
+        paged req, support standard pagination args"""
+        async for i in self.gate.iter_paged_req(api.Guild.list(), **kwargs):
+            yield Guild(_gate_=self.gate, _lazy_loaded_=True, **i)
 
     async def leave(self, guild: Union[Guild, str]):
         """leave from ``guild``"""
@@ -176,14 +327,22 @@ class Client(Requestable, AsyncRunnable):
         guild = Guild(_gate_=self.gate, id=guild) if isinstance(guild, str) else guild
         return await guild.kickout(user)
 
-    async def fetch_public_channel(self, channel_id: str) -> PublicChannel:
-        """fetch details of a public channel from khl"""
-        channel_data = await self.gate.exec_req(api.Channel.view(channel_id))
+    async def fetch_public_channel(self, channel_id: str, *, bypass_cache: bool = False) -> PublicChannel:
+        """fetch details of a public channel from khl
+
+        :param bypass_cache: always request khl server instead of using the entity cache"""
+        channel_data = await self.gate.cache.fetch(self.gate.cache.channels, channel_id,
+                                                   lambda: self.gate.exec_req(api.Channel.view(channel_id)),
+                                                   bypass_cache)
         return public_channel_factory(_gate_=self.gate, **channel_data)
 
-    async def fetch_channel_category(self, category_id: str) -> ChannelCategory:
-        """fetch details of a channel category from khl"""
-        category_data = await self.gate.exec_req(api.Channel.view(category_id))
+    async def fetch_channel_category(self, category_id: str, *, bypass_cache: bool = False) -> ChannelCategory:
+        """fetch details of a channel category from khl
+
+        :param bypass_cache: always request khl server instead of using the entity cache"""
+        category_data = await self.gate.cache.fetch(self.gate.cache.channels, category_id,
+                                                    lambda: self.gate.exec_req(api.Channel.view(category_id)),
+                                                    bypass_cache)
         return ChannelCategory(_gate_=self.gate, **category_data)
 
     async def create_text_channel(self,
@@ -271,8 +430,14 @@ class Client(Requestable, AsyncRunnable):
         """list the games already registered at khl server
 
         paged req, support standard pagination args"""
-        games = await self.gate.exec_paged_req(api.game(type=unpack_value(type)), **kwargs)
-        return [Game(**game_data) for game_data in games]
+        return [g async for g in self.iter_games(type, **kwargs)]
+
+    async def iter_games(self, type: Union[GameTypes, str] = GameTypes.ALL, **kwargs) -> AsyncIterator[Game]:
+        """iterate over the games already registered at khl server, pages are fetched ahead while the caller consumes
+
+        paged req, support standard pagination args"""
+        async for game_data in self.gate.iter_paged_req(api.game(type=unpack_value(type)), **kwargs):
+            yield Game(**game_data)
 
     async def register_game(self, name, process_name: Optional[str] = None, icon: Optional[str] = None) -> Game:
         """register a new game at khl server, can be used in profile status"""
@@ -333,7 +498,7 @@ class Client(Requestable, AsyncRunnable):
     async def fetch_guild_boost(self,
                                 guild: Union[str, Guild],
                                 start_time: int = 0,
-                                end_time: int = int(time.time()),
+                                end_time: int = None,
                                 **kwargs):
         """
         list the boost in guild.
@@ -342,9 +507,24 @@ class Client(Requestable, AsyncRunnable):
         :param start_time: start_time time stamp (Sec).
         :param end_time: end_time time stamp (Sec). Default to now time.
         """
-        boost_list = await self.gate.exec_paged_req(
-            api.GuildBoost.history(guild_id=unpack_id(guild), start_time=start_time, end_time=end_time), **kwargs)
-        return [GuildBoost(**item, _gate_=self.gate) for item in boost_list]
+        return [b async for b in self.iter_guild_boost(guild, start_time, end_time, **kwargs)]
+
+    async def iter_guild_boost(self,
+                               guild: Union[str, Guild],
+                               start_time: int = 0,
+                               end_time: int = None,
+                               **kwargs) -> AsyncIterator[GuildBoost]:
+        """
+        iterate over the boost in guild, pages are fetched ahead while the caller consumes
+
+        :param guild: guild_id or Guild object.
+        :param start_time: start_time time stamp (Sec).
+        :param end_time: end_time time stamp (Sec). Default to now time.
+        """
+        end_time = int(time.time()) if end_time is None else end_time
+        async for item in self.gate.iter_paged_req(
+                api.GuildBoost.history(guild_id=unpack_id(guild), start_time=start_time, end_time=end_time), **kwargs):
+            yield GuildBoost(**item, _gate_=self.gate)
 
     async def fetch_friends(self) -> List[Friend]:
         """list friends who have been added to friend list"""
@@ -366,4 +546,8 @@ class Client(Requestable, AsyncRunnable):
         await self.gate.exec_req(api.User.offline())
 
     async def start(self):
+        try:
+            await self.fetch_me()
+        except Exception as e:  # not fatal: fetch_me() will be retried on the first msg
+            log.exception('error raised during fetching self identity', exc_info=e)
         await asyncio.gather(self.handle_pkg(), self.gate.run(self._pkg_queue))
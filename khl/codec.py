@@ -0,0 +1,90 @@
+"""JSON codec used across khl.py: orjson or ujson if installed, stdlib json as the fallback"""
+import json
+import logging
+from typing import Any, Callable, Dict, Union
+
+log = logging.getLogger(__name__)
+
+
+def _orjson_codec():
+    import orjson  # pylint: disable=import-outside-toplevel
+
+    def dumps(obj, indent: bool = False) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode()
+
+    return orjson.loads, dumps
+
+
+def _ujson_codec():
+    import ujson  # pylint: disable=import-outside-toplevel
+
+    def dumps(obj, indent: bool = False) -> str:
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, indent=2 if indent else 0)
+
+    return ujson.loads, dumps
+
+
+def _json_codec():
+
+    def dumps(obj, indent: bool = False) -> str:
+        if indent:
+            return json.dumps(obj, ensure_ascii=False, indent=2)
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+    return json.loads, dumps
+
+
+_BACKENDS: Dict[str, Callable] = {'orjson': _orjson_codec, 'ujson': _ujson_codec, 'json': _json_codec}
+
+_backend = ''
+_loads: Callable = json.loads
+_dumps: Callable = json.dumps
+
+
+def use(name: str):
+    """
+    switch the backend, one of ``'orjson'``, ``'ujson'``, ``'json'``
+
+    :raise ImportError: the backend is not installed
+    """
+    global _backend, _loads, _dumps  # pylint: disable=global-statement
+    if name not in _BACKENDS:
+        raise ValueError(f'unknown json backend: {name}, available: {", ".join(_BACKENDS)}')
+    _loads, _dumps = _BACKENDS[name]()
+    _backend = name
+    log.debug(f'json backend: {name}')
+
+
+def backend() -> str:
+    """name of the backend in use"""
+    return _backend
+
+
+def loads(data: Union[bytes, bytearray, str]) -> Any:
+    """
+    parse JSON, bytes are accepted directly: no need to decode into str first
+
+    :raise ValueError: malformed JSON, whichever the backend is
+    """
+    return _loads(data)
+
+
+def dumps(obj: Any, *, indent: bool = False) -> str:
+    """
+    serialize ``obj`` to a JSON str, non-ASCII chars are kept as is
+
+    list subclasses(e.g. ``CardMessage``) are serialized via their ``__iter__``, as stdlib json does
+
+    :param indent: pretty print with 2-space indentation
+    """
+    if isinstance(obj, list) and type(obj) is not list:  # pylint: disable=unidiomatic-typecheck
+        obj = list(obj)
+    return _dumps(obj, indent)
+
+
+for _name in _BACKENDS:  # pick the fastest available one
+    try:
+        use(_name)
+        break
+    except ImportError:
+        continue
@@ -1,9 +1,10 @@
 """gateway related stuff"""
 import asyncio
 from abc import ABC
-from typing import Union, List
+from typing import AsyncIterator, Dict, Optional, Union, List
 
 from .api import _Req
+from .cache import EntityCache
 from .receiver import Receiver
 from .requester import HTTPRequester
 
@@ -16,10 +17,18 @@ class Gateway:
     """
     requester: HTTPRequester
     receiver: Receiver
+    cache: EntityCache
 
-    def __init__(self, requester: HTTPRequester, receiver: Receiver):
+    def __init__(self, requester: HTTPRequester, receiver: Receiver, cache: Optional[EntityCache] = None):
+        """
+        :param cache: entities cache shared by all objects using this gateway, a default one if not given,
+            pass ``EntityCache(max_size=0)`` to disable it
+        """
         self.requester = requester
         self.receiver = receiver
+        if receiver is not None and receiver.session is None:  # one connection pool for REST and gateway
+            receiver.session = requester.session
+        self.cache = cache if cache is not None else EntityCache()
 
     async def request(self, method: str, route: str, **params) -> Union[dict, list]:
         """execute raw request, this is just a wrapper for convenience"""
@@ -33,6 +42,10 @@ class Gateway:
         """execute paged request, this is just a wrapper for convenience"""
         return await self.requester.exec_paged_req(r, **kwargs)
 
+    def iter_paged_req(self, r: _Req, **kwargs) -> AsyncIterator[Dict]:
+        """iterate over items of paged request, this is just a wrapper for convenience"""
+        return self.requester.iter_paged_req(r, **kwargs)
+
     async def run(self, in_queue: asyncio.Queue):
         """run the receiver"""
         self.receiver.pkg_queue = in_queue
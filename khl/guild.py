@@ -2,9 +2,10 @@
 import logging
 import time
 import warnings
-from typing import List, Union, Dict, IO
+from typing import AsyncIterator, Iterable, List, Optional, Union, Dict, IO
 
 from . import api
+from .bulk import BulkOperation
 from ._types import ChannelTypes, GuildMuteTypes, BadgeTypes
 from .channel import Channel, public_channel_factory, PublicChannel, PublicVoiceChannel, PublicTextChannel
 from .gateway import Requestable
@@ -80,7 +81,7 @@ class ChannelCategory(PermissionHolder, Requestable):
         self.guild_id = kwargs.get('_guild_id_')
         self.level = kwargs.get('level')
         self.limit_amount = kwargs.get('limit_amount')
-        self._channels = kwargs.get('channels', [])
+        self._channels = list(kwargs.get('channels') or [])  # own copy: kwargs may be a shared response
         self.permission: ChannelPermission = ChannelPermission(**kwargs)
 
     @property
@@ -109,6 +110,7 @@ class ChannelCategory(PermissionHolder, Requestable):
         docs: https://developer.kaiheila.cn/doc/http/channel#%E5%88%9B%E5%BB%BA%E9%A2%91%E9%81%93"""
         params = {'name': name, 'guild_id': self.guild_id, 'parent_id': self.id, 'type': ChannelTypes.TEXT.value}
         pc = public_channel_factory(self.gate, **(await self.gate.exec_req(api.Channel.create(**params))))
+        self.gate.cache.forget_channel(self.guild_id)
         self._channels.append(pc)
         return pc
 
@@ -125,6 +127,7 @@ class ChannelCategory(PermissionHolder, Requestable):
         if voice_quality:
             params['voice_quality'] = voice_quality
         pc = public_channel_factory(self.gate, **(await self.gate.exec_req(api.Channel.create(**params))))
+        self.gate.cache.forget_channel(self.guild_id)
         self._channels.append(pc)
         return pc
 
@@ -133,7 +136,9 @@ class ChannelCategory(PermissionHolder, Requestable):
         channel_id = channel.id if isinstance(channel, Channel) else channel
         if channel_id not in [i.id for i in self._channels]:
             raise ValueError(f'channel {channel_id} is not belongs to this category')
-        return await self.gate.exec_req(api.Channel.delete(channel_id))
+        rt = await self.gate.exec_req(api.Channel.delete(channel_id))
+        self.gate.cache.forget_channel(self.guild_id, channel_id)
+        return rt
 
     def __iter__(self):
         return iter(self._channels)
@@ -178,22 +183,95 @@ class Guild(LazyLoadable, Requestable):
         self.open_id = kwargs.get('open_id', '')
         self.default_channel_id = kwargs.get('default_channel_id', '')
         self.welcome_channel_id = kwargs.get('welcome_channel_id', '')
-        self._roles = kwargs.get('roles', None)
-        self._channels = kwargs.get('channels', None)
+        # own copies: kwargs may be a shared response, and the lists are patched by events
+        self._roles = _copy(kwargs.get('roles', None))
+        self._channels = _copy(kwargs.get('channels', None))
+
+    _PATCHABLE_FIELDS = ('name', 'topic', 'master_id', 'icon', 'notify_type', 'region', 'enable_open', 'open_id',
+                         'default_channel_id', 'welcome_channel_id')
+
+    def _patch_fields(self, **kwargs):
+        """update fields present in ``kwargs`` only, roles and channels are kept, used with partial data in events"""
+        for k in self._PATCHABLE_FIELDS:
+            if k in kwargs:
+                setattr(self, k, kwargs[k])
+
+    def _put_channel(self, data: Dict):
+        """add or update a channel/category in the fetched channel list, channels already there are updated in place"""
+        if self._channels is None:
+            return
+        cid = data['id']
+        if data.get('is_category'):
+            cc = ChannelCategory(_gate_=self.gate, _guild_id_=self.id, **data)
+            for c in self._channel_categories.get(cid, ()):
+                cc.append(c)
+            self._channel_categories[cid] = cc
+            return
+        channel = self._detach_channel(cid)
+        if channel is None:
+            channel = public_channel_factory(_gate_=self.gate, **data)
+        else:
+            channel._update_fields(**data)  # pylint: disable=protected-access
+        if channel.parent_id in self._channel_categories:
+            self._channel_categories[channel.parent_id].append(channel)
+        else:
+            self._channels.append(channel)
+
+    def _remove_channel(self, channel_id: str):
+        """remove a channel/category from the fetched channel list, channels in a removed category go top-level"""
+        if self._channels is None:
+            return
+        cc = self._channel_categories.pop(channel_id, None)
+        if cc is not None:
+            self._channels.extend(cc)
+        else:
+            self._detach_channel(channel_id)
+
+    def _detach_channel(self, channel_id: str) -> Union[PublicChannel, None]:
+        for i, c in enumerate(self._channels):
+            if c.id == channel_id:
+                return self._channels.pop(i)
+        for cc in self._channel_categories.values():
+            for i, c in enumerate(cc):
+                if c.id == channel_id:
+                    return cc.pop(i)
+        return None
+
+    def _put_role(self, data: Dict):
+        """add or update a role in the fetched role list"""
+        if self._roles is None:
+            return
+        self._remove_role(data.get('role_id'))
+        self._roles.append(Role(**data))
+        self._roles.sort(key=lambda r: r.position)
+
+    def _remove_role(self, role_id: int):
+        """remove a role from the fetched role list"""
+        if self._roles is not None:
+            self._roles = [r for r in self._roles if r.id != role_id]
 
     async def load(self):
         self._update_fields(**(await self.gate.exec_req(api.Guild.view(self.id))))
         self._loaded = True
 
-    async def fetch_channel_category_list(self, force_update: bool = True) -> List[ChannelCategory]:
-        """fetch all channel category as a list"""
-        await self.fetch_channel_list(force_update)
+    async def fetch_channel_category_list(self,
+                                          force_update: bool = True,
+                                          *,
+                                          bypass_cache: bool = False) -> List[ChannelCategory]:
+        """fetch all channel category as a list, see :func:`fetch_channel_list()` for params"""
+        await self.fetch_channel_list(force_update, bypass_cache=bypass_cache)
         return list(self._channel_categories.values())
 
-    async def fetch_channel_list(self, force_update: bool = True) -> List[PublicChannel]:
-        """fetch channel list from khl server"""
+    async def fetch_channel_list(self, force_update: bool = True, *, bypass_cache: bool = False) -> List[PublicChannel]:
+        """fetch channel list from khl server
+
+        :param force_update: rebuild the list from the entity cache(``gate.cache``) instead of using the one already
+            on this object, the cache is kept fresh by events and writes through this library
+        :param bypass_cache: reload from khl server instead of the entity cache"""
         if force_update or self._channels is None:
-            raw_list = await self.gate.exec_paged_req(api.Channel.list(guild_id=self.id))
+            raw_list = await self.gate.cache.fetch(self.gate.cache.channel_lists, self.id,
+                                                   lambda: self.gate.exec_paged_req(api.Channel.list(guild_id=self.id)),
+                                                   bypass_cache)
             channels: List[PublicChannel] = []
             channel_categories: Dict[str, ChannelCategory] = {}
             for i in raw_list:
@@ -249,13 +327,20 @@ class Guild(LazyLoadable, Requestable):
     async def fetch_user_list(self, channel: Union[Channel, str] = None, **kwargs) -> List[User]:
         """list users in the guild/a channel belongs to the guild
 
+        paged req, support standard pagination args"""
+        return [u async for u in self.iter_users(channel, **kwargs)]
+
+    async def iter_users(self, channel: Union[Channel, str] = None, **kwargs) -> AsyncIterator[User]:
+        """iterate over users in the guild/a channel belongs to the guild,
+        pages are fetched ahead while the caller consumes, memory use stays the same whatever the guild size
+
         paged req, support standard pagination args"""
         cid = channel.id if isinstance(channel, Channel) else channel
         params = {'guild_id': self.id}
         if cid is not None:
             params['channel_id'] = cid
-        users = await self.gate.exec_paged_req(api.Guild.userList(**params), **kwargs)
-        return [User(_gate_=self.gate, _lazy_loaded_=True, **i) for i in users]
+        async for i in self.gate.iter_paged_req(api.Guild.userList(**params), **kwargs):
+            yield User(_gate_=self.gate, _lazy_loaded_=True, **i)
 
     async def fetch_joined_channel(self,
                                    user: Union[User, str],
@@ -266,52 +351,93 @@ class Guild(LazyLoadable, Requestable):
             api.ChannelUser.getJoinedChannel(page=page, page_size=page_size, guild_id=self.id, user_id=unpack_id(user)))
         return [PublicVoiceChannel(_gate_=self.gate, _lazy_loaded_=True, **i) for i in channels]
 
-    async def fetch_user(self, user_id: str) -> GuildUser:
+    async def fetch_user(self, user_id: str, *, bypass_cache: bool = False) -> GuildUser:
         """get user object from user_id, can only fetch user in current guild
+
+        :param bypass_cache: always request khl server instead of using the entity cache
         """
-        user = await self.gate.exec_req(api.User.view(user_id=user_id, guild_id=self.id))
+        user = await self.gate.cache.fetch(self.gate.cache.guild_users, (self.id, user_id),
+                                           lambda: self.gate.exec_req(api.User.view(user_id=user_id, guild_id=self.id)),
+                                           bypass_cache)
         return GuildUser(guild_id=self.id, _gate_=self.gate, _lazy_loaded_=True, **user)
 
     async def set_user_nickname(self, user: Union[User, str], nickname: str):
         """set the user's nickname in this guild"""
         await self.gate.exec_req(api.Guild.nickname(guild_id=self.id, nickname=nickname, user_id=unpack_id(user)))
+        self.gate.cache.forget_guild_user(self.id, unpack_id(user))
+
+    async def fetch_roles(self, force_update: bool = True, *, bypass_cache: bool = False) -> List[Role]:
+        """fetch the role list in the guild
 
-    async def fetch_roles(self, force_update: bool = True) -> List[Role]:
-        """fetch the role list in the guild"""
+        :param force_update: rebuild the list from the entity cache(``gate.cache``) instead of using the one already
+            on this object, the cache is kept fresh by events and writes through this library
+        :param bypass_cache: reload from khl server instead of the entity cache"""
         if force_update or self._roles is None:
-            raw_list = await self.gate.exec_paged_req(api.GuildRole.list(guild_id=self.id))
+            raw_list = await self.gate.cache.fetch(
+                self.gate.cache.roles, self.id, lambda: self.gate.exec_paged_req(api.GuildRole.list(guild_id=self.id)),
+                bypass_cache)
             self._roles = [Role(**i) for i in raw_list]
         return self._roles
 
     async def create_role(self, role_name: str) -> Role:
         """create a role in the guild"""
-        return Role(**(await self.gate.exec_req(api.GuildRole.create(guild_id=self.id, name=role_name))))
+        role = Role(**(await self.gate.exec_req(api.GuildRole.create(guild_id=self.id, name=role_name))))
+        self.gate.cache.forget_roles(self.id)
+        return role
 
     async def update_role(self, new_role: Role) -> Role:
         """update a role in the guild
 
         :param new_role an edited role object"""
-        return Role(**(await self.gate.exec_req(api.GuildRole.update(guild_id=self.id, **vars(new_role)))))
+        role = Role(**(await self.gate.exec_req(api.GuildRole.update(guild_id=self.id, **vars(new_role)))))
+        self.gate.cache.forget_roles(self.id)
+        return role
 
     async def delete_role(self, role: Union[int, Role]):
         """delete a role from the guild"""
-        return await self.gate.exec_req(api.GuildRole.delete(guild_id=self.id, role_id=unpack_id(role)))
+        rt = await self.gate.exec_req(api.GuildRole.delete(guild_id=self.id, role_id=unpack_id(role)))
+        self.gate.cache.forget_roles(self.id)
+        return rt
 
     async def grant_role(self, user: Union[User, str], role: Union[Role, int]):
         """
         docs:
         https://developer.kaiheila.cn/doc/http/guild-role#%E8%B5%8B%E4%BA%88%E7%94%A8%E6%88%B7%E8%A7%92%E8%89%B2
         """
-        return await self.gate.exec_req(
+        rt = await self.gate.exec_req(
             api.GuildRole.grant(guild_id=self.id, user_id=unpack_id(user), role_id=unpack_id(role)))
+        self.gate.cache.forget_guild_user(self.id, unpack_id(user))
+        return rt
 
     async def revoke_role(self, user: Union[User, str], role: Union[Role, int]):
         """
         docs:
         https://developer.kaiheila.cn/doc/http/guild-role#%E5%88%A0%E9%99%A4%E7%94%A8%E6%88%B7%E8%A7%92%E8%89%B2
         """
-        return await self.gate.exec_req(
+        rt = await self.gate.exec_req(
             api.GuildRole.revoke(guild_id=self.id, user_id=unpack_id(user), role_id=unpack_id(role)))
+        self.gate.cache.forget_guild_user(self.id, unpack_id(user))
+        return rt
+
+    def grant_role_bulk(self,
+                        role: Union[Role, int],
+                        users: Iterable[Union[User, str]],
+                        *,
+                        concurrency: int = 4) -> BulkOperation:
+        """grant ``role`` to each of ``users``, await it or iterate over it, refer to ``BulkOperation``"""
+        return BulkOperation(lambda user: self.grant_role(user, role), users, concurrency=concurrency)
+
+    def revoke_role_bulk(self,
+                         role: Union[Role, int],
+                         users: Iterable[Union[User, str]],
+                         *,
+                         concurrency: int = 4) -> BulkOperation:
+        """revoke ``role`` from each of ``users``, await it or iterate over it, refer to ``BulkOperation``"""
+        return BulkOperation(lambda user: self.revoke_role(user, role), users, concurrency=concurrency)
+
+    def kickout_bulk(self, users: Iterable[Union[User, str]], *, concurrency: int = 4) -> BulkOperation:
+        """kick each of ``users`` from the guild, await it or iterate over it, refer to ``BulkOperation``"""
+        return BulkOperation(self.kickout, users, concurrency=concurrency)
 
     async def create_text_channel(self, name: str, category: Union[str, ChannelCategory] = None) -> PublicTextChannel:
         """create a text channel in the guild
@@ -320,7 +446,9 @@ class Guild(LazyLoadable, Requestable):
         params = {'name': name, 'guild_id': self.id, 'type': ChannelTypes.TEXT.value}
         if category:
             params['parent_id'] = unpack_id(category)
-        return public_channel_factory(self.gate, **(await self.gate.exec_req(api.Channel.create(**params))))
+        channel = public_channel_factory(self.gate, **(await self.gate.exec_req(api.Channel.create(**params))))
+        self.gate.cache.forget_channel(self.id)
+        return channel
 
     async def create_voice_channel(self,
                                    name: str,
@@ -337,22 +465,30 @@ class Guild(LazyLoadable, Requestable):
             params['limit_amount'] = limit_amount
         if voice_quality:
             params['voice_quality'] = voice_quality
-        return public_channel_factory(self.gate, **(await self.gate.exec_req(api.Channel.create(**params))))
+        channel = public_channel_factory(self.gate, **(await self.gate.exec_req(api.Channel.create(**params))))
+        self.gate.cache.forget_channel(self.id)
+        return channel
 
     async def create_channel_category(self, name: str) -> ChannelCategory:
         """create a channel category in the guild
 
         docs: https://developer.kaiheila.cn/doc/http/channel#%E5%88%9B%E5%BB%BA%E9%A2%91%E9%81%93"""
         params = {'guild_id': self.id, 'name': name, 'is_category': 1}
-        return ChannelCategory(_gate_=self.gate, **(await self.gate.exec_req(api.Channel.create(**params))))
+        category = ChannelCategory(_gate_=self.gate, **(await self.gate.exec_req(api.Channel.create(**params))))
+        self.gate.cache.forget_channel(self.id)
+        return category
 
     async def delete_channel(self, channel: Union[Channel, str]):
         """delete the channel from the guild"""
-        return await self.gate.exec_req(api.Channel.delete(unpack_id(channel)))
+        rt = await self.gate.exec_req(api.Channel.delete(unpack_id(channel)))
+        self.gate.cache.forget_channel(self.id, unpack_id(channel))
+        return rt
 
     async def kickout(self, user: Union[User, str]):
         """kick the user from the guild"""
-        return await self.gate.exec_req(api.Guild.kickout(guild_id=self.id, target_id=unpack_id(user)))
+        rt = await self.gate.exec_req(api.Guild.kickout(guild_id=self.id, target_id=unpack_id(user)))
+        self.gate.cache.forget_guild_user(self.id, unpack_id(user))
+        return rt
 
     async def leave(self):
         """leave from this guild"""
@@ -414,17 +550,34 @@ class Guild(LazyLoadable, Requestable):
         """delete a custom emoji"""
         return await self.gate.exec_req(api.GuildEmoji.delete(unpack_id(emoji)))
 
-    async def fetch_boost(self, start_time: int = 0, end_time: int = int(time.time()), **kwargs) -> List[GuildBoost]:
+    async def fetch_boost(self, start_time: int = 0, end_time: int = None, **kwargs) -> List[GuildBoost]:
         """
         list the boost in guild.
 
         :param start_time: start_time time stamp (Sec).
         :param end_time: end_time time stamp (Sec). Default to now time.
         """
-        boost_list = await self.gate.exec_paged_req(
-            api.GuildBoost.history(guild_id=self.id, start_time=start_time, end_time=end_time), **kwargs)
-        return [GuildBoost(**item, _gate_=self.gate) for item in boost_list]
+        return [b async for b in self.iter_boost(start_time, end_time, **kwargs)]
+
+    async def iter_boost(self,
+                         start_time: int = 0,
+                         end_time: int = None,
+                         **kwargs) -> AsyncIterator[GuildBoost]:
+        """
+        iterate over the boost in guild, pages are fetched ahead while the caller consumes
+
+        :param start_time: start_time time stamp (Sec).
+        :param end_time: end_time time stamp (Sec). Default to now time.
+        """
+        end_time = int(time.time()) if end_time is None else end_time
+        async for item in self.gate.iter_paged_req(
+                api.GuildBoost.history(guild_id=self.id, start_time=start_time, end_time=end_time), **kwargs):
+            yield GuildBoost(**item, _gate_=self.gate)
 
     async def fetch_badge(self, style: Union[int, BadgeTypes] = BadgeTypes.NAME) -> bytes:
         """get the badge of the guild"""
         return await self.gate.exec_req(api.Badge.guild(guild_id=self.id, style=unpack_value(style)))
+
+
+def _copy(items: Optional[List]) -> Optional[List]:
+    return list(items) if items is not None else None
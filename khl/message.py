@@ -1,9 +1,7 @@
 from abc import ABC, abstractmethod
 from typing import Any, List, Dict, Union, Optional
 
-import json
-
-from . import api
+from . import api, codec
 from .channel import PublicTextChannel, PrivateChannel
 from .context import Context
 from .gateway import Requestable
@@ -276,7 +274,7 @@ class PublicMessage(Message):
 
     async def update(self, content: Union[str, List], quote: str = None, temp_target_id: str = None):
         if isinstance(content, List):
-            content = json.dumps(content)
+            content = codec.dumps(content)
         params = {'msg_id': self.id, 'content': content}
         if quote is not None:
             params['quote'] = quote
@@ -341,7 +339,7 @@ class PrivateMessage(Message):
 
     async def update(self, content: Union[str, List], quote: str = None, _: str = None):
         if isinstance(content, List):
-            content = json.dumps(content)
+            content = codec.dumps(content)
         params = {'msg_id': self.id, 'content': content}
         if quote is not None:
             params['quote'] = quote
@@ -0,0 +1,169 @@
+"""in-process metrics: counters, gauges and histograms, read out with ``snapshot()``"""
+import bisect
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    """monotonically increasing value"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._value = 0
+
+    def inc(self, n: Union[int, float] = 1):
+        """add ``n`` to the counter"""
+        self._value += n
+
+    @property
+    def value(self) -> Union[int, float]:
+        """current value"""
+        return self._value
+
+    def _snapshot(self):
+        return self._value
+
+
+class Gauge:
+    """
+    value that goes up and down
+
+    :param fn: if set, the value is read from ``fn()`` on every access, e.g. the size of a queue
+    """
+
+    def __init__(self, name: str, fn: Optional[Callable[[], Union[int, float]]] = None):
+        self.name = name
+        self._value = 0
+        self._fn = fn
+
+    def set(self, v: Union[int, float]):
+        """set the gauge to ``v``"""
+        self._value = v
+
+    def inc(self, n: Union[int, float] = 1):
+        """add ``n`` to the gauge"""
+        self._value += n
+
+    def dec(self, n: Union[int, float] = 1):
+        """subtract ``n`` from the gauge"""
+        self._value -= n
+
+    @property
+    def value(self) -> Union[int, float]:
+        """current value"""
+        return self._fn() if self._fn is not None else self._value
+
+    def _snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """distribution of observed values, bucketed by upper bounds"""
+
+    def __init__(self, name: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # the last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, v: float):
+        """record a value"""
+        self._counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q: float) -> float:
+        """estimate the ``q`` quantile(0.0 ~ 1.0) as the upper bound of the bucket it falls in"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self._counts):
+            seen += c
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def _snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self._counts))
+        }
+
+
+class Registry:
+    """holds metrics by name, ``counter()``/``gauge()``/``histogram()`` get-or-create"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Union[Counter, Gauge, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args):
+        m = self._metrics.get(name)
+        if m is None:
+            with self._lock:
+                m = self._metrics.setdefault(name, cls(name, *args))
+        if not isinstance(m, cls):
+            raise TypeError(f'metric {name} is already registered as {type(m).__name__}')
+        return m
+
+    def counter(self, name: str) -> Counter:
+        """get or create the counter ``name``"""
+        return self._get_or_create(Counter, name)
+
+    def gauge(self, name: str, fn: Optional[Callable[[], Union[int, float]]] = None) -> Gauge:
+        """get or create the gauge ``name``, ``fn`` replaces the value source if given"""
+        g = self._get_or_create(Gauge, name)
+        if fn is not None:
+            g._fn = fn  # pylint: disable=protected-access
+        return g
+
+    def histogram(self, name: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        """get or create the histogram ``name``"""
+        return self._get_or_create(Histogram, name, buckets)
+
+    def names(self) -> List[str]:
+        """all registered metric names"""
+        return list(self._metrics)
+
+    def snapshot(self, prefix: str = '') -> Dict:
+        """current values of all metrics whose name starts with ``prefix``"""
+        return {k: m._snapshot() for k, m in list(self._metrics.items()) if k.startswith(prefix)}  # pylint: disable=protected-access
+
+
+_registry = Registry()
+
+
+def get_registry() -> Registry:
+    """the process-wide registry used by khl.py internals"""
+    return _registry
+
+
+def counter(name: str) -> Counter:
+    """get or create the counter ``name`` in the process-wide registry"""
+    return _registry.counter(name)
+
+
+def gauge(name: str, fn: Optional[Callable[[], Union[int, float]]] = None) -> Gauge:
+    """get or create the gauge ``name`` in the process-wide registry"""
+    return _registry.gauge(name, fn)
+
+
+def histogram(name: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """get or create the histogram ``name`` in the process-wide registry"""
+    return _registry.histogram(name, buckets)
+
+
+def snapshot(prefix: str = '') -> Dict:
+    """current values of metrics in the process-wide registry"""
+    return _registry.snapshot(prefix)
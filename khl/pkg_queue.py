@@ -0,0 +1,59 @@
+"""bounded queue carrying pkgs from Receiver to Client"""
+import asyncio
+import logging
+from enum import Enum
+from typing import Dict, Iterable, Union
+
+from . import metrics
+from ._types import MessageTypes
+from .util import unpack_value
+
+log = logging.getLogger(__name__)
+
+
+class PkgQueue(asyncio.Queue):
+    """
+    the pkg_queue with an explicit policy on overflow
+
+    ``maxsize <= 0`` means unbounded, then the policy never kicks in
+    """
+
+    class Overflow(Enum):
+        """what to do when a pkg comes while the queue is full"""
+        BLOCK = 'block'
+        """the receiver waits until there is space, backpressure propagates to the network"""
+        DROP_OLDEST = 'drop_oldest'
+        """evict the oldest queued pkg to make room"""
+        DROP_TYPES = 'drop_types'
+        """drop the incoming pkg if its type is in ``drop_types``, otherwise block"""
+
+    def __init__(self,
+                 maxsize: int = 0,
+                 overflow: Overflow = Overflow.BLOCK,
+                 drop_types: Iterable[Union[MessageTypes, int]] = ()):
+        super().__init__(maxsize)
+        self.overflow = PkgQueue.Overflow(overflow)
+        self.drop_types = {unpack_value(t) for t in drop_types}
+
+        self._dropped = metrics.counter('pkg_queue.dropped')
+        self._blocked = metrics.counter('pkg_queue.blocked')
+        metrics.gauge('pkg_queue.depth', self.qsize)
+        metrics.gauge('pkg_queue.capacity', lambda: self.maxsize)
+
+    async def put(self, item: Dict):
+        if self.full():
+            if self.overflow == PkgQueue.Overflow.DROP_OLDEST:
+                dropped = self.get_nowait()
+                self.task_done()
+                self.record_drop(dropped)
+            elif self.overflow == PkgQueue.Overflow.DROP_TYPES and item.get('type') in self.drop_types:
+                self.record_drop(item)
+                return
+            else:
+                self._blocked.inc()
+        await super().put(item)
+
+    def record_drop(self, pkg: Dict):
+        """count ``pkg`` as dropped on overflow, also used by receivers applying the policy before the queue"""
+        self._dropped.inc()
+        log.debug(f'pkg_queue full, dropped pkg: type: {pkg.get("type")}, msg_id: {pkg.get("msg_id")}')
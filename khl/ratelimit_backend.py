@@ -0,0 +1,348 @@
+"""where RateLimiter keeps its state: in memory, in a mmap file shared by local processes, or in redis"""
+import asyncio
+import contextlib
+import hashlib
+import itertools
+import logging
+import math
+import mmap
+import os
+import struct
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+TypeBucketState = Tuple[int, float, float, int, float]  # remaining, reset_at, next_at, limit, window
+
+
+def _roll(state: TypeBucketState, now: float) -> Optional[TypeBucketState]:
+    """move the state on to the window ``now`` is in, each passed window refills ``limit`` tokens"""
+    remaining, reset_at, next_at, limit, window = state
+    if reset_at > now:
+        return state
+    if window <= 0:  # never knew the window length, budget unknown until the next response
+        return None
+    passed = math.floor((now - reset_at) / window) + 1
+    return min(remaining + passed * limit, limit), reset_at + passed * window, next_at, limit, window
+
+
+def _reserve(state: Optional[TypeBucketState], start: int,
+             now: float) -> Tuple[Optional[TypeBucketState], Optional[float]]:
+    """
+    take a token from a bucket, the core of all backends
+
+    the bucket holds ``remaining`` tokens till ``reset_at``, then it's refilled with ``limit`` tokens every ``window``.
+    above ``start`` tokens, requests go right away; below it, the rest of the window is split evenly among the
+    remaining tokens, each caller is given its own slot in turn; when tokens run out, callers borrow from the
+    following windows(``remaining`` goes negative) and are spread over them
+
+    :return: the new state(None if unchanged), seconds to wait before the slot(None if the budget is unknown)
+    """
+    if state is None:
+        return None, None
+    state = _roll(state, now)
+    if state is None:
+        return None, None
+    remaining, reset_at, next_at, limit, window = state
+    if remaining > start:
+        slot = now
+    elif remaining > 0:
+        slot = max(now, next_at)
+        next_at = slot + max(reset_at - slot, 0) / remaining
+    elif limit > 0 and window > 0:
+        debt = -remaining
+        slot = reset_at + (debt // limit) * window + (debt % limit) * window / limit
+    else:
+        slot = max(reset_at, next_at)
+    return (remaining - 1, reset_at, next_at, limit, window), slot - now
+
+
+def _merge(state: Optional[TypeBucketState], remaining: int, reset_at: float, limit: int,
+           now: float) -> TypeBucketState:
+    """apply the budget reported by the server to the state"""
+    old = _roll(state, now) if state is not None else None
+    if old is None:
+        return remaining, reset_at, 0.0, limit, reset_at - now
+    window = max(old[4], reset_at - now)  # the reset right after a window starts tells its length
+    if reset_at > old[1] + 1:  # a window not seen yet, borrowed tokens are still to be sent
+        return remaining + min(old[0], 0), reset_at, old[2], limit, window
+    # the same window: tokens taken locally may not reach the server yet, and windows may start later than rolled
+    return min(old[0], remaining), max(old[1], reset_at), old[2], limit, window
+
+
+class RateLimitBackend(ABC):
+    """
+    storage of rate limit state: route -> bucket mapping, and per-bucket budgets
+
+    all methods are atomic among every RateLimiter sharing the backend
+    """
+
+    @abstractmethod
+    async def get_bucket(self, route: str) -> Optional[str]:
+        """the bucket ``route`` belongs to, None if not known yet"""
+
+    @abstractmethod
+    async def set_bucket(self, route: str, bucket: str):
+        """remember ``route`` belongs to ``bucket``, the first mapping wins"""
+
+    @abstractmethod
+    async def update(self, bucket: str, remaining: int, reset_at: float, limit: int, now: float):
+        """apply the budget reported by the server, ``reset_at`` and ``now`` are unix timestamps"""
+
+    @abstractmethod
+    async def peek(self, bucket: str, now: float) -> Optional[TypeBucketState]:
+        """the state of ``bucket`` as of ``now``, None if the budget is unknown; nothing is taken or changed"""
+
+    @abstractmethod
+    async def reserve(self, bucket: str, start: int, now: float) -> Optional[float]:
+        """take a request slot in ``bucket``, return seconds to wait before sending, None if the budget is unknown"""
+
+    async def close(self):
+        """release resources held by the backend"""
+
+
+class MemoryBackend(RateLimitBackend):
+    """state in the process memory, the default"""
+
+    def __init__(self):
+        self._buckets: Dict[str, str] = {}
+        self._states: Dict[str, TypeBucketState] = {}
+
+    async def get_bucket(self, route: str) -> Optional[str]:
+        return self._buckets.get(route)
+
+    async def set_bucket(self, route: str, bucket: str):
+        self._buckets.setdefault(route, bucket)
+
+    async def update(self, bucket: str, remaining: int, reset_at: float, limit: int, now: float):
+        self._states[bucket] = _merge(self._states.get(bucket), remaining, reset_at, limit, now)
+
+    async def peek(self, bucket: str, now: float) -> Optional[TypeBucketState]:
+        state = self._states.get(bucket)
+        return _roll(state, now) if state is not None else None
+
+    async def reserve(self, bucket: str, start: int, now: float) -> Optional[float]:
+        state, delay = _reserve(self._states.get(bucket), start, now)
+        if state is not None:
+            self._states[bucket] = state
+        return delay
+
+
+class MmapBackend(RateLimitBackend):
+    """
+    state in a mmap-ed file, shared by processes on the same machine and kept across restarts
+
+    the file holds two fixed-size open-addressing tables(route -> bucket, bucket -> state),
+    every operation holds an exclusive ``flock`` on it. unix only
+
+    the loop is never blocked on the lock: it's tried without blocking and retried after a short sleep,
+    and a key is looked for in at most ``_MAX_PROBES`` slots, beyond that the table is taken as full
+
+    :param path: the state file, created if missing
+    :param slots: capacity of each table
+    """
+
+    _KEY_SIZE = 64
+    _ROUTE = struct.Struct(f'<{_KEY_SIZE}s{_KEY_SIZE}s')
+    _STATE = struct.Struct(f'<{_KEY_SIZE}siddid')
+    _MAX_PROBES = 64
+    _LOCK_RETRY_DELAYS = (0.0005, 0.001, 0.002, 0.005)  # then the last one over and over
+
+    def __init__(self, path: str, slots: int = 4096):
+        import fcntl  # pylint: disable=import-outside-toplevel
+        self._fcntl = fcntl
+        self.path = path
+        self.slots = slots
+        self._route_base = 0
+        self._state_base = self._ROUTE.size * slots
+        size = self._state_base + self._STATE.size * slots
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._fcntl.flock(self._fd, self._fcntl.LOCK_EX)  # once, at construction: blocking is fine
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        finally:
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+        self._mm = mmap.mmap(self._fd, size)
+
+    @contextlib.asynccontextmanager
+    async def _locked(self):
+        """
+        hold the exclusive lock of the file
+
+        the body must not await: ``flock`` is held by the file, not by the coroutine,
+        so other coroutines of this process would not be kept out
+        """
+        for i in itertools.count():
+            try:
+                self._fcntl.flock(self._fd, self._fcntl.LOCK_EX | self._fcntl.LOCK_NB)
+                break
+            except BlockingIOError:  # held by another process
+                await asyncio.sleep(self._LOCK_RETRY_DELAYS[min(i, len(self._LOCK_RETRY_DELAYS) - 1)])
+        try:
+            yield
+        finally:
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+
+    def _key(self, key: str) -> bytes:
+        k = key.encode()
+        if len(k) > self._KEY_SIZE:
+            k = hashlib.blake2b(k, digest_size=self._KEY_SIZE // 2).hexdigest().encode()
+        return k.ljust(self._KEY_SIZE, b'\x00')
+
+    def _find(self, base: int, entry: struct.Struct, key: bytes) -> Tuple[int, bool]:
+        """offset of the slot holding ``key``, or the empty slot for it; found or not"""
+        first = zlib.crc32(key) % self.slots
+        for i in range(min(self.slots, self._MAX_PROBES)):
+            offset = base + entry.size * ((first + i) % self.slots)
+            slot_key = self._mm[offset:offset + self._KEY_SIZE]
+            if slot_key == key:
+                return offset, True
+            if slot_key[0] == 0:
+                return offset, False
+        return -1, False
+
+    async def get_bucket(self, route: str) -> Optional[str]:
+        async with self._locked():
+            offset, found = self._find(self._route_base, self._ROUTE, self._key(route))
+            if not found:
+                return None
+            return self._ROUTE.unpack_from(self._mm, offset)[1].rstrip(b'\x00').decode()
+
+    async def set_bucket(self, route: str, bucket: str):
+        key = self._key(route)
+        async with self._locked():
+            offset, found = self._find(self._route_base, self._ROUTE, key)
+            if offset < 0:
+                log.warning(f'ratelimit state file {self.path} is full, route {route} not recorded')
+            elif not found:
+                self._ROUTE.pack_into(self._mm, offset, key, bucket.encode()[:self._KEY_SIZE])
+
+    def _get_state(self, key: bytes) -> Tuple[int, Optional[TypeBucketState]]:
+        offset, found = self._find(self._state_base, self._STATE, key)
+        return offset, self._STATE.unpack_from(self._mm, offset)[1:] if found else None
+
+    async def update(self, bucket: str, remaining: int, reset_at: float, limit: int, now: float):
+        key = self._key(bucket)
+        async with self._locked():
+            offset, state = self._get_state(key)
+            if offset < 0:
+                log.warning(f'ratelimit state file {self.path} is full, bucket {bucket} not recorded')
+                return
+            self._STATE.pack_into(self._mm, offset, key, *_merge(state, remaining, reset_at, limit, now))
+
+    async def peek(self, bucket: str, now: float) -> Optional[TypeBucketState]:
+        async with self._locked():
+            _, state = self._get_state(self._key(bucket))
+        return _roll(state, now) if state is not None else None
+
+    async def reserve(self, bucket: str, start: int, now: float) -> Optional[float]:
+        key = self._key(bucket)
+        async with self._locked():
+            offset, state = self._get_state(key)
+            state, delay = _reserve(state, start, now)
+            if state is not None:
+                self._STATE.pack_into(self._mm, offset, key, *state)
+        return delay
+
+    async def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+
+class RedisBackend(RateLimitBackend):
+    """
+    state in redis, shared by processes across machines
+
+    :param client: an async redis client, e.g. ``redis.asyncio.Redis(decode_responses=True)``,
+        anything speaking the same commands(HGET/HSETNX/EVAL) works, e.g. fakeredis in tests
+    :param prefix: namespace of keys
+    """
+
+    # mirrors _roll(), _reserve() and _merge(), keep them in sync
+    _ROLL = """
+local function load(key)
+    local s = redis.call('HMGET', key, 'remaining', 'reset_at', 'next_at', 'limit', 'window')
+    if not s[1] then return nil end
+    return {tonumber(s[1]), tonumber(s[2]), tonumber(s[3]), tonumber(s[4]), tonumber(s[5])}
+end
+local function roll(st, now)
+    if st == nil or st[2] > now then return st end
+    if st[5] <= 0 then return nil end
+    local passed = math.floor((now - st[2]) / st[5]) + 1
+    return {math.min(st[1] + passed * st[4], st[4]), st[2] + passed * st[5], st[3], st[4], st[5]}
+end
+local function save(key, st)
+    redis.call('HSET', key, 'remaining', string.format('%d', st[1]), 'reset_at', string.format('%.6f', st[2]),
+        'next_at', string.format('%.6f', st[3]), 'limit', string.format('%d', st[4]),
+        'window', string.format('%.6f', st[5]))
+    redis.call('EXPIREAT', key, math.ceil(math.max(st[2], st[3]) + st[5]) + 60)
+end
+"""
+
+    _RESERVE = _ROLL + """
+local start, now = tonumber(ARGV[1]), tonumber(ARGV[2])
+local st = roll(load(KEYS[1]), now)
+if st == nil then return false end
+local remaining, reset_at, next_at, limit, window = st[1], st[2], st[3], st[4], st[5]
+local slot
+if remaining > start then
+    slot = now
+elseif remaining > 0 then
+    slot = math.max(now, next_at)
+    next_at = slot + math.max(reset_at - slot, 0) / remaining
+elseif limit > 0 and window > 0 then
+    local debt = -remaining
+    slot = reset_at + math.floor(debt / limit) * window + (debt % limit) * window / limit
+else
+    slot = math.max(reset_at, next_at)
+end
+save(KEYS[1], {remaining - 1, reset_at, next_at, limit, window})
+return string.format('%.6f', slot - now)
+"""
+
+    _UPDATE = _ROLL + """
+local remaining, reset_at, limit, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local old = load(KEYS[1])
+if old ~= nil then old = roll(old, now) end
+if old == nil then
+    save(KEYS[1], {remaining, reset_at, 0, limit, reset_at - now})
+    return
+end
+local window = math.max(old[5], reset_at - now)
+if reset_at > old[2] + 1 then
+    save(KEYS[1], {remaining + math.min(old[1], 0), reset_at, old[3], limit, window})
+else
+    save(KEYS[1], {math.min(old[1], remaining), math.max(old[2], reset_at), old[3], limit, window})
+end
+"""
+
+    def __init__(self, client, prefix: str = 'khl:ratelimit:'):
+        self._client = client
+        self._prefix = prefix
+
+    async def get_bucket(self, route: str) -> Optional[str]:
+        bucket = await self._client.hget(f'{self._prefix}buckets', route)
+        return bucket.decode() if isinstance(bucket, bytes) else bucket
+
+    async def set_bucket(self, route: str, bucket: str):
+        await self._client.hsetnx(f'{self._prefix}buckets', route, bucket)
+
+    async def update(self, bucket: str, remaining: int, reset_at: float, limit: int, now: float):
+        await self._client.eval(self._UPDATE, 1, f'{self._prefix}state:{bucket}', remaining, f'{reset_at:.6f}', limit,
+                                f'{now:.6f}')
+
+    async def peek(self, bucket: str, now: float) -> Optional[TypeBucketState]:
+        state = await self._client.hmget(f'{self._prefix}state:{bucket}', 'remaining', 'reset_at', 'next_at', 'limit',
+                                         'window')
+        if state[0] is None:
+            return None
+        remaining, reset_at, next_at, limit, window = (float(v) for v in state)
+        return _roll((int(remaining), reset_at, next_at, int(limit), window), now)
+
+    async def reserve(self, bucket: str, start: int, now: float) -> Optional[float]:
+        delay = await self._client.eval(self._RESERVE, 1, f'{self._prefix}state:{bucket}', start, f'{now:.6f}')
+        return float(delay) if delay is not None else None
@@ -1,38 +1,123 @@
 import asyncio
 import logging
-from typing import Dict
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from . import codec
+from .ratelimit_backend import RateLimitBackend, MemoryBackend
 
 log = logging.getLogger(__name__)
 
 
 class RateLimiter:
     """rate limit control
+
+    every request reserves a token in the bucket of its route and in the global bucket, and waits for its own slot.
+    until the budget of a bucket is learned from a response, later requests to it wait for the first one
+
     @param start: when the remain reach this number, start ratelimit
+    @param backend: where the state is kept, defaults to ``MemoryBackend``;
+        share a ``MmapBackend``/``RedisBackend`` to let processes using the same token limit together
+    @param global_limit: (requests, seconds) allowed across all routes, enforced before the server reports one
+    @param bucket_map_file: file to keep learned route -> bucket mappings across restarts
     """
 
-    def __init__(self, start: int = 120):
-        self._ratelimit_info: Dict[str, RateLimiter.RateLimitData] = {}
-        self._api_bucket_mapping: Dict[str, str] = {}
-        self._lock = asyncio.Lock()
+    GLOBAL_BUCKET = 'global'
+    _PROBE_TIMEOUT = 3
+
+    def __init__(self,
+                 start: int = 120,
+                 *,
+                 backend: Optional[RateLimitBackend] = None,
+                 global_limit: Optional[Tuple[int, float]] = None,
+                 bucket_map_file: str = ''):
+        self._backend = backend if backend is not None else MemoryBackend()
         self._start = start
+        self._global_limit = global_limit
+        self._bucket_map_file = bucket_map_file
+        self._bucket_map: Dict[str, str] = {}
+        self._loaded = False
+        self._probes: Dict[str, asyncio.Future] = {}
+
+    @property
+    def start(self) -> int:
+        """when the remain reach this number, start ratelimit"""
+        return self._start
+
+    @property
+    def backend(self) -> RateLimitBackend:
+        """where the state is kept"""
+        return self._backend
+
+    @backend.setter
+    def backend(self, backend: RateLimitBackend):
+        self._backend = backend
+        self._loaded = False
+
+    async def _load(self):
+        self._loaded = True
+        if self._global_limit is not None:
+            limit, window = self._global_limit
+            now = time.time()
+            await self._backend.update(self.GLOBAL_BUCKET, limit, now + window, limit, now)
+        if self._bucket_map_file and os.path.exists(self._bucket_map_file):
+            with open(self._bucket_map_file, 'rb') as f:
+                self._bucket_map = codec.loads(f.read())
+            for api, bucket in self._bucket_map.items():
+                await self._backend.set_bucket(api, bucket)
 
     async def wait_for_rate(self, route):
-        """get and wait delay"""
+        """reserve a slot and wait for it"""
+
+        if not self._loaded:
+            await self._load()
 
         bucket = await self.get_bucket(route)
-        delay = await self.get_delay(bucket)
+        if await self._backend.peek(bucket, time.time()) is None and not await self._probe(bucket):
+            bucket = await self.get_bucket(route)  # the bucket may turn out to be another one after probing
+        # the token of the bucket is taken for the time the global bucket allows, not for now
+        delay = await self.get_delay(self.GLOBAL_BUCKET)
+        delay += await self._backend.reserve(bucket, self._start, time.time() + delay) or 0
         log.debug(f'ratelimiter: {route} req bucket: {bucket} delay: {delay: .3f}s')
-        await asyncio.sleep(delay)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _probe(self, bucket: str) -> bool:
+        """the first request to a bucket with unknown budget goes, others wait for the budget it learns
+
+        :return: if the caller is the first one"""
+        probe = self._probes.get(bucket)
+        if probe is None:
+            self._probes[bucket] = asyncio.get_event_loop().create_future()
+            return True
+        try:
+            await asyncio.wait_for(asyncio.shield(probe), self._PROBE_TIMEOUT)
+        except asyncio.TimeoutError:  # the first request is lost, e.g. network errors, the next one probes again
+            if self._probes.get(bucket) is probe:
+                del self._probes[bucket]
+        return False
 
     async def update(self, route, headers):
         """get values and update ratelimit information"""
 
+        probing = [route.lower()]
         if 'X-Rate-Limit-Limit' in headers:
             bucket, remaining, reset = self.extract_xrate_header(headers)
-            await self.push_api_bucket_mapping(route, bucket)
-            await self.update_ratelimit(bucket, remaining, reset)
+            probing.append(bucket.lower())
+            limit = int(headers['X-Rate-Limit-Limit'])
+            if 'X-Rate-Limit-Global' in headers:
+                await self.update_ratelimit(self.GLOBAL_BUCKET, remaining, reset, limit)
+            else:
+                await self.push_api_bucket_mapping(route, bucket)
+                await self.update_ratelimit(bucket, remaining, reset, limit)
             log.debug(f'ratelimiter: {route} rsp ratelimit: bucket: {bucket} remaining: {remaining} reset: {reset}s')
 
+        for b in probing:
+            probe = self._probes.pop(b, None)
+            if probe is not None and not probe.done():
+                probe.set_result(None)
+
     async def push_api_bucket_mapping(self, api: str, bucket: str):
         """
         when finished request, associate bucket that api returned with api route
@@ -41,53 +126,30 @@ class RateLimiter:
 
         api = api.lower()
         bucket = bucket.lower()
-
-        async with self._lock:
-            if api not in self._api_bucket_mapping:
-                self._api_bucket_mapping[api] = bucket
+        await self._backend.set_bucket(api, bucket)
+        if self._bucket_map_file and api not in self._bucket_map:
+            self._bucket_map[api] = bucket
+            with open(self._bucket_map_file, 'w', encoding='utf-8') as f:
+                f.write(codec.dumps(self._bucket_map))
 
     async def get_bucket(self, api: str):
         """get bucket name by api route"""
 
         api = api.lower()
+        return await self._backend.get_bucket(api) or api
 
-        async with self._lock:
-            if api not in self._api_bucket_mapping:
-                return api
-
-        return self._api_bucket_mapping[api]
-
-    async def update_ratelimit(self, bucket: str, remaining: int, reset: int):
+    async def update_ratelimit(self, bucket: str, remaining: int, reset: int, limit: int = 0):
         """update rate limit info"""
 
-        bucket = bucket.lower()
-        async with self._lock:
-            if bucket not in self._ratelimit_info:
-                self._ratelimit_info[bucket] = self.RateLimitData(remaining, reset)
-            else:
-                self._ratelimit_info[bucket].remaining = remaining
-                self._ratelimit_info[bucket].reset = reset
+        now = time.time()
+        await self._backend.update(bucket.lower(), remaining, now + reset, limit, now)
 
     async def get_delay(self, bucket: str) -> float:
-        """get request delay time, seconds"""
-
-        bucket = bucket.lower()
-        async with self._lock:
-            if bucket not in self._ratelimit_info:
-                return 0
-
-            if self._ratelimit_info[bucket].reset == 0:
-                return 0
+        """reserve a request slot in the bucket, get how long to wait for it, seconds
 
-            if self._ratelimit_info[bucket].remaining == 0:
-                return self._ratelimit_info[bucket].reset
+        concurrent callers are given different slots, instead of all going at the same time"""
 
-            if self._ratelimit_info[bucket].remaining > self._start:
-                return 0
-
-            delay = self._ratelimit_info[bucket].reset / self._ratelimit_info[bucket].remaining
-
-        return delay
+        return await self._backend.reserve(bucket.lower(), self._start, time.time()) or 0
 
     @staticmethod
     def extract_xrate_header(headers):
@@ -97,10 +159,3 @@ class RateLimiter:
         remaining = int(headers['X-Rate-Limit-Remaining'])
         reset = int(headers['X-Rate-Limit-Reset'])
         return bucket, remaining, reset
-
-    class RateLimitData:
-        """to save single bucket rate limit"""
-
-        def __init__(self, remaining: int = 120, reset: int = 0):
-            self.remaining = remaining
-            self.reset = reset
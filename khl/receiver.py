@@ -1,20 +1,70 @@
 import asyncio
 import logging
 import time
+import warnings
 import zlib
 from abc import ABC, abstractmethod
-from typing import Dict
+from collections import deque
+from types import MappingProxyType
+from typing import Callable, Deque, Dict, Hashable, List, Mapping, Optional, Set, Tuple
 
 from aiohttp import ClientWebSocketResponse, ClientSession, web, WSMessage
 
+from . import codec, metrics, tracing
+from .backoff import Backoff
 from .cert import Cert
 from .interface import AsyncRunnable
+from .pkg_queue import PkgQueue
+from .session import HTTPSession
 
 log = logging.getLogger(__name__)
 
 API = 'https://www.kaiheila.cn/api/v3'
 
 
+class _DedupWindow:
+    """
+    remembers keys seen in the last ``window`` seconds
+
+    keys are queued in arrival order, so expired ones are always at the head of the queue:
+    insert, lookup and eviction are all O(1), memory is bounded by the traffic within one window
+
+    :param clock: monotonic seconds, ``time.monotonic`` by default
+    """
+
+    def __init__(self, window: float, clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self._clock = clock
+        self._queue: Deque[Tuple[float, Hashable]] = deque()
+        self._seen: Set[Hashable] = set()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def check_and_add(self, key: Hashable) -> bool:
+        """if ``key`` is seen within the window, otherwise remember it from now on"""
+        now = self._clock()
+        self._evict(now)
+        if key in self._seen:
+            return True
+        self._seen.add(key)
+        self._queue.append((now, key))
+        return False
+
+    def snapshot(self) -> Dict[Hashable, float]:
+        """keys in the window -> unix timestamp they were first seen"""
+        now = self._clock()
+        self._evict(now)
+        offset = time.time() - now
+        return {key: seen_at + offset for seen_at, key in self._queue}
+
+    def _evict(self, now: float):
+        deadline = now - self.window
+        queue = self._queue
+        while queue and queue[0][0] < deadline:
+            self._seen.discard(queue.popleft()[1])
+
+
 class Receiver(AsyncRunnable, ABC):
     """
     1. receive raw data from khl server
@@ -22,6 +72,7 @@ class Receiver(AsyncRunnable, ABC):
     3. put pkg into the pkg_queue() for others to use
     """
     _queue: asyncio.Queue
+    session: Optional[HTTPSession] = None  # outbound HTTP session, set by ``Gateway`` to share the requester's
 
     @property
     def type(self) -> str:
@@ -44,33 +95,140 @@ class Receiver(AsyncRunnable, ABC):
 
 
 class WebsocketReceiver(Receiver):
-    """receive data in websocket mode"""
-
-    def __init__(self, cert: Cert, compress: bool):
+    """receive data in websocket mode
+
+    keeps the session across reconnects: resumes from the newest sn when possible,
+    delivers events in sn order and drops replayed duplicates.
+
+    events are moved into the pkg_queue by a separate task through an outbox as large as the pkg_queue.
+    a full outbox takes the pkg_queue's overflow policy: the DROP ones drop there and reading goes on,
+    BLOCK stops reading frames until there is room, meanwhile the heartbeat keeps pinging
+    and missed pongs are not taken for a dead link"""
+
+    _SN_MOD = 65535  # sn cycles in 1 ~ 65535
+    _SN_BUFFER_SIZE = 128
+    _SN_BUFFER_TIMEOUT = 6
+    _PONG_TIMEOUT = 6
+    _PONG_RETRY_DELAYS = (2, 4)  # re-ping after a missed pong, the link is dead if all retries missed
+    _HEARTBEAT_INTERVAL = 26
+    _STABLE_CONNECTION = 60  # a connection lived this long resets the backoff
+
+    def __init__(self,
+                 cert: Cert,
+                 compress: bool,
+                 *,
+                 reconnect_backoff: Backoff = None,
+                 gateway_fetch_interval: float = 10):
+        """
+        :param reconnect_backoff: delays between reconnects, default: 1s ~ 60s exponential with jitter
+        :param gateway_fetch_interval: min interval between two fetches of the gateway url, seconds
+        """
         super().__init__()
         self._cert = cert
         self.compress = compress
 
         self._NEWEST_SN = 0
         self._RAW_GATEWAY = ''
+        self._gateway_stale = True
+        self._gateway_fetched_at = 0.0
+        self._gateway_fetch_interval = gateway_fetch_interval
+        self._backoff = reconnect_backoff or Backoff(base=1, cap=60)
+        self._hello_received = False
+
+        self._session_id = ''
+        self._sn_buffer: Dict[int, Dict] = {}
+        self._sn_buffer_since = 0.0
+        self._pong = asyncio.Event()
+        self._latency = 0.0
+        self._ws_conn: Optional[ClientWebSocketResponse] = None
+        self._outbox: Deque[Dict] = deque()  # events in sn order, waiting for the pkg_queue
+        self._outbox_ready = asyncio.Event()
+        self._outbox_room = asyncio.Event()
+        self._reader_paused = False
+
+        self._dup_dropped = metrics.counter('ws.sn.dup_dropped')
+        self._out_of_order = metrics.counter('ws.sn.out_of_order')
+        self._gap_skipped = metrics.counter('ws.sn.gap_skipped')
+        self._resumed = metrics.counter('ws.resumed')
+        self._reconnect_instructed = metrics.counter('ws.reconnect_instructed')
+        self._pong_timeout = metrics.counter('ws.pong_timeout')
+        self._link_dead = metrics.counter('ws.link_dead')
+        self._rtt = metrics.histogram('ws.rtt_seconds', (0.05, 0.1, 0.25, 0.5, 1, 2, 6))
+        metrics.gauge('ws.latency_seconds', lambda: self._latency)
+        self._reconnects = metrics.counter('ws.reconnects')
+        self._gateway_fetches = metrics.counter('ws.gateway.fetches')
+        self._gateway_fetch_failures = metrics.counter('ws.gateway.fetch_failures')
+        self._gateway_reused = metrics.counter('ws.gateway.reused')
+        self._backoff_delay = metrics.histogram('ws.backoff_seconds', (0.5, 1, 2, 4, 8, 16, 32, 64))
+        metrics.gauge('ws.outbox.depth', self._outbox.__len__)
 
     @property
     def type(self) -> str:
         return 'websocket'
 
+    @property
+    def latency(self) -> float:
+        """round-trip time of the latest ping/pong, seconds"""
+        return self._latency
+
     async def heartbeat(self, ws_conn: ClientWebSocketResponse):
-        """khl customized heartbeat scheme"""
-        while True:
+        """khl customized heartbeat scheme
+
+        ping every 26s, a missed pong is retried after 2s and 4s, if still missed the link is declared dead:
+        the connection is closed, then ``start()`` reconnects and resumes.
+        missed pongs are not counted while the reader is paused by a full outbox: backpressure is not a dead link.
+
+        owned by the connection: started and cancelled along with it in ``_connect_gateway_and_handle_msg()``"""
+        delays = (self._HEARTBEAT_INTERVAL, ) + self._PONG_RETRY_DELAYS
+        missed = 0
+        while not ws_conn.closed:
             try:
-                await asyncio.sleep(26)
-                await ws_conn.send_json({'s': 2, 'sn': self._NEWEST_SN})
+                await asyncio.sleep(delays[missed])
+                if await self._ping(ws_conn) or self._reader_paused:  # paused reader: the pong is not read yet
+                    missed = 0
+                    continue
+                missed += 1
+                self._pong_timeout.inc()
+                if missed < len(delays):
+                    log.warning(f'websocket pong timed out, retry in {delays[missed]}s')
+                    continue
+                self._link_dead.inc()
+                log.warning('websocket link is dead, reconnect with resume')
+                await ws_conn.close()
+                return
+            except asyncio.CancelledError:
+                raise
             except ConnectionResetError:
                 return
             except Exception as e:
                 log.exception('error raised during websocket heartbeat',
                               exc_info=e)
 
-    async def _get_gateway(self, cs: ClientSession):
+    async def _ping(self, ws_conn: ClientWebSocketResponse) -> bool:
+        """send a ping and wait for the pong
+
+        :return: if pong received in time"""
+        self._pong.clear()
+        sent_at = time.perf_counter()
+        await ws_conn.send_json({'s': 2, 'sn': self._NEWEST_SN})
+        try:
+            await asyncio.wait_for(self._pong.wait(), self._PONG_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        self._latency = time.perf_counter() - sent_at
+        self._rtt.observe(self._latency)
+        return True
+
+    async def _get_gateway(self, cs: ClientSession) -> bool:
+        """fetch a new gateway url, at most once per ``gateway_fetch_interval``
+
+        :return: if succeeded"""
+        wait = self._gateway_fetched_at + self._gateway_fetch_interval - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._gateway_fetched_at = time.time()
+        self._gateway_fetches.inc()
+
         headers = {
             'Authorization': f'Bot {self._cert.token}',
             'Content-type': 'application/json'
@@ -79,114 +237,388 @@ class WebsocketReceiver(Receiver):
         async with cs.get(f"{API}/gateway/index",
                           headers=headers,
                           params=params) as res:
-            res_json = await res.json()
+            res_json = await res.json(loads=codec.loads)
             if res_json['code'] != 0:
                 log.error(f'getting gateway: {res_json}')
-                return
+                self._gateway_fetch_failures.inc()
+                return False
 
             self._RAW_GATEWAY = res_json['data']['url']
+            self._gateway_stale = False
+            return True
+
+    def _gateway_url(self) -> str:
+        """the gateway url, with resume params if there is a session to resume"""
+        if not self._session_id:
+            return self._RAW_GATEWAY
+        sep = '&' if '?' in self._RAW_GATEWAY else '?'
+        return f'{self._RAW_GATEWAY}{sep}resume=1&sn={self._NEWEST_SN}&session_id={self._session_id}'
 
     async def _connect_gateway_and_handle_msg(self, cs: ClientSession):
-        async with cs.ws_connect(self._RAW_GATEWAY) as ws_conn:
-            asyncio.ensure_future(self.heartbeat(ws_conn), loop=self.loop)
+        self._hello_received = False
+        async with cs.ws_connect(self._gateway_url()) as ws_conn:
+            self._ws_conn = ws_conn
+            heartbeat = asyncio.ensure_future(self.heartbeat(ws_conn), loop=self.loop)
 
             log.info('[ init ] launched')
             try:
                 async for raw in ws_conn:
                     raw: WSMessage
                     await self._handle_raw(raw)
+                    await self._wait_outbox_room()
             except Exception:
                 log.exception(
                     'error raised during websocket receive, reconnect automatically'
                 )
+            finally:
+                heartbeat.cancel()
+                self._ws_conn = None
 
     async def start(self):
-        async with ClientSession(loop=self.loop) as cs:
+        own_session = self.session is None  # not shared: it's ours to close
+        session = HTTPSession() if own_session else self.session
+        forward = asyncio.ensure_future(self._forward())
+        try:
             while True:
-                await self._get_gateway(cs)
-                await self._connect_gateway_and_handle_msg(cs)
+                connected_at = time.time()
+                await self._connect_once(session.session)  # a closed session is reopened on reconnect
+
+                if time.time() - connected_at >= self._STABLE_CONNECTION:
+                    self._backoff.reset()
+                delay = self._backoff.next_delay()
+                self._backoff_delay.observe(delay)
+                self._reconnects.inc()
+                log.info(f'reconnect in {delay:.2f}s')
+                await asyncio.sleep(delay)
+        finally:
+            forward.cancel()
+            if own_session:
+                await session.close()
+
+    async def _connect_once(self, cs: ClientSession):
+        """connect with the cached gateway url if it's still usable, otherwise fetch a new one"""
+        try:
+            if self._gateway_stale or not self._RAW_GATEWAY:
+                if not await self._get_gateway(cs):
+                    return
+            else:
+                self._gateway_reused.inc()
+            await self._connect_gateway_and_handle_msg(cs)
+        except Exception as e:
+            log.exception('error raised during connecting to gateway', exc_info=e)
+        if not self._hello_received:  # the url did not bring us a session, don't trust it next time
+            self._gateway_stale = True
 
     async def _handle_raw(self, raw: WSMessage):
         try:
-            data = raw.data
-            data = zlib.decompress(data) if self.compress else data
+            data = zlib.decompress(raw.data) if self.compress else raw.data  # khl compresses each frame on its own
             pkg: Dict = self._cert.decode_raw(data)
             log.debug(f'upcoming raw: {pkg}')
-            if pkg['s'] != 0:
-                return
-            self._NEWEST_SN = pkg['sn']
-            await self.pkg_queue.put(pkg['d'])
+            for ready in self._drain_sn_buffer(timed_out_only=True):  # any frame, pongs at least, checks the timeout
+                self._deliver(ready)
+            signal = pkg['s']
+            if signal == 0:  # only events start a trace: pongs and other control frames would flood the exporter
+                with tracing.span('receiver.handle_raw', receiver=self.type, sn=pkg['sn']) as span:
+                    tracing.attach(pkg['d'], span)
+                    self._handle_event(pkg)
+            elif signal == 1:
+                await self._handle_hello(pkg['d'])
+            elif signal == 3:
+                self._pong.set()
+            elif signal == 5:
+                self._reconnect_instructed.inc()
+                log.warning(f'reconnect instructed by server: {pkg.get("d")}')
+                await self._reset_session()
+            elif signal == 6:
+                self._resumed.inc()
+                self._session_id = pkg['d'].get('session_id', self._session_id)
+                log.info(f'session resumed from sn: {self._NEWEST_SN}')
         except Exception as e:
             log.exception(e)
 
+    async def _handle_hello(self, d: Dict):
+        if d.get('code', 0) != 0:
+            log.error(f'handshake failed: {d}, reconnect from scratch')
+            await self._reset_session()
+            return
+        self._hello_received = True
+        session_id = d.get('session_id', '')
+        if session_id != self._session_id:  # not the session being resumed: sn of the new one starts over
+            self._NEWEST_SN = 0
+            self._sn_buffer.clear()
+        self._session_id = session_id
+
+    async def _reset_session(self):
+        """drop the session and all sn states, then close the connection to let ``start()`` reconnect from scratch"""
+        self._session_id = ''
+        self._NEWEST_SN = 0
+        self._sn_buffer.clear()
+        self._gateway_stale = True
+        if self._ws_conn is not None:
+            await self._ws_conn.close()
+
+    def _handle_event(self, pkg: Dict):
+        """deliver events in sn order: stale sn is a replayed duplicate, sn after a gap waits in the buffer"""
+        for ready in self._order_event(pkg):
+            self._deliver(ready)
+
+    def _order_event(self, pkg: Dict) -> List[Dict]:
+        """
+        sn bookkeeping of an incoming event, no await: the read path is the only one touching the sn buffer
+
+        :return: events ready to deliver, in sn order
+        """
+        sn = pkg['sn']
+        if self._NEWEST_SN:
+            gap = (sn - self._NEWEST_SN) % self._SN_MOD
+            if gap == 0 or gap > self._SN_MOD // 2 or sn in self._sn_buffer:
+                self._dup_dropped.inc()
+                return []
+            if gap > 1:
+                self._out_of_order.inc()
+                if not self._sn_buffer:
+                    self._sn_buffer_since = time.time()
+                self._sn_buffer[sn] = pkg
+                if len(self._sn_buffer) > self._SN_BUFFER_SIZE:
+                    return self._drain_sn_buffer()
+                return []
+        self._NEWEST_SN = sn
+        return [pkg] + self._drain_sn_buffer(consecutive_only=True)
+
+    def _drain_sn_buffer(self, *, consecutive_only: bool = False, timed_out_only: bool = False) -> List[Dict]:
+        """pop buffered events in sn order, ``_NEWEST_SN`` moves on to the last one
+
+        :param consecutive_only: stop at the first gap, otherwise give up waiting for the missing sn
+        :param timed_out_only: do nothing unless the buffer has been waiting for too long
+        :return: events to deliver, in sn order
+        """
+        if not self._sn_buffer:
+            return []
+        if timed_out_only and time.time() - self._sn_buffer_since < self._SN_BUFFER_TIMEOUT:
+            return []
+        ready = []
+        for sn in sorted(self._sn_buffer, key=lambda s: (s - self._NEWEST_SN) % self._SN_MOD):
+            if (sn - self._NEWEST_SN) % self._SN_MOD != 1:
+                if consecutive_only:
+                    break
+                self._gap_skipped.inc()
+                log.warning(f'sn gap skipped: {self._NEWEST_SN} -> {sn}')
+            self._NEWEST_SN = sn
+            ready.append(self._sn_buffer.pop(sn))
+        self._sn_buffer_since = time.time()
+        return ready
+
+    def _outbox_full(self) -> bool:
+        return 0 < self.pkg_queue.maxsize <= len(self._outbox)
+
+    def _deliver(self, pkg: Dict):
+        """append the event to the outbox, a full outbox takes the pkg_queue's overflow policy
+
+        BLOCK is left to the read loop, see ``_wait_outbox_room()``"""
+        item = pkg['d']
+        if self._outbox_full() and isinstance(self.pkg_queue, PkgQueue):
+            queue: PkgQueue = self.pkg_queue
+            if queue.overflow == PkgQueue.Overflow.DROP_OLDEST:
+                queue.record_drop(self._outbox.popleft())
+            elif queue.overflow == PkgQueue.Overflow.DROP_TYPES and item.get('type') in queue.drop_types:
+                queue.record_drop(item)
+                return
+        self._outbox.append(item)
+        self._outbox_ready.set()
+
+    async def _wait_outbox_room(self):
+        """stop reading frames while the outbox is full, so backpressure reaches the network"""
+        while self._outbox_full():
+            self._reader_paused = True
+            self._outbox_room.clear()
+            try:
+                await self._outbox_room.wait()
+            finally:
+                self._reader_paused = False
+
+    async def _forward(self):
+        """move delivered events into the pkg_queue, only this task waits when the pkg_queue is full"""
+        while True:
+            while self._outbox:
+                await self.pkg_queue.put(self._outbox[0])
+                self._outbox.popleft()  # after put: an event being put when cancelled is kept
+                self._outbox_room.set()
+            self._outbox_ready.clear()
+            await self._outbox_ready.wait()
+
 
 class WebhookReceiver(Receiver):
-    """receive data in webhook mode"""
+    """
+    receive data in webhook mode
+
+    by default a request is decoded, checked and put into the pkg_queue before responded.
+    with ``fast_ack``, requests are acknowledged after O(1) checks on the body(size, first bytes), decoding and the
+    rest are done by ``decode_workers`` in the background, so queue pressure and CPU work don't hold up the responses
+    to KOOK; bodies failing the checks are answered with 400.
+    bodies small enough to be a challenge are still handled inline: the challenge has to be answered in its response,
+    and decoding a few hundred bytes is cheap
+
+    :param dedup_window: seconds to remember a sn, pkgs with a sn seen within it are dropped as redelivery
+    :param fast_ack: acknowledge requests before decoding them
+    :param decode_workers: count of background decoders under ``fast_ack``
+    :param raw_queue_size: max count of acknowledged requests waiting for decoding, 503 is responded if full
+    :param reuse_port: listen with SO_REUSEPORT, so several bot processes can share the port and the load
+    :param max_body_size: larger requests are refused with 413 before read
+    """
 
-    def __init__(self, cert: Cert, *, port: int, route: str, compress: bool):
+    _LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+    _INLINE_MAX_SIZE = 512  # a challenge takes ~330 bytes encrypted, events are mostly larger
+    _ZLIB_METHOD = 8  # deflate, the only method in CMF of a zlib stream
+
+    def __init__(self,
+                 cert: Cert,
+                 *,
+                 port: int,
+                 route: str,
+                 compress: bool,
+                 dedup_window: float = 600,
+                 fast_ack: bool = False,
+                 decode_workers: int = 1,
+                 raw_queue_size: int = 1024,
+                 reuse_port: bool = False,
+                 max_body_size: int = 1024**2):
         super().__init__()
         self._cert = cert
         self.port = port
         self.route = route
-        self.app = web.Application()
+        self.app = web.Application(client_max_size=max_body_size)  # bounds chunked bodies as well
         self.compress = compress
-        self.sn_dup_map = {}
+        self.fast_ack = fast_ack
+        self.decode_workers = decode_workers
+        self.reuse_port = reuse_port
+        self.max_body_size = max_body_size
+        self._dedup = _DedupWindow(dedup_window)
+        self._raw_queue: asyncio.Queue = asyncio.Queue(raw_queue_size)
+        self._workers = []
+
+        metrics.gauge('webhook.dedup.size', self._dedup.__len__)
+        metrics.gauge('webhook.raw_queue.depth', self._raw_queue.qsize)
+        self._rejected = metrics.counter('webhook.rejected')
+        self._malformed = metrics.counter('webhook.malformed')
+        self._request_latency = metrics.histogram('webhook.request_seconds', self._LATENCY_BUCKETS)
+        self._decode_latency = metrics.histogram('webhook.decode_seconds', self._LATENCY_BUCKETS)
+        self._pipeline_latency = metrics.histogram('webhook.ack_to_queue_seconds', self._LATENCY_BUCKETS)
 
     @property
     def type(self) -> str:
         return 'webhook'
 
+    @property
+    def sn_dup_map(self) -> Mapping[Hashable, float]:
+        """sn seen within ``dedup_window`` -> unix timestamp, a read-only snapshot
+
+        .. deprecated-removed:: 0.3.17 0.4.0
+            dedup is internal now, only ``dedup_window`` is configurable"""
+        warnings.warn('deprecated, sn_dup_map is a read-only snapshot now and will be removed',
+                      DeprecationWarning,
+                      stacklevel=2)
+        return MappingProxyType(self._dedup.snapshot())
+
     def _is_dup(self, req: dict) -> bool:
         sn = req.get('sn', None)
         if sn is None:
             return False
-        current = time.time()
-        if sn in self.sn_dup_map:
-            if current - self.sn_dup_map[sn] <= 600:
-                # 600 sec timed out
-                return True
-        self.sn_dup_map[sn] = current
-        return False
+        return self._dedup.check_and_add(sn)
 
     async def start(self):
+        self.app.router.add_post(self.route, self._on_recv)
+        if self.fast_ack:
+            self._workers = [asyncio.ensure_future(self._decode_worker()) for _ in range(self.decode_workers)]
+        try:
+            runner = web.AppRunner(self.app)
+            await runner.setup()  # runner use its own loop, can not be set
+            site = web.TCPSite(runner, '0.0.0.0', self.port, reuse_port=self.reuse_port)
 
-        async def on_recv(request: web.Request):
-            try:
-                data = await request.read()
-                data = zlib.decompress(data) if self.compress else data
-                pkg: Dict = self._cert.decode_raw(data)
-            except Exception as e:
-                log.exception(e)
-                return web.Response()
-
-            if not pkg:  # empty pkg
-                return web.Response()
-
-            if pkg['d'][
-                    'verify_token'] != self._cert.verify_token:  # check verify_token
-                return web.Response()
-
-            if self._is_dup(pkg):  # dup pkg
-                return web.Response()
+            log.info('[ init ] launched')
 
-            if pkg['s'] == 0:
-                pkg = pkg['d']
-                if pkg['type'] == 255 and pkg[
-                        'channel_type'] == 'WEBHOOK_CHALLENGE':
-                    return web.json_response({'challenge': pkg['challenge']})
-                await self.pkg_queue.put(pkg)
+            await site.start()
 
-            return web.Response()
+            while True:
+                await asyncio.sleep(3600)  # sleep forever
+        finally:
+            for worker in self._workers:
+                worker.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            self._workers = []
+
+    def _is_sane(self, data: bytes) -> bool:
+        """O(1) checks of a request body: a zlib header if compressed, a JSON object otherwise"""
+        if self.compress:  # zlib header: deflate method, and the check bits make it a multiple of 31
+            return len(data) >= 2 and data[0] & 0x0f == self._ZLIB_METHOD and (data[0] << 8 | data[1]) % 31 == 0
+        return data[:1] == b'{'
+
+    async def _on_recv(self, request: web.Request) -> web.Response:
+        start = time.perf_counter()
+        span = tracing.span('receiver.on_recv', receiver=self.type)
+        handed_off = False
+        try:
+            if request.content_length is not None and request.content_length > self.max_body_size:
+                self._malformed.inc()
+                return web.Response(status=413)  # refused before read
+            data = await request.read()
+            if self.fast_ack:
+                if not self._is_sane(data):
+                    self._malformed.inc()
+                    return web.Response(status=400)
+                if len(data) > self._INLINE_MAX_SIZE:
+                    try:
+                        self._raw_queue.put_nowait((data, span, time.perf_counter()))
+                    except asyncio.QueueFull:
+                        self._rejected.inc()
+                        return web.Response(status=503)  # KOOK will redeliver it
+                    handed_off = True  # the span ends in the decode worker
+                    return web.Response()
+            answer = await self._handle_raw(data, span)
+            return web.json_response(answer) if answer else web.Response()
+        finally:
+            if not handed_off:
+                span.end()
+            self._request_latency.observe(time.perf_counter() - start)
+
+    async def _decode_worker(self):
+        while True:
+            data, span, acked_at = await self._raw_queue.get()
+            try:
+                if await self._handle_raw(data, span):
+                    log.warning(f'challenge larger than {self._INLINE_MAX_SIZE} bytes was acknowledged unanswered')
+            except Exception as e:
+                log.exception('error raised during webhook pkg handling', exc_info=e)
+            finally:
+                span.end()
+                self._raw_queue.task_done()
+                self._pipeline_latency.observe(time.perf_counter() - acked_at)
+
+    async def _handle_raw(self, data: bytes, span) -> Optional[Dict]:
+        """decode, check and enqueue a request body, returns the answer if it's a challenge"""
+        try:
+            start = time.perf_counter()
+            data = zlib.decompress(data) if self.compress else data
+            pkg: Dict = self._cert.decode_raw(data)
+            self._decode_latency.observe(time.perf_counter() - start)
+        except Exception as e:
+            span.set_error(e)
+            log.exception(e)
+            return None
 
-        self.app.router.add_post(self.route, on_recv)
+        if not pkg:  # empty pkg
+            return None
 
-        runner = web.AppRunner(self.app)
-        await runner.setup()  # runner use its own loop, can not be set
-        site = web.TCPSite(runner, '0.0.0.0', self.port)
+        if pkg['d']['verify_token'] != self._cert.verify_token:  # check verify_token
+            return None
 
-        log.info('[ init ] launched')
+        if self._is_dup(pkg):  # dup pkg
+            return None
 
-        await site.start()
+        if pkg['s'] == 0:
+            pkg = pkg['d']
+            if pkg['type'] == 255 and pkg['channel_type'] == 'WEBHOOK_CHALLENGE':
+                return {'challenge': pkg['challenge']}
+            tracing.attach(pkg, span)
+            await self.pkg_queue.put(pkg)
 
-        while True:
-            await asyncio.sleep(3600)  # sleep forever
+        return None
@@ -1,10 +1,14 @@
 import asyncio
+import collections
+import functools
 import logging
-from typing import Union, List, Optional
-
-from aiohttp import ClientSession
+from typing import AsyncIterator, Dict, Hashable, Union, List, Optional
 
+from . import codec, metrics, tracing
+from .cache import TTLCache
 from .ratelimiter import RateLimiter
+from .retry import RetryPolicy, parse_retry_after
+from .session import HTTPSession
 from .api import _Req
 from .cert import Cert
 
@@ -14,42 +18,139 @@ API = 'https://www.kookapp.cn/api/v3'
 
 
 class HTTPRequester:
-    """wrap raw requests, handle boilerplate param filling works"""
+    """wrap raw requests, handle boilerplate param filling works
+
+    identical GET requests(same route and query) in flight at the same time are sent only once,
+    callers share the result: treat it as read-only"""
 
-    def __init__(self, cert: Cert, ratelimiter: Optional[RateLimiter]):
+    def __init__(self,
+                 cert: Cert,
+                 ratelimiter: Optional[RateLimiter],
+                 *,
+                 coalesce: bool = True,
+                 response_ttl: float = 0,
+                 response_cache_size: int = 1024,
+                 retry: Optional[RetryPolicy] = None,
+                 session: Optional[HTTPSession] = None):
+        """
+        :param coalesce: share one in-flight request among identical GET requests
+        :param response_ttl: if > 0, responses of GET requests are also reused for this many seconds,
+            only for data that can be a bit stale
+        :param response_cache_size: max count of responses kept when ``response_ttl`` > 0
+        :param retry: retry policy of failed requests, default: ``RetryPolicy()``, idempotent requests only,
+            pass ``RetryPolicy(max_attempts=1)`` to disable retries
+        :param session: connection pool and timeouts, default: ``HTTPSession()``,
+            shared with the websocket receiver if it's in the same ``Gateway``; call ``close()`` when done
+        """
         self._cert = cert
-        self._cs: Union[ClientSession, None] = None
+        self._session = session if session is not None else HTTPSession()
         self._ratelimiter = ratelimiter
+        self._coalesce = coalesce
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._responses = TTLCache('requester.responses', response_cache_size, response_ttl) \
+            if response_ttl > 0 else None
+        self._coalesced = metrics.counter('requester.coalesced')
+        self._retry = retry if retry is not None else RetryPolicy()
+
+    @property
+    def ratelimiter(self) -> Optional[RateLimiter]:
+        """the ratelimiter applied to requests, None if not limited"""
+        return self._ratelimiter
+
+    @ratelimiter.setter
+    def ratelimiter(self, ratelimiter: Optional[RateLimiter]):
+        self._ratelimiter = ratelimiter
+
+    @property
+    def session(self) -> HTTPSession:
+        """the HTTP session requests are sent with"""
+        return self._session
 
-    def __del__(self):
-        if self._cs is not None:
-            asyncio.get_event_loop().run_until_complete(self._cs.close())
+    async def warm_up(self, connections: int = 2):
+        """open connections to khl server ahead of the first requests, see :func:`HTTPSession.warm_up()`"""
+        await self._session.warm_up(f'{API}/gateway/index', connections)
+
+    async def close(self):
+        """close the HTTP session, requests made later open a new one"""
+        await self._session.close()
 
     async def request(self, method: str, route: str, **params) -> Union[dict, list, bytes]:
         """wrap raw request, fill authorization, handle & extract response"""
+        with tracing.span('requester.request', method=method, route=route):
+            key = self._coalesce_key(method, route, params) if self._coalesce else None
+            if key is None:
+                return await self._request_with_retry(method, route, params)
+
+            if self._responses is not None:
+                rsp = self._responses.get(key)
+                if rsp is not None:
+                    return rsp
+            task = self._inflight.get(key)
+            if task is None:
+                task = self._inflight[key] = asyncio.ensure_future(self._request_with_retry(method, route, params))
+                task.add_done_callback(functools.partial(self._on_shared_done, key))
+            else:
+                self._coalesced.inc()
+            # shielded: one caller cancelled does not cancel the request others are waiting for
+            return await asyncio.shield(task)
+
+    @staticmethod
+    def _coalesce_key(method: str, route: str, params: Dict) -> Optional[Hashable]:
+        """key of requests that can share one, None if not sharable: not GET, with body or custom headers"""
+        if method != 'GET' or params.get('headers') or not set(params).issubset(('params', 'headers')):
+            return None
+        try:
+            return route, frozenset((params.get('params') or {}).items())
+        except TypeError:  # unhashable values in the query
+            return None
+
+    def _on_shared_done(self, key: Hashable, task: asyncio.Future):
+        self._inflight.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is None and self._responses is not None:  # retrieved anyway: no warning if none waits
+            self._responses.set(key, task.result())
+
+    async def _request_with_retry(self, method: str, route: str, params: Dict) -> Union[dict, list, bytes]:
+        return await self._retry.run(method, route, lambda: self._request(method, route, **params))
+
+    async def _request(self, method: str, route: str, **params) -> Union[dict, list, bytes]:
         headers = params.pop('headers', {})
         params['headers'] = headers
 
         log.debug(f'{method} {route}: req: {params}')  # token is excluded
 
         if self._ratelimiter is not None:
-            await self._ratelimiter.wait_for_rate(route)
+            with tracing.span('ratelimiter.wait_for_rate', route=route):
+                await self._ratelimiter.wait_for_rate(route)
 
         headers['Authorization'] = f'Bot {self._cert.token}'
-        if self._cs is None:  # lazy init
-            self._cs = ClientSession()
-        async with self._cs.request(method, f'{API}/{route}', **params) as res:
+        async with self._session.session.request(method, f'{API}/{route}', **params) as res:
+            if self._ratelimiter is not None:  # before checking the code: failed responses carry the limits too
+                await self._ratelimiter.update(route, res.headers)
+
+            if res.status == 429 or res.status >= 500:  # the body can be anything, even not JSON
+                retry_after = parse_retry_after(res.headers.get('Retry-After'))
+                if retry_after is None and res.status == 429:  # khl sends the reset on every response, 429 means it
+                    retry_after = parse_retry_after(res.headers.get('X-Rate-Limit-Reset'))
+                body = await _read_error_body(res)
+                raise HTTPRequester.APIRequestFailed(method,
+                                                     route,
+                                                     params,
+                                                     body.get('code'),
+                                                     body.get('message') or res.reason,
+                                                     status=res.status,
+                                                     retry_after=retry_after)
+
             if res.content_type == 'application/json':
-                rsp = await res.json()
+                rsp = codec.loads(await res.read())
                 if rsp['code'] != 0:
-                    raise HTTPRequester.APIRequestFailed(method, route, params, rsp['code'], rsp['message'])
+                    raise HTTPRequester.APIRequestFailed(method, route, params, rsp['code'], rsp['message'],
+                                                         status=res.status)
                 rsp = rsp['data']
             else:
                 rsp = await res.read()
 
-            if self._ratelimiter is not None:
-                await self._ratelimiter.update(route, res.headers)
-
             log.debug(f'{method} {route}: rsp: {rsp}')
             return rsp
 
@@ -63,41 +164,82 @@ class HTTPRequester:
                              begin_page: int = 1,
                              end_page: int = None,
                              page_size: int = 50,
-                             sort: str = '') -> List:
+                             sort: str = '',
+                             concurrency: int = 4) -> List:
         """
-        execute paged requests
+        execute paged requests, collect items of all pages into a list
 
-        iter from ``begin_page`` to the ``end_page``, ``end_page=None`` means to the end
+        see :func:`iter_paged_req()` for params
+        """
+        return [i async for i in self.iter_paged_req(r,
+                                                     begin_page=begin_page,
+                                                     end_page=end_page,
+                                                     page_size=page_size,
+                                                     sort=sort,
+                                                     concurrency=concurrency)]
 
-        1. get a req, inject the params
-        2. req and receive the result
-        3. unwrap the result, append result, fresh pagination params
+    async def iter_paged_req(self,
+                             r: _Req,
+                             *,
+                             begin_page: int = 1,
+                             end_page: int = None,
+                             page_size: int = 50,
+                             sort: str = '',
+                             concurrency: int = 4) -> AsyncIterator[Dict]:
+        """
+        execute paged requests, yield items one by one in order
+
+        iter from ``begin_page`` to the ``end_page``, ``end_page=None`` means to the end,
+        nothing is requested if ``end_page`` < ``begin_page``
+
+        1. req the first page, learn ``page_total`` from it
+        2. req following pages, up to ``concurrency`` of them in flight, each still waits for the ratelimiter
+        3. yield items page by page in order, only pages in the window are held in memory
 
         :param begin_page: int = 1,
         :param end_page: int = None,
         :param page_size: int = 50,
-        :param sort: str = ''
+        :param sort: str = '',
+        :param concurrency: max pages requested at the same time
         """
-        ret = []
-        current_page = begin_page
-        while end_page is None or current_page <= end_page:
-            r.params['params']['page'] = current_page
-            r.params['params']['page_size'] = page_size
-            if sort:
-                r.params['params']['sort'] = sort
+        if end_page is not None and end_page < begin_page:
+            return
+        first = await self.exec_req(self._paged(r, begin_page, page_size, sort))
+        meta = first['meta']
+        page_size = meta['page_size']
+        end_page = meta['page_total'] if end_page is None else min(end_page, meta['page_total'])
+        pages = iter(range(meta['page'] + 1, end_page + 1))
 
-            p = await self.exec_req(r)
+        window = collections.deque()
 
-            ret.extend(p['items'])
-            current_page = p['meta']['page']
-            page_total = p['meta']['page_total']
-            page_size = p['meta']['page_size']
+        def fill():
+            while len(window) < max(concurrency, 1):
+                page = next(pages, None)
+                if page is None:
+                    return
+                window.append(asyncio.ensure_future(self.exec_req(self._paged(r, page, page_size, sort))))
 
-            current_page += 1
-            if end_page is None:
-                end_page = page_total
+        fill()
+        try:
+            for i in first['items']:
+                yield i
+            while window:
+                p = await window.popleft()
+                fill()  # keep the window full while the caller consumes the page
+                for i in p['items']:
+                    yield i
+        finally:  # the caller breaks early or a page fails: drop pages in flight
+            for t in window:
+                t.cancel()
+            await asyncio.gather(*window, return_exceptions=True)
 
-        return ret
+    @staticmethod
+    def _paged(r: _Req, page: int, page_size: int, sort: str) -> _Req:
+        """a copy of ``r`` with pagination params, pages in flight must not share params"""
+        query = dict(r.params.get('params', {}), page=page, page_size=page_size)
+        if sort:
+            query['sort'] = sort
+        return _Req(r.method, r.route, dict(r.params, params=query))
 
     class APIRequestFailed(Exception):
         """Raised when khl.py received non-zero error code from remote server.
@@ -108,13 +250,27 @@ class HTTPRequester:
         if request body is needed for debug purpose, consider explicitly catching this exception and
         call repr(...) with the exception instance."""
 
-        def __init__(self, method, route, params, err_code, err_message):
+        def __init__(self, method, route, params, err_code, err_message, *, status=None, retry_after=None):
             super().__init__()
             self.method = method
             self.route = route
             self.params = params
-            self.err_code = err_code
+            self.err_code = err_code  # code in the response body, None if the body has none
             self.err_message = err_message
+            self.status = status  # HTTP status
+            self.retry_after = retry_after  # seconds the server asks to wait
 
         def __str__(self):
-            return f"Requesting '{self.method} {self.route}' failed with {self.err_code}: {self.err_message}"
+            code = self.err_code if self.err_code is not None else f'HTTP {self.status}'
+            return f"Requesting '{self.method} {self.route}' failed with {code}: {self.err_message}"
+
+
+async def _read_error_body(res) -> Dict:
+    """the JSON body of a failed response, {} if it is not JSON or not an object"""
+    if res.content_type != 'application/json':
+        return {}
+    try:
+        body = codec.loads(await res.read())
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
@@ -0,0 +1,173 @@
+"""retry policy: which failed requests to retry, how long to wait between attempts, and a budget against retry storms"""
+import asyncio
+import copy
+import email.utils
+import logging
+import math
+import time
+from typing import Awaitable, Callable, Dict, FrozenSet, Iterable, Optional, TypeVar
+
+from aiohttp import ClientConnectionError, ClientPayloadError
+
+from . import metrics
+from .backoff import Backoff
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    seconds to wait from a ``Retry-After`` header: delay seconds(``"2"``, ``"1.5"``) or an HTTP-date
+
+    :return: None if missing or not understood, a date in the past gives 0
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date is None or date.tzinfo is None:  # HTTP-dates are GMT, a date without a zone is not one
+            return None
+        seconds = date.timestamp() - time.time()
+    if math.isnan(seconds) or math.isinf(seconds):
+        return None
+    return max(seconds, 0.0)
+
+
+class RetryError(Exception):
+    """
+    raised by an attempt to report a failed response to ``RetryPolicy.run()``,
+    for callers that do not raise on failed responses themselves
+
+    :param status: HTTP status, None for failures without a response, e.g. timeouts
+    :param retry_after: seconds the server asks to wait before the next attempt
+    :param payload: anything the caller wants back if no attempt succeeded
+    """
+
+    def __init__(self, status: Optional[int] = None, retry_after: Optional[float] = None, payload=None):
+        super().__init__(f'attempt failed with status: {status}')
+        self.status = status
+        self.retry_after = retry_after
+        self.payload = payload
+
+
+class RetryBudget:
+    """
+    caps retries to a ratio of requests, so when a service is down, clients do not multiply the load by retrying
+
+    every retry takes a token, every request gives back ``ratio`` token, up to ``max_retries`` tokens;
+    so a burst of failures is retried ``max_retries`` times at most, then only ``ratio`` of requests are
+
+    :param ratio: retries allowed per request in the long run
+    :param max_retries: tokens when full, i.e. retries allowed in a burst
+    """
+
+    def __init__(self, ratio: float = 0.2, max_retries: int = 10):
+        self.ratio = ratio
+        self.max_retries = max_retries
+        self._tokens = float(max_retries)
+        self._exhausted = metrics.counter('retry.budget_exhausted')
+
+    def deposit(self):
+        """a request is made"""
+        self._tokens = min(self._tokens + self.ratio, self.max_retries)
+
+    def withdraw(self) -> bool:
+        """take a token for a retry, False if the budget is exhausted"""
+        if self._tokens < 1:
+            self._exhausted.inc()
+            return False
+        self._tokens -= 1
+        return True
+
+
+class RetryPolicy:
+    """
+    retry failed attempts of a request, with jittered exponential backoff
+
+    an attempt is retried if the method is in ``methods``(idempotent ones by default: repeating them is safe),
+    and it failed with a status in ``statuses``, or without a response(timeouts, connection resets).
+    the wait before the next attempt is the backoff delay, or what the server asks(``retry_after``) if longer.
+
+    exceptions are inspected by duck typing: ``.status`` for the HTTP status and ``.retry_after`` if any,
+    e.g. ``HTTPRequester.APIRequestFailed``, ``aiohttp.ClientResponseError`` and ``RetryError``
+
+    :param max_attempts: attempts in total, including the first one, 1 means no retry
+    :param backoff: template of the delays, each request starts over from its ``base``
+    :param methods: HTTP methods to retry
+    :param statuses: HTTP statuses to retry
+    :param routes: per-route policies, matched by route prefix, e.g. ``{'asset/create': RetryPolicy(max_attempts=1)}``
+    :param budget: shared by all requests under this policy, None means unlimited;
+        the default one is shared by all policies using the default
+    """
+
+    IDEMPOTENT_METHODS: FrozenSet[str] = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+    RETRY_STATUSES: FrozenSet[int] = frozenset((408, 429, 500, 502, 503, 504))
+    TRANSIENT_ERRORS = (asyncio.TimeoutError, ClientConnectionError, ClientPayloadError)
+
+    def __init__(self,
+                 max_attempts: int = 3,
+                 *,
+                 backoff: Backoff = None,
+                 methods: Iterable[str] = IDEMPOTENT_METHODS,
+                 statuses: Iterable[int] = RETRY_STATUSES,
+                 routes: Dict[str, 'RetryPolicy'] = None,
+                 budget: Optional[RetryBudget] = RetryBudget()):
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff = backoff or Backoff(base=0.5, cap=10)
+        self.methods = frozenset(m.upper() for m in methods)
+        self.statuses = frozenset(statuses)
+        self.routes = routes or {}
+        self.budget = budget
+        self._retries = metrics.counter('retry.retries')
+        self._gave_up = metrics.counter('retry.gave_up')
+
+    def for_route(self, route: str) -> 'RetryPolicy':
+        """the policy applied to ``route``: the longest matched prefix in ``routes``, or this one"""
+        matched = max((r for r in self.routes if route.startswith(r)), key=len, default=None)
+        return self.routes[matched] if matched is not None else self
+
+    def should_retry(self, method: str, error: BaseException) -> bool:
+        """if the attempt failed with ``error`` deserves another one, regardless of attempts and budget"""
+        if method.upper() not in self.methods:
+            return False
+        status = getattr(error, 'status', None)
+        if status is not None:
+            return status in self.statuses
+        return isinstance(error, (RetryError, *self.TRANSIENT_ERRORS))
+
+    async def run(self, method: str, route: str, attempt: Callable[[], Awaitable[T]]) -> T:
+        """
+        ``await attempt()`` until it succeeds or the failure should not be retried
+
+        :param attempt: makes one attempt, raises on failures
+        :raise: the exception of the last attempt
+        """
+        policy = self.for_route(route)
+        backoff = copy.copy(policy.backoff)
+        backoff.reset()
+        if policy.budget is not None:
+            policy.budget.deposit()
+
+        n = 1
+        while True:
+            try:
+                return await attempt()
+            except Exception as e:  # pylint: disable=broad-except
+                if not policy.should_retry(method, e):
+                    raise
+                if n >= policy.max_attempts or (policy.budget is not None and not policy.budget.withdraw()):
+                    self._gave_up.inc()
+                    raise
+                delay = max(backoff.next_delay(), getattr(e, 'retry_after', None) or 0)
+                log.warning(f'{method} {route}: attempt {n} failed: {e}, retry in {delay:.2f}s')
+                self._retries.inc()
+                await asyncio.sleep(delay)
+            n += 1
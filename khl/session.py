@@ -0,0 +1,112 @@
+"""http session: one tuned aiohttp ClientSession shared by REST requests and the websocket gateway"""
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from . import codec, metrics
+
+log = logging.getLogger(__name__)
+
+
+class HTTPSession:
+    """
+    owns the aiohttp ``ClientSession``, created on first use inside the running loop and closed by ``close()``
+
+    :param limit: max connections in total
+    :param limit_per_host: max connections to one host, 0 means no limit beyond ``limit``
+    :param keepalive_timeout: seconds an idle connection is kept for reuse
+    :param timeout: timeouts of REST requests, websocket frames are not limited by it once connected;
+        default: 10s to connect, 30s between reads, no limit on the total so slow uploads can finish
+    :param ttl_dns_cache: seconds DNS results are cached
+    """
+    # as aiohttp's graceful shutdown advises: SSL transports need a moment to finish closing after the session is,
+    # or they are reported as unclosed; plain ones close on the next loop iteration
+    _SSL_CLOSE_DELAY = 0.25
+
+    def __init__(self,
+                 *,
+                 limit: int = 100,
+                 limit_per_host: int = 0,
+                 keepalive_timeout: float = 30,
+                 timeout: Optional[ClientTimeout] = None,
+                 ttl_dns_cache: int = 300):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout or ClientTimeout(total=None, sock_connect=10, sock_read=30)
+        self.ttl_dns_cache = ttl_dns_cache
+        self._cs: Optional[ClientSession] = None
+        metrics.gauge('http.connections.acquired', lambda: self.stats()['acquired'])
+        metrics.gauge('http.connections.idle', lambda: self.stats()['idle'])
+
+    @property
+    def session(self) -> ClientSession:
+        """the ClientSession, (re)created if not yet or closed, must be accessed inside the running loop"""
+        if self._cs is None or self._cs.closed:
+            connector = TCPConnector(limit=self.limit,
+                                     limit_per_host=self.limit_per_host,
+                                     keepalive_timeout=self.keepalive_timeout,
+                                     ttl_dns_cache=self.ttl_dns_cache)
+            self._cs = ClientSession(connector=connector, timeout=self.timeout, json_serialize=codec.dumps)
+        return self._cs
+
+    @property
+    def closed(self) -> bool:
+        """no open ClientSession"""
+        return self._cs is None or self._cs.closed
+
+    async def warm_up(self, url: str, connections: int = 2):
+        """
+        open ``connections`` connections(TCP + TLS) to the host of ``url`` ahead of the first requests,
+        they are kept alive for ``keepalive_timeout``. failures are logged, not raised
+
+        any response will do: the url is requested without authorization
+        """
+
+        async def one():
+            async with self.session.head(url, allow_redirects=False) as res:
+                await res.read()
+
+        results = await asyncio.gather(*[one() for _ in range(max(connections, 1))], return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            log.warning(f'http warm-up: {len(failed)}/{len(results)} failed: {failed[0]!r}')
+        log.debug(f'http warm-up done: {self.stats()}')
+
+    def stats(self) -> Dict:
+        """connections in use and idle in the pool, and the limits"""
+        connector = self._cs.connector if self._cs is not None and not self._cs.closed else None
+        if connector is None:
+            return {'acquired': 0, 'idle': 0, 'limit': self.limit, 'limit_per_host': self.limit_per_host}
+        try:  # aiohttp does not expose the counts publicly
+            acquired = len(connector._acquired)  # pylint: disable=protected-access
+            idle = sum(len(c) for c in connector._conns.values())  # pylint: disable=protected-access
+        except AttributeError:  # internals changed in some aiohttp version
+            acquired = idle = 0
+        return {
+            'acquired': acquired,
+            'idle': idle,
+            'limit': connector.limit,
+            'limit_per_host': connector.limit_per_host
+        }
+
+    async def close(self):
+        """close the ClientSession and all its connections, a later use opens a new one"""
+        if self._cs is not None and not self._cs.closed:
+            ssl = _has_ssl_connections(self._cs.connector)
+            await self._cs.close()
+            await asyncio.sleep(self._SSL_CLOSE_DELAY if ssl else 0)
+        self._cs = None
+
+
+def _has_ssl_connections(connector) -> bool:
+    """any open connection over SSL in ``connector``, True if not known"""
+    # pylint: disable=protected-access
+    try:
+        protos = list(connector._acquired)
+        protos.extend(proto for conns in connector._conns.values() for proto, _ in conns)
+    except AttributeError:  # internals changed in some aiohttp version
+        return True
+    return any(p.transport is not None and p.transport.get_extra_info('sslcontext') is not None for p in protos)
@@ -0,0 +1,116 @@
+"""guild state: Guild objects with their channels and roles, loaded once and kept in sync by system events"""
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from . import metrics
+from .cache import event_patch
+from .channel import PublicChannel
+from .gateway import Gateway
+from .guild import Guild
+from .message import Event
+
+log = logging.getLogger(__name__)
+
+
+class GuildState:
+    """
+    serve guild structure queries from memory
+
+    ``fetch_guild()`` loads a guild with its channel list and role list once, and tracks it;
+    system events dispatched by ``Client`` are applied to tracked guilds as incremental patches:
+
+    - ``updated_guild``: guild fields
+    - ``added/updated/deleted_channel``: channels and categories, updated channels are the same objects
+    - ``added/updated/deleted_role``: roles
+    - ``deleted_guild``/``self_exited_guild``: the guild is no longer tracked
+
+    so ``guild.fetch_channel_list(force_update=False)``/``guild.fetch_roles(force_update=False)``
+    on a tracked guild need no request. guild members are kept by the entity cache(``Gateway.cache``).
+
+    tracked objects are shared: treat them as read-only, call ``fetch_guild(guild_id, force_update=True)``
+    to reload one in case events were missed, e.g. after a long disconnection
+    """
+
+    def __init__(self, gate: Gateway):
+        self.gate = gate
+        self._guilds: Dict[str, Guild] = {}
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._patches = metrics.counter('state.patches')
+        metrics.gauge('state.guilds', self._guilds.__len__)
+
+    @property
+    def guilds(self) -> List[Guild]:
+        """tracked guilds"""
+        return list(self._guilds.values())
+
+    def get_guild(self, guild_id: str) -> Optional[Guild]:
+        """the tracked guild, None if not tracked, no network involved"""
+        return self._guilds.get(guild_id)
+
+    def get_channel(self, channel_id: str) -> Optional[PublicChannel]:
+        """the channel in tracked guilds, None if not found, no network involved"""
+        for guild in self._guilds.values():
+            for c in guild.channels:
+                if c.id == channel_id:
+                    return c
+        return None
+
+    async def fetch_guild(self, guild_id: str, force_update: bool = False) -> Guild:
+        """
+        the tracked guild, load and track it if not yet
+
+        concurrent calls share one loading
+
+        :param force_update: reload from khl server even if tracked
+        """
+        if not force_update and guild_id in self._guilds:
+            return self._guilds[guild_id]
+        loading = self._loading.get(guild_id)
+        if loading is None:
+            loading = self._loading[guild_id] = asyncio.ensure_future(self._load(guild_id))
+            loading.add_done_callback(lambda _: self._loading.pop(guild_id, None))
+        return await asyncio.shield(loading)
+
+    async def _load(self, guild_id: str) -> Guild:
+        guild = Guild(_gate_=self.gate, id=guild_id)
+        await guild.load()
+        await guild.fetch_channel_list(bypass_cache=True)
+        await guild.fetch_roles(bypass_cache=True)
+        self._guilds[guild_id] = guild
+        return guild
+
+    def forget(self, guild_id: str):
+        """stop tracking the guild"""
+        self._guilds.pop(guild_id, None)
+
+    def apply(self, event: Event):
+        """apply the event to the tracked guild it belongs to, called by ``Client`` before dispatching"""
+        # pylint: disable=protected-access
+        try:
+            patch = event_patch(event.event_type, event.target_id, event.body or {})
+        except ValueError:  # event types not known yet
+            return
+        guild = self._guilds.get(patch.guild_id) if patch is not None and patch.guild_id else None
+        if guild is None:
+            return
+
+        if patch.kind == 'guild':
+            if patch.data is not None:
+                guild._patch_fields(**patch.data)
+            else:
+                self.forget(guild.id)
+        elif patch.kind == 'channel':
+            if patch.data is not None:
+                guild._put_channel(patch.data)
+            else:
+                guild._remove_channel(patch.id)
+        elif patch.kind == 'role':
+            if patch.data is not None:
+                guild._put_role(patch.data)
+            else:
+                guild._remove_role(patch.id)
+        else:  # members are kept by the entity cache
+            return
+        self._patches.inc()
+        log.debug(f'guild state: {event.event_type.value} applied to guild {guild.id}')
@@ -0,0 +1,276 @@
+"""lightweight tracing: per-message spans with parent/child timing, exported to a local JSON-lines file"""
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, Callable, Dict, Optional
+
+log = logging.getLogger(__name__)
+
+_PKG_SPAN_KEY = '_span_'
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar('khl_current_span', default=None)
+
+
+class Span:
+    """
+    a timed unit of work
+
+    spans sharing a ``trace_id`` form one trace, ``parent_id`` links a span to the span it was started in.
+
+    used as a context manager, the span becomes the current span inside the block,
+    tasks spawned in the block (e.g. handlers dispatched by ``Client``) inherit it as their parent
+    """
+
+    def __init__(self, tracer: 'Tracer', name: str, trace_id: str, parent_id: str, attributes: Dict[str, Any]):
+        self._tracer = tracer
+        self._token = None
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = ''
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+
+    @property
+    def duration_ms(self) -> float:
+        """elapsed time in milliseconds, till now if the span is not ended"""
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value: Any):
+        """attach a key-value pair to the span"""
+        self.attributes[key] = value
+
+    def set_error(self, e: BaseException):
+        """mark the span as failed"""
+        self.error = f'{type(e).__name__}: {e}'
+
+    def end(self):
+        """finish the span and hand it to the exporter, only the first call takes effect"""
+        if self.end_ns:
+            return
+        self.end_ns = time.time_ns()
+        self._tracer.export(self)
+
+    def __enter__(self) -> 'Span':
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_val is not None:
+            self.set_error(exc_val)
+        _current_span.reset(self._token)
+        self.end()
+
+
+class _NoopSpan:
+    """
+    placeholder for disabled/unsampled traces, children of it are no-op too
+
+    only the root of an unsampled trace marks the running context, so its descendants skip sampling
+    """
+    trace_id = ''
+    span_id = ''
+    duration_ms = 0.0
+
+    def __init__(self, mark: bool = False):
+        self._mark = mark
+        self._token = None
+
+    def set_attribute(self, key: str, value: Any):
+        """no-op"""
+
+    def set_error(self, e: BaseException):
+        """no-op"""
+
+    def end(self):
+        """no-op"""
+
+    def __enter__(self) -> '_NoopSpan':
+        if self._mark:
+            self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._mark:
+            _current_span.reset(self._token)
+
+
+NOOP_SPAN = _NoopSpan()
+
+_CURRENT = object()
+
+
+class JsonLinesExporter:
+    """
+    append ended spans to a local file, one JSON object per line
+
+    :param path: the output file, parent dirs are created if missing
+    :param otlp: write each span as an OTLP/JSON ``resourceSpans`` envelope instead of the flat record
+    """
+
+    def __init__(self, path: str, *, otlp: bool = False):
+        self.path = path
+        self.otlp = otlp
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # line buffered: a trace is readable as soon as its spans end, even if the bot is killed later
+        self._file = open(path, 'a', buffering=1, encoding='utf-8')  # pylint: disable=consider-using-with
+
+    def export(self, span: Span):
+        """write the span"""
+        record = self._to_otlp(span) if self.otlp else self._to_record(span)
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    def close(self):
+        """flush and close the output file"""
+        if not self._file.closed:
+            self._file.close()
+
+    @staticmethod
+    def _to_record(span: Span) -> Dict:
+        return {
+            'trace_id': span.trace_id,
+            'span_id': span.span_id,
+            'parent_id': span.parent_id,
+            'name': span.name,
+            'start_ns': span.start_ns,
+            'end_ns': span.end_ns,
+            'duration_ms': round(span.duration_ms, 3),
+            'attributes': span.attributes,
+            'error': span.error
+        }
+
+    @staticmethod
+    def _to_otlp(span: Span) -> Dict:
+        attributes = [{'key': k, 'value': {'stringValue': str(v)}} for k, v in span.attributes.items()]
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'parentSpanId': span.parent_id or '',
+            'name': span.name,
+            'kind': 1,
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': attributes,
+            'status': {'code': 2, 'message': span.error} if span.error else {}
+        }
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'khl.py'}}]},
+                'scopeSpans': [{'scope': {'name': __name__}, 'spans': [otlp_span]}]
+            }]
+        }
+
+
+class Tracer:
+    """
+    creates spans and decides sampling
+
+    sampling is decided once per trace, at its root span: all descendants of an unsampled root are no-op
+
+    :param exporter: receives ended spans, tracing is disabled if None
+    :param sample_rate: fraction of traces to record, 0.0 ~ 1.0
+    """
+
+    def __init__(self, exporter: Optional[JsonLinesExporter] = None, sample_rate: float = 1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @property
+    def enabled(self) -> bool:
+        """if spans are recorded at all"""
+        return self.exporter is not None and self.sample_rate > 0
+
+    def start_span(self, name: str, parent=_CURRENT, **attributes):
+        """
+        create a span, caller should ``end()`` it, or use it as a context manager
+
+        :param parent: parent span, defaults to the current span of the running context, None to start a new trace
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        if parent is _CURRENT:
+            parent = _current_span.get()
+            if isinstance(parent, _NoopSpan):  # context already marked by the unsampled root
+                return NOOP_SPAN
+        elif isinstance(parent, _NoopSpan):  # explicit parent from another context, e.g. carried by a pkg
+            return _NoopSpan(mark=True)
+        if parent is None:
+            if random.random() >= self.sample_rate:
+                return _NoopSpan(mark=True)
+            return Span(self, name, os.urandom(16).hex(), None, attributes)
+        return Span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    def export(self, span: Span):
+        """pass an ended span to the exporter, exporting errors are logged and swallowed"""
+        if self.exporter is None:
+            return
+        try:
+            self.exporter.export(span)
+        except Exception as e:
+            log.exception('error raised during span exporting', exc_info=e)
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """the process-wide tracer used by khl.py internals"""
+    return _tracer
+
+
+def configure(path: str = '', *, sample_rate: float = 1.0, otlp: bool = False) -> Tracer:
+    """
+    enable tracing, spans will be appended to ``path``
+
+    empty ``path`` disables tracing
+    """
+    if _tracer.exporter is not None:
+        _tracer.exporter.close()
+    _tracer.exporter = JsonLinesExporter(path, otlp=otlp) if path else None
+    _tracer.sample_rate = sample_rate
+    return _tracer
+
+
+def span(name: str, **attributes):
+    """start a child of the current span(or a new trace) on the process-wide tracer"""
+    return _tracer.start_span(name, **attributes)
+
+
+def current_span():
+    """the span of the running context, ``NOOP_SPAN`` if not in any span"""
+    return _current_span.get() or NOOP_SPAN
+
+
+def traced(name: str = ''):
+    """decorator, wrap every call of the coroutine function in a span named ``name``(default: func qualname)"""
+
+    def dec(func: Callable):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with _tracer.start_span(span_name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return dec
+
+
+def attach(pkg: Dict, s):
+    """carry span ``s`` along with ``pkg`` across the pkg_queue"""
+    if _tracer.enabled:
+        pkg[_PKG_SPAN_KEY] = s
+
+
+def detach(pkg: Dict):
+    """take the span carried by ``pkg`` out, None if nothing carried"""
+    return pkg.pop(_PKG_SPAN_KEY, None)
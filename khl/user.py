@@ -1,7 +1,6 @@
-import json
 from typing import List, Union
 
-from . import api
+from . import api, codec, tracing
 from ._types import MessageTypes, FriendTypes
 from .gateway import Requestable, Gateway
 from .interface import LazyLoadable
@@ -59,7 +58,7 @@ class User(LazyLoadable, Requestable):
         # if content is card msg, then convert it to plain str
         if isinstance(content, List):
             type = MessageTypes.CARD
-            content = json.dumps(content)
+            content = codec.dumps(content)
         else:
             type = type or MessageTypes.KMD
 
@@ -68,7 +67,8 @@ class User(LazyLoadable, Requestable):
         kwargs['content'] = content
         kwargs['type'] = type.value
 
-        return await self.gate.exec_req(api.DirectMessage.create(**kwargs))
+        with tracing.span('user.send', target_id=self.id, type=type.name):
+            return await self.gate.exec_req(api.DirectMessage.create(**kwargs))
 
     async def fetch_intimacy(self) -> Intimacy:
         """get the user's intimacy info"""
@@ -135,6 +135,7 @@ class GuildUser(User):
         Set user's nickname
         """
         await self.gate.exec_req(api.Guild.nickname(guild_id=self.guild_id, nickname=nickname, user_id=self.id))
+        self.gate.cache.forget_guild_user(self.guild_id, self.id)
 
     async def add_friend(self):
         await self.gate.exec_req(
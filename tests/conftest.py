@@ -0,0 +1,69 @@
+"""shared fixtures: local stand-ins of khl servers"""
+import contextlib
+import socket
+
+import pytest
+from aiohttp import web
+
+import khl.receiver
+import khl.requester
+from khl import Gateway
+
+
+class FakeGateway(Gateway):
+    """answers requests from a route -> data map, paged ones included, records the routes requested"""
+
+    def __init__(self, responses: dict):
+        super().__init__(None, None)
+        self.responses = responses
+        self.requested = []
+
+    async def exec_req(self, r):
+        self.requested.append(r.route)
+        return self.responses.get(r.route, {})
+
+    async def exec_paged_req(self, r, **kwargs):
+        return await self.exec_req(r)
+
+    async def iter_paged_req(self, r, **kwargs):
+        for i in await self.exec_req(r):
+            yield i
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """
+    ``async with serve(app) as url``: run ``app`` on a free local port, ``url`` is its base, e.g. http://127.0.0.1:80
+
+    meanwhile requests of ``HTTPRequester`` and ``WebsocketReceiver`` go to ``{url}/api/v3``
+    """
+
+    @contextlib.asynccontextmanager
+    async def _serve(app: web.Application):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, '127.0.0.1', 0).start()
+            host, port = runner.addresses[0][:2]
+            url = f'http://{host}:{port}'
+            monkeypatch.setattr(khl.requester, 'API', f'{url}/api/v3')
+            monkeypatch.setattr(khl.receiver, 'API', f'{url}/api/v3')
+            yield url
+        finally:
+            await runner.cleanup()
+
+    return _serve
+
+
+@pytest.fixture
+def free_port() -> int:
+    """a local port nothing listens on, for servers which bind by themselves, e.g. ``WebhookReceiver``"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def fake_gate():
+    """``fake_gate(responses)``: a ``Gateway`` answering requests from a route -> data map, without network"""
+    return FakeGateway
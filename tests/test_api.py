@@ -0,0 +1,103 @@
+"""khl.api: every @req function builds the same _Req as the decorator resolving everything per call did"""
+import ast
+import functools
+import inspect
+import io
+import re
+
+import aiohttp
+import pytest
+
+from khl import api
+
+
+def _legacy_req(method: str, **http_fields):
+    """the decorator before routes and payload layouts were precomputed, kept as the reference"""
+
+    def _method(func):
+
+        @functools.wraps(func)
+        def req_maker(*args, **kwargs):
+            route = re.compile(r'(?<!^)(?=[A-Z])').sub('-', func.__qualname__).lower().replace('.', '/')
+            param_names = list(inspect.signature(func).parameters.keys())
+            for i, arg in enumerate(args):
+                kwargs[param_names[i].lstrip('_')] = arg
+            return api._Req(method, route, _legacy_merge_params(method, http_fields, kwargs))
+
+        return req_maker
+
+    return _method
+
+
+def _legacy_merge_params(method: str, http_fields: dict, req_args: dict) -> dict:
+    payload, payload_key = req_args, 'params'
+    if method == 'POST':
+        payload_key = 'json'
+        if http_fields.get('headers', {}).get('Content-Type') == 'multipart/form-data':
+            payload_key, payload = 'data', aiohttp.FormData()
+            for name, value in req_args.items():
+                payload.add_field(name, value)
+            http_fields = {**http_fields, 'headers': {**http_fields['headers']}}
+            del http_fields['headers']['Content-Type']
+    return {payload_key: payload, **http_fields}
+
+
+def _req_functions():
+    """(qualname, method, http_fields) of each @req function, read from the source"""
+    found = {}  # a later definition of the same name wins, as in the class
+    for cls in ast.parse(inspect.getsource(api)).body:
+        if not isinstance(cls, ast.ClassDef):
+            continue
+        for func in cls.body:
+            for dec in getattr(func, 'decorator_list', ()):
+                if isinstance(dec, ast.Call) and getattr(dec.func, 'id', None) == 'req':
+                    http_fields = {kw.arg: ast.literal_eval(kw.value) for kw in dec.keywords}
+                    found[f'{cls.name}.{func.name}'] = (ast.literal_eval(dec.args[0]), http_fields)
+    return [(qualname, method, http_fields) for qualname, (method, http_fields) in found.items()]
+
+
+def _normalized(r: api._Req):
+    params = dict(r.params)
+    if params.get('headers') == {}:  # empty headers are no longer sent: the same request
+        del params['headers']
+    if isinstance(params.get('data'), aiohttp.FormData):
+        params['data'] = params['data']._fields
+    return r.method, r.route, params
+
+
+REQ_FUNCTIONS = _req_functions()
+
+
+def test_all_found():
+    assert len(REQ_FUNCTIONS) > 70
+
+
+@pytest.mark.parametrize('qualname, method, http_fields', REQ_FUNCTIONS, ids=[q for q, _, _ in REQ_FUNCTIONS])
+def test_same_as_legacy(qualname, method, http_fields):
+    cls_name, name = qualname.split('.')
+    new = getattr(getattr(api, cls_name), name)
+    old = _legacy_req(method, **http_fields)(new.__wrapped__)
+
+    params = inspect.signature(new.__wrapped__).parameters.values()
+    values = {p.name: f'value-of-{p.name}' for p in params}
+    required = [values[p.name] for p in params if p.default is inspect.Parameter.empty]
+    calls = [
+        ((), {}),
+        (tuple(values.values()), {}),  # positional
+        ((), {k.lstrip('_'): v for k, v in values.items()}),  # keyword
+        (tuple(required), {}),  # defaulted args left out
+        (tuple(values.values())[:1], {k.lstrip('_'): v for k, v in list(values.items())[1:]}),  # mixed
+    ]
+    for args, kwargs in calls:
+        assert _normalized(new(*args, **kwargs)) == _normalized(old(*args, **kwargs))
+
+
+def test_headers_not_shared():
+    r1, r2 = api.Asset.create(file=io.BytesIO()), api.Asset.create(file=io.BytesIO())
+    if 'headers' in r1.params:
+        assert r1.params['headers'] is not r2.params['headers']
+
+
+def test_too_many_args():
+    with pytest.raises(TypeError):
+        api.Guild.view('1', '2')
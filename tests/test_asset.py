@@ -0,0 +1,70 @@
+"""AssetUploader against a fake asset/create endpoint"""
+import asyncio
+import contextlib
+import io
+import os
+
+from aiohttp import web
+
+from khl import Cert, Gateway, HTTPRequester
+from khl.asset import AssetUploader
+
+
+class FakeAssetServer:
+    """records Content-Length and the uploaded file of each request"""
+
+    def __init__(self):
+        self.requests = []
+        self.app = web.Application(client_max_size=16 * 1024**2)
+        self.app.router.add_post('/api/v3/asset/create', self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        self.requests.append((request.content_length, form['file'].filename, form['file'].file.read()))
+        return web.json_response({'code': 0, 'message': '', 'data': {'url': f'url-{len(self.requests)}'}})
+
+
+@contextlib.asynccontextmanager
+async def _uploader(serve, server: FakeAssetServer, **kwargs):
+    async with serve(server.app):
+        requester = HTTPRequester(Cert(token='t'), None)
+        try:
+            yield AssetUploader(Gateway(requester, None), **kwargs)
+        finally:
+            await requester.close()
+
+
+def test_progress_upload_has_content_length(tmp_path, serve):
+    content = os.urandom(3 * 1024**2)
+    path = tmp_path / 'image.png'
+    path.write_bytes(content)
+
+    async def run(file, **kwargs):
+        progress = []
+        server = FakeAssetServer()
+        async with _uploader(serve, server, **kwargs) as uploader:
+            await uploader.upload(file, progress=lambda sent, total: progress.append((sent, total)))
+        (length, filename, sent), = server.requests
+        assert sent == content
+        assert length is not None and length > len(content)  # not chunked
+        assert progress[-1] == (len(content), len(content))
+        return filename
+
+    assert asyncio.run(run(path)) == 'image.png'
+    assert asyncio.run(run(io.BytesIO(content))) == 'file'  # no fileno(): the size still known
+    assert asyncio.run(run(path, cache_size=0)) == 'image.png'  # not hashed
+
+
+def test_same_content_uploaded_once(tmp_path, serve):
+    (tmp_path / 'a.png').write_bytes(b'same')
+    (tmp_path / 'b.png').write_bytes(b'same')
+
+    async def run():
+        server = FakeAssetServer()
+        async with _uploader(serve, server) as uploader:
+            urls = await asyncio.gather(uploader.upload(tmp_path / 'a.png'), uploader.upload(tmp_path / 'b.png'))
+            urls.append(await uploader.upload(tmp_path / 'a.png'))
+        assert urls == ['url-1'] * 3
+        assert len(server.requests) == 1
+
+    asyncio.run(run())
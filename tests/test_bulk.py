@@ -0,0 +1,126 @@
+"""BulkOperation: bounded concurrency, partial failures, stopping early and running once"""
+import asyncio
+
+import pytest
+
+from khl import BulkOperation, BulkResult
+
+
+class Calls:
+    """the bulk func: records calls started, in flight and cancelled, fails on items in ``fail``"""
+
+    def __init__(self, delay: float = 0.01, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.started = []
+        self.running = 0
+        self.max_running = 0
+        self.cancelled = []
+        self.release = None
+
+    async def __call__(self, item):
+        self.started.append(item)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if self.release and item != 0:
+                await self.release.wait()
+            else:
+                await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(item)
+            raise
+        finally:
+            self.running -= 1
+        if item in self.fail:
+            raise ValueError(item)
+        return item * 10
+
+
+@pytest.mark.parametrize('concurrency, total, expected', [(3, 10, 3), (4, 2, 2), (0, 3, 1)])
+def test_concurrency_bound(concurrency, total, expected):
+    calls = Calls()
+    op = BulkOperation(calls, range(total), concurrency=concurrency)
+
+    result = asyncio.run(op.wait())
+    assert calls.max_running == expected
+    assert sorted(i.item for i in result.items) == list(range(total))
+    assert result.ok and (op.done, op.total, op.failed) == (total, total, 0)
+
+
+def test_empty():
+    result = asyncio.run(BulkOperation(Calls(), []).wait())
+    assert isinstance(result, BulkResult) and result.ok and result.items == []
+
+
+def test_partial_failures():
+    calls = Calls(fail=[1, 4])
+    op = BulkOperation(calls, range(6), concurrency=2)
+
+    async def run():
+        return await op
+
+    result = asyncio.run(run())
+    assert not result.ok
+    assert sorted(i.item for i in result.failed) == [1, 4]
+    assert all(isinstance(i.error, ValueError) and i.result is None for i in result.failed)
+    assert sorted((i.item, i.result) for i in result.succeeded) == [(0, 0), (2, 20), (3, 30), (5, 50)]
+    assert sorted(calls.started) == list(range(6))  # a failure stops no other call
+    assert (op.done, op.failed) == (6, 2)
+
+
+def test_break_lets_calls_in_flight_finish():
+    calls = Calls(fail=[2])
+    op = BulkOperation(calls, range(6), concurrency=2)
+
+    async def run():
+        calls.release = asyncio.Event()
+        outcomes = op.__aiter__()
+        first = await outcomes.__anext__()
+        await asyncio.sleep(0.01)
+        assert first.item == 0
+        assert sorted(calls.started) == [0, 1, 2]  # a worker took the next item
+
+        closing = asyncio.ensure_future(outcomes.aclose())  # what `break` in `async for` leads to
+        await asyncio.sleep(0.01)
+        assert not closing.done()  # waits for the calls in flight
+        calls.release.set()
+        await asyncio.wait_for(closing, 1)
+
+    asyncio.run(run())
+    assert sorted(calls.started) == [0, 1, 2]  # nothing started after the break
+    assert calls.cancelled == []
+    assert (op.done, op.failed) == (3, 1)  # outcomes not yielded are still counted
+
+
+def test_cancel_cancels_calls_in_flight():
+    calls = Calls()
+    op = BulkOperation(calls, range(6), concurrency=2)
+
+    async def run():
+        calls.release = asyncio.Event()
+        task = asyncio.ensure_future(op.wait())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert sorted(calls.cancelled) == [1, 2]
+    assert calls.running == 0
+    assert op.done == 1
+
+
+def test_runs_once():
+    op = BulkOperation(Calls(), range(3))
+
+    async def run():
+        await op
+        with pytest.raises(RuntimeError):
+            await op
+        with pytest.raises(RuntimeError):
+            async for _ in op:
+                pass
+
+    asyncio.run(run())
+    assert op.done == 3  # the first run's outcomes are kept
@@ -0,0 +1,56 @@
+"""EntityCache learns from inbound pkgs, writes through the library drop what they change"""
+import asyncio
+
+from khl import Guild
+from khl.cache import EntityCache
+
+
+def test_feed_author_is_guild_scoped():
+    cache = EntityCache()
+    author = {'id': '2', 'username': 'someone', 'nickname': 'nick in the guild', 'roles': [1]}
+    cache.feed({'type': 9, 'target_id': '10', 'extra': {'type': 9, 'guild_id': '100', 'author': author}})
+    assert cache.authors.get(('100', '2')) == author
+    assert cache.guild_users.get(('100', '2')) is None  # partial: fetch_user() must load user/view
+    assert cache.users.get('2') is None
+
+    cache.feed({'type': 9, 'target_id': '3', 'extra': {'type': 9, 'author': {'id': '4'}}})  # private message
+    assert cache.users.get('4') is None
+
+
+def test_fetch_user_not_served_by_authors(fake_gate):
+    gate = fake_gate({'user/view': {'id': 'u1', 'roles': [1], 'joined_at': 1000}})
+    gate.cache.feed({'type': 9, 'target_id': 'c', 'extra': {'type': 9, 'guild_id': 'g1', 'author': {'id': 'u1'}}})
+
+    user = asyncio.run(Guild(id='g1', _gate_=gate).fetch_user('u1'))
+    assert gate.requested == ['user/view']
+    assert user.joined_at == 1000
+
+
+def test_writes_drop_cached_entities(fake_gate):
+    gate = fake_gate({
+        'user/view': {'id': 'u', 'roles': [1]},
+        'guild-role/list': [{'role_id': 1, 'position': 1}],
+        'channel/list': [{'id': 'c', 'is_category': False, 'type': 1}],
+    })
+    guild = Guild(id='g', _gate_=gate)
+
+    async def run():
+        assert (await guild.fetch_user('u')).roles == [1]
+        await guild.grant_role('u', 2)
+        await guild.fetch_user('u')
+        assert gate.requested.count('user/view') == 2
+
+        await guild.fetch_roles()
+        await guild.fetch_roles()
+        await guild.create_role('new')
+        await guild.fetch_roles()
+        assert gate.requested.count('guild-role/list') == 2
+
+        await guild.fetch_channel_list()
+        gate.cache.channels.set('c', {'id': 'c'})
+        await guild.delete_channel('c')
+        await guild.fetch_channel_list()
+        assert gate.requested.count('channel/list') == 2
+        assert gate.cache.channels.get('c') is None
+
+    asyncio.run(run())
@@ -0,0 +1,57 @@
+"""Cert decrypts webhook pkgs encrypted the way KOOK does"""
+import base64
+import json
+import os
+import pickle
+
+import pytest
+from Cryptodome.Cipher import AES
+from Cryptodome.Util import Padding
+
+from khl import Cert
+
+KEY = 'encrypt_key'
+
+
+def _encrypt(data: bytes, key: str = KEY, iv: bytes = None) -> bytes:
+    iv = iv or os.urandom(16)
+    cipher = AES.new(key.encode().ljust(32, b'\x00'), AES.MODE_CBC, iv=iv)
+    return base64.b64encode(iv + base64.b64encode(cipher.encrypt(Padding.pad(data, 16))))
+
+
+def _cert() -> Cert:
+    return Cert(token='t', verify_token='v', encrypt_key=KEY)
+
+
+@pytest.mark.parametrize('size', [0, 1, 15, 16, 17, 4096])  # around the block size: padding and slicing edges
+def test_decrypt_round_trip(size):
+    plain = os.urandom(size).hex()[:size]
+    encrypted = _encrypt(plain.encode())
+    cert = _cert()
+    assert cert.decrypt(encrypted) == plain
+    assert cert.decrypt(encrypted.decode()) == plain
+
+
+def test_decode_raw():
+    pkg = {'s': 0, 'd': {'verify_token': 'v', 'content': '你好 https://www.kookapp.cn/'}}
+    body = json.dumps({'encrypt': _encrypt(json.dumps(pkg).encode()).decode()})
+    cert = _cert()
+    assert cert.decode_raw(body) == pkg
+    assert cert.decode_raw(body.encode()) == pkg
+    assert Cert(token='t').decode_raw(json.dumps(pkg).encode()) == pkg  # no encrypt_key: parsed as is
+
+
+def test_wrong_key():
+    encrypted = _encrypt(b'{"s": 0}', iv=bytes(16))  # fixed: a random iv may decrypt to valid padding by chance
+    with pytest.raises(ValueError):
+        Cert(token='t', encrypt_key='another_key').decrypt(encrypted)
+
+
+def test_empty_ciphertext():
+    with pytest.raises(ValueError):
+        _cert().decrypt(base64.b64encode(os.urandom(16)))
+
+
+def test_pickle():
+    cert = pickle.loads(pickle.dumps(_cert()))
+    assert cert.decrypt(_encrypt(b'{"s": 0}')) == '{"s": 0}'
@@ -0,0 +1,31 @@
+"""Client routes pkgs to its consumers by channel"""
+import asyncio
+
+from khl import Client, Gateway
+
+
+def _dm(code: str, author_id: str) -> dict:
+    return {'channel_type': 'PERSON', 'type': 1, 'target_id': 'bot', 'author_id': author_id, 'extra': {'code': code}}
+
+
+def test_private_messages_spread_over_consumers():
+
+    async def run():
+        client = Client(Gateway(None, None), pkg_consumers=4, shard_queue_size=0)
+        shards = [asyncio.Queue(0) for _ in range(4)]
+        router = asyncio.ensure_future(client._route_pkg(shards))  # pylint: disable=protected-access
+        for i in range(64):
+            await client._pkg_queue.put(_dm(f'chat-{i}', f'user-{i}'))  # pylint: disable=protected-access
+        await client._pkg_queue.join()  # pylint: disable=protected-access
+        router.cancel()
+        return [s.qsize() for s in shards]
+
+    sizes = asyncio.run(run())
+    assert sum(sizes) == 64
+    assert sum(1 for s in sizes if s) > 1  # not all on the shard of the bot's own id
+
+
+def test_shard_key():
+    assert Client._shard_key({'channel_type': 'GROUP', 'target_id': 'c'}) == 'c'  # pylint: disable=protected-access
+    assert Client._shard_key(_dm('chat', 'u')) == 'chat'  # pylint: disable=protected-access
+    assert Client._shard_key({'channel_type': 'PERSON', 'author_id': 'u'}) == 'u'  # pylint: disable=protected-access
@@ -0,0 +1,86 @@
+"""khl.codec: backend fallback, and the same results whichever backend is in use"""
+import importlib
+import sys
+
+import pytest
+
+from khl import codec
+
+OBJ = {
+    'content': 'https://www.kookapp.cn/app 你好 "quoted" \\ \n',
+    'ids': [1, 2, 10**15],
+    'flags': {
+        'bot': True,
+        'nickname': None
+    },
+    'score': 2.5,
+}
+ENCODED = '{"content":"https://www.kookapp.cn/app 你好 \\"quoted\\" \\\\ \\n",' \
+          '"ids":[1,2,1000000000000000],"flags":{"bot":true,"nickname":null},"score":2.5}'
+
+
+def _installed():
+    names = []
+    for name in codec._BACKENDS:  # pylint: disable=protected-access
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+@pytest.fixture(autouse=True)
+def _restore_backend():
+    backend = codec.backend()
+    yield
+    codec.use(backend)
+
+
+@pytest.mark.parametrize('missing, expected', [((), 'orjson'), (('orjson', ), 'ujson'),
+                                               (('orjson', 'ujson'), 'json')])
+def test_fallback(monkeypatch, missing, expected):
+    if expected != 'json':
+        pytest.importorskip(expected)
+    for name in missing:
+        monkeypatch.setitem(sys.modules, name, None)  # import raises ImportError
+    try:
+        assert importlib.reload(codec).backend() == expected
+    finally:
+        monkeypatch.undo()
+        importlib.reload(codec)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        codec.use('simplejson')
+
+
+@pytest.mark.parametrize('name', _installed())
+def test_round_trip(name):
+    codec.use(name)
+    assert codec.dumps(OBJ) == ENCODED
+    assert codec.loads(ENCODED) == OBJ
+    assert codec.loads(ENCODED.encode()) == OBJ
+    assert codec.loads(bytearray(ENCODED.encode())) == OBJ
+    assert codec.loads(codec.dumps(OBJ, indent=True)) == OBJ
+    assert codec.dumps([OBJ]) == f'[{ENCODED}]'
+
+
+@pytest.mark.parametrize('name', _installed())
+def test_list_subclass(name):
+
+    class Cards(list):
+
+        def __iter__(self):
+            return iter([{'type': 'card'}])
+
+    codec.use(name)
+    assert codec.dumps(Cards()) == '[{"type":"card"}]'
+
+
+@pytest.mark.parametrize('name', _installed())
+def test_malformed(name):
+    codec.use(name)
+    with pytest.raises(ValueError):
+        codec.loads(b'{"code": 0')
@@ -0,0 +1,179 @@
+"""overflow policies of the pkg_queue, applied by PkgQueue and by the websocket outbox, and handler backpressure"""
+import asyncio
+
+import pytest
+
+from khl import Cert, Client, Gateway, Message, MessageTypes, PkgQueue
+from khl.receiver import WebsocketReceiver
+
+Overflow = PkgQueue.Overflow
+
+
+def _pkg(n: int, type: int = 1) -> dict:  # pylint: disable=redefined-builtin
+    return {
+        'channel_type': 'GROUP',
+        'type': type,
+        'target_id': 'channel',
+        'author_id': '2',
+        'content': str(n),
+        'msg_id': str(n),
+        'msg_timestamp': 0,
+        'nonce': '',
+        'extra': {
+            'type': type,
+            'guild_id': 'guild',
+            'channel_name': 'general',
+            'mention': [],
+            'author': {
+                'id': '2',
+                'username': 'someone'
+            }
+        },
+    }
+
+
+def _contents(queue: asyncio.Queue) -> list:
+    return [queue.get_nowait()['content'] for _ in range(queue.qsize())]
+
+
+def test_pkg_queue_policies():
+
+    async def run():
+        queue = PkgQueue(2, Overflow.DROP_OLDEST)
+        for i in range(5):
+            await queue.put(_pkg(i))
+        assert _contents(queue) == ['3', '4']
+
+        queue = PkgQueue(2, Overflow.DROP_TYPES, drop_types=[MessageTypes.TEXT])
+        for i in range(4):
+            await queue.put(_pkg(i))
+        assert _contents(queue) == ['0', '1']  # droppable ones dropped
+        await queue.put(_pkg(0, type=9))
+        await queue.put(_pkg(1, type=9))
+        with pytest.raises(asyncio.TimeoutError):  # others block
+            await asyncio.wait_for(queue.put(_pkg(2, type=9)), 0.05)
+
+        queue = PkgQueue(2)
+        await queue.put(_pkg(0))
+        await queue.put(_pkg(1))
+        put = asyncio.ensure_future(queue.put(_pkg(2)))
+        await asyncio.sleep(0.01)
+        assert not put.done()
+        assert queue.get_nowait()['content'] == '0'
+        await asyncio.wait_for(put, 1)
+        assert _contents(queue) == ['1', '2']
+
+    asyncio.run(run())
+
+
+def _receiver(queue: asyncio.Queue) -> WebsocketReceiver:
+    receiver = WebsocketReceiver(Cert(token='t'), False)
+    receiver.pkg_queue = queue
+    return receiver
+
+
+def _deliver(receiver: WebsocketReceiver, *pkgs: dict):
+    for sn, pkg in enumerate(pkgs, start=receiver._NEWEST_SN + 1):  # pylint: disable=protected-access
+        receiver._handle_event({'s': 0, 'sn': sn, 'd': pkg})  # pylint: disable=protected-access
+
+
+def test_outbox_drop_policies():
+    # pylint: disable=protected-access
+    receiver = _receiver(PkgQueue(2, Overflow.DROP_OLDEST))
+    _deliver(receiver, *[_pkg(i) for i in range(5)])  # nothing forwarded: the outbox takes the overflow
+    assert [p['content'] for p in receiver._outbox] == ['3', '4']
+
+    receiver = _receiver(PkgQueue(2, Overflow.DROP_TYPES, drop_types=[MessageTypes.TEXT]))
+    _deliver(receiver, _pkg(0), _pkg(1), _pkg(2), _pkg(3, type=9), _pkg(4))
+    assert [p['content'] for p in receiver._outbox] == ['0', '1', '3']  # others are kept, the reader waits
+
+
+def test_outbox_block_pauses_reader():
+    # pylint: disable=protected-access
+    n = 20
+
+    async def run():
+        receiver = _receiver(PkgQueue(2))
+        forward = asyncio.ensure_future(receiver._forward())
+        paused = []
+
+        async def reader():
+            for i in range(n):
+                _deliver(receiver, _pkg(i))
+                await receiver._wait_outbox_room()
+                paused.append(receiver._reader_paused)
+
+        reading = asyncio.ensure_future(reader())
+        await asyncio.sleep(0.05)
+        assert not reading.done()  # pkg_queue and outbox are full: the reader stops reading frames
+        assert receiver._reader_paused
+        assert receiver.pkg_queue.qsize() == 2 and len(receiver._outbox) == 2
+
+        got = []
+        while len(got) < n:
+            got.append((await asyncio.wait_for(receiver.pkg_queue.get(), 1))['content'])
+        await asyncio.wait_for(reading, 1)
+        forward.cancel()
+        assert got == [str(i) for i in range(n)]  # nothing dropped, in order
+        assert not any(paused)
+
+    asyncio.run(run())
+
+
+def test_handlers_bounded_and_drained():
+    # pylint: disable=protected-access
+
+    async def run():
+        client = Client(Gateway(None, None), max_handlers=2)
+        client.ignore_self_msg = False
+        release = asyncio.Event()
+        running, done = set(), []
+
+        async def handler(msg: Message):
+            running.add(msg.content)
+            await release.wait()
+            running.discard(msg.content)
+            done.append(msg.content)
+            if msg.content == '0':
+                raise ValueError('a failed handler frees its slot too')
+
+        client.register(MessageTypes.TEXT, handler)
+        consumer = asyncio.ensure_future(client.handle_pkg())
+        for i in range(5):
+            await client._pkg_queue.put(_pkg(i))
+        await asyncio.sleep(0.05)
+        assert running == {'0', '1'}
+        assert client._pkg_queue.qsize() == 2  # the consumer waits for a slot with the 3rd pkg
+
+        release.set()
+        await asyncio.wait_for(client.drain(), 1)
+        assert sorted(done) == ['0', '1', '2', '3', '4']
+        assert not client._handler_tasks
+        assert client._handler_sem._value == 2  # every slot released
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_spawn_cancelled_while_waiting():
+    # pylint: disable=protected-access
+
+    async def run():
+        client = Client(Gateway(None, None), max_handlers=1)
+        blocker = asyncio.Event()
+        await client._spawn_handler(blocker.wait())
+
+        coro = blocker.wait()
+        spawn = asyncio.ensure_future(client._spawn_handler(coro))
+        await asyncio.sleep(0.01)
+        spawn.cancel()
+        await asyncio.gather(spawn, return_exceptions=True)
+        assert coro.cr_frame is None  # closed, never run
+        assert len(client._handler_tasks) == 1
+
+        blocker.set()
+        await asyncio.wait_for(client.drain(), 1)
+        assert client._handler_sem._value == 1
+
+    asyncio.run(run())
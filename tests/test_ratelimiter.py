@@ -0,0 +1,237 @@
+"""RateLimiter against a fake rate-limited khl server"""
+import asyncio
+import contextlib
+import math
+import os
+import random
+import tempfile
+import time
+
+import pytest
+from aiohttp import web
+
+from khl import Cert, HTTPRequester, MemoryBackend, MmapBackend, RateLimiter, RedisBackend
+
+LIMIT, WINDOW = 5, 1.0
+BUCKETS = {'message/create': 'message/create', 'message/update': 'message/create', 'user/me': 'user/me'}
+
+
+class FakeServer:
+    """fixed windows of ``WINDOW`` seconds per bucket, ``LIMIT`` requests in each, 429 beyond"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.windows = {}  # bucket -> (window index, count)
+        self.ok = 0
+        self.rejected = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bucket = BUCKETS[request.match_info['route']]
+        elapsed = time.monotonic() - self.started
+        index = int(elapsed // WINDOW)
+        last, count = self.windows.get(bucket, (index, 0))
+        count = count + 1 if last == index else 1
+        self.windows[bucket] = (index, count)
+
+        headers = {
+            'X-Rate-Limit-Limit': str(LIMIT),
+            'X-Rate-Limit-Remaining': str(max(LIMIT - count, 0)),
+            'X-Rate-Limit-Reset': str(math.ceil((index + 1) * WINDOW - elapsed)),  # whole seconds as khl sends
+            'X-Rate-Limit-Bucket': bucket,
+        }
+        if count > LIMIT:
+            self.rejected += 1
+            return web.json_response({'code': 429, 'message': 'too many requests', 'data': {}}, status=429,
+                                     headers=headers)
+        self.ok += 1
+        return web.json_response({'code': 0, 'message': '', 'data': {}}, headers=headers)
+
+
+@contextlib.asynccontextmanager
+async def _server(serve):
+    server = FakeServer()
+    app = web.Application()
+    app.router.add_route('*', '/api/v3/{route:.*}', server.handle)
+    async with serve(app):
+        yield server
+
+
+def _backends():
+    yield MemoryBackend()
+    with tempfile.TemporaryDirectory() as d:
+        backend = MmapBackend(os.path.join(d, 'ratelimit'))
+        yield backend
+        asyncio.run(backend.close())
+
+
+def test_one_token_per_request(serve):
+    for backend in _backends():
+
+        async def run():
+            async with _server(serve):
+                limiter = RateLimiter(start=1, backend=backend)
+                requester = HTTPRequester(Cert(token='t'), limiter)
+                await requester.request('POST', 'message/create')  # learns the budget: LIMIT - 1 left
+                remaining = (await backend.peek('message/create', time.time()))[0]
+                await requester.request('POST', 'message/create')
+                assert (await backend.peek('message/create', time.time()))[0] == remaining - 1
+                await requester.close()
+
+        asyncio.run(run())
+
+
+def test_concurrent_requests_stay_within_limits(serve):
+    n = 4 * LIMIT  # one window of budget, the rest spread over the following windows
+
+    async def run():
+        async with _server(serve) as server:
+            requester = HTTPRequester(Cert(token='t'), RateLimiter(start=2))
+            routes = ['message/create', 'message/update']  # two routes in one bucket
+            started = time.monotonic()
+            await asyncio.gather(*[requester.request('POST', routes[i % 2]) for i in range(n)])
+            elapsed = time.monotonic() - started
+            await requester.close()
+        assert server.rejected == 0
+        assert server.ok == n
+        # each request takes one token: the budget of 4 windows, spending 2 tokens each would take twice as long
+        assert elapsed < (n / LIMIT + 1) * WINDOW
+
+    asyncio.run(run())
+
+
+def _headers(bucket: str, remaining: int, reset: int = 1) -> dict:
+    return {
+        'X-Rate-Limit-Limit': str(LIMIT),
+        'X-Rate-Limit-Remaining': str(remaining),
+        'X-Rate-Limit-Reset': str(reset),
+        'X-Rate-Limit-Bucket': bucket,
+    }
+
+
+def test_redis_script_matches_python():
+    fakeredis = pytest.importorskip('fakeredis.aioredis')
+    pytest.importorskip('lupa')  # EVAL support of fakeredis
+
+    async def run():
+        memory, redis = MemoryBackend(), RedisBackend(fakeredis.FakeRedis(decode_responses=True))
+        rand = random.Random(233)
+        now = time.time()  # keys expire at the real time: EXPIREAT in the past deletes them
+        for _ in range(500):
+            now += rand.choice((0, 0, 0.01, 0.1, 0.5, 1.5))
+            bucket = rand.choice(('a', 'b'))
+            op = rand.random()
+            if op < 0.2:
+                remaining, reset_at, limit = rand.randint(0, LIMIT), now + rand.choice((0.5, 1, 2)), LIMIT
+                await memory.update(bucket, remaining, reset_at, limit, now)
+                await redis.update(bucket, remaining, reset_at, limit, now)
+            elif op < 0.9:
+                start = rand.randint(0, 2)
+                expected, got = await memory.reserve(bucket, start, now), await redis.reserve(bucket, start, now)
+                assert (expected is None) == (got is None)
+                if expected is not None:
+                    assert got == pytest.approx(expected, abs=1e-4)
+            expected, got = await memory.peek(bucket, now), await redis.peek(bucket, now)
+            assert (expected is None) == (got is None)
+            if expected is not None:
+                assert got == pytest.approx(expected, abs=1e-4)
+
+    asyncio.run(run())
+
+
+def test_global_bucket():
+    window = 0.5
+
+    async def run(n: int) -> float:
+        limiter = RateLimiter(start=0, global_limit=(3, window))
+        started = time.monotonic()
+        await asyncio.gather(*[limiter.wait_for_rate(f'route/{i}') for i in range(n)])  # one bucket per route
+        return time.monotonic() - started
+
+    assert asyncio.run(run(3)) < window / 2
+    assert asyncio.run(run(4)) >= window * 0.8  # the 4th waits for the next global window
+
+
+def test_bucket_map_file():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'buckets.json')
+
+        async def learn():
+            limiter = RateLimiter(bucket_map_file=path)
+            await limiter.wait_for_rate('message/update')
+            await limiter.update('message/update', _headers('message/create', LIMIT - 1))
+
+        async def restart() -> str:
+            limiter = RateLimiter(bucket_map_file=path)
+            await limiter.wait_for_rate('user/me')  # loads the file
+            return await limiter.get_bucket('message/update')
+
+        asyncio.run(learn())
+        assert os.path.exists(path)
+        assert asyncio.run(restart()) == 'message/create'
+
+
+def test_probe():
+
+    async def run():
+        limiter = RateLimiter()
+        await limiter.wait_for_rate('user/me')  # the first one goes to learn the budget
+        waiting = asyncio.ensure_future(limiter.wait_for_rate('user/me'))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        await limiter.update('user/me', _headers('user/me', LIMIT - 1))
+        await asyncio.wait_for(waiting, 1)
+
+        limiter._PROBE_TIMEOUT = 0.1  # pylint: disable=protected-access
+        await limiter.wait_for_rate('guild/list')  # its response never comes
+        await asyncio.wait_for(limiter.wait_for_rate('guild/list'), 1)  # gives up waiting
+        assert not limiter._probes  # pylint: disable=protected-access
+        await limiter.wait_for_rate('guild/list')  # the next one probes again
+        assert limiter._probes  # pylint: disable=protected-access
+        await limiter.update('guild/list', {})  # a response without limits ends the probe as well
+        assert not limiter._probes  # pylint: disable=protected-access
+
+    asyncio.run(run())
+
+
+def test_mmap_table_full():
+
+    async def run(path: str):
+        backend = MmapBackend(path, slots=4)
+        now = time.time()
+        for i in range(4):
+            await backend.set_bucket(f'route/{i}', f'bucket/{i}')
+            await backend.update(f'bucket/{i}', LIMIT, now + WINDOW, LIMIT, now)
+        await backend.set_bucket('route/4', 'bucket/4')  # full: not recorded, no error
+        await backend.update('bucket/4', LIMIT, now + WINDOW, LIMIT, now)
+        assert await backend.get_bucket('route/4') is None
+        assert await backend.peek('bucket/4', now) is None
+        assert await backend.reserve('bucket/4', 0, now) is None  # budget unknown: the limiter does not wait
+        for i in range(4):  # the recorded ones are still there
+            assert await backend.get_bucket(f'route/{i}') == f'bucket/{i}'
+            assert await backend.reserve(f'bucket/{i}', 0, now) == 0
+        await backend.close()
+
+    with tempfile.TemporaryDirectory() as d:
+        asyncio.run(run(os.path.join(d, 'ratelimit')))
+
+
+def test_mmap_lock_does_not_block_loop():
+    fcntl = pytest.importorskip('fcntl')
+
+    async def run(path: str):
+        backend = MmapBackend(path)
+        other = os.open(path, os.O_RDWR)  # another open file: flock conflicts as with another process
+        fcntl.flock(other, fcntl.LOCK_EX)
+        try:
+            update = asyncio.ensure_future(backend.update('bucket', LIMIT, time.time() + WINDOW, LIMIT, time.time()))
+            await asyncio.sleep(0.1)  # a blocking flock would hang the loop here for good
+            assert not update.done()
+        finally:
+            fcntl.flock(other, fcntl.LOCK_UN)
+            os.close(other)
+        await asyncio.wait_for(update, 1)
+        assert (await backend.peek('bucket', time.time()))[0] == LIMIT
+        await backend.close()
+
+    with tempfile.TemporaryDirectory() as d:
+        asyncio.run(run(os.path.join(d, 'ratelimit')))
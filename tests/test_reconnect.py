@@ -0,0 +1,312 @@
+"""WebsocketReceiver: sn ordering, resume and reconnects, against a local websocket stand-in server"""
+import asyncio
+import contextlib
+import json
+import time
+
+from aiohttp import WSMessage, WSMsgType, web
+
+from khl import Cert
+from khl.backoff import Backoff
+from khl.receiver import WebsocketReceiver
+
+
+class FakeGateway:
+    """
+    serves ``gateway/index`` and a websocket which says hello(or not), sends the scripted frames, then closes
+
+    :param frames: frames sent after the hello, one list per connection, later connections send none
+    :param pings: if > 0, keep the connection open till this many pings are received, or the client closes it
+    :param pong: answer pings
+    """
+
+    def __init__(self, hello: bool, frames: list = (), pings: int = 0, pong: bool = True):
+        self.hello = hello
+        self.frames = list(frames)
+        self.pings = pings
+        self.pong = pong
+        self.pinged = []  # count of pings received, per connection
+        self.closed_by_client = 0
+        self.url = ''
+        self.fetched_at = []
+        self.connections = 0
+        self.queries = []
+
+    async def index(self, request: web.Request) -> web.Response:
+        self.fetched_at.append(time.monotonic())
+        return web.json_response({'code': 0, 'message': '', 'data': {'url': self.url}})
+
+    async def ws(self, request: web.Request) -> web.WebSocketResponse:
+        self.connections += 1
+        self.queries.append(dict(request.query))
+        conn = web.WebSocketResponse()
+        await conn.prepare(request)
+        if self.hello:
+            await conn.send_json({'s': 1, 'd': {'code': 0, 'session_id': 'session'}})
+        for frame in self.frames.pop(0) if self.frames else ():
+            await conn.send_json(frame)
+        self.pinged.append(0)
+        if self.pings > 0:
+            async for msg in conn:
+                if json.loads(msg.data).get('s') == 2:
+                    self.pinged[-1] += 1
+                    if self.pong:
+                        await conn.send_json({'s': 3})
+                    if self.pinged[-1] >= self.pings:
+                        break
+            else:
+                self.closed_by_client += 1
+        await conn.close()
+        return conn
+
+
+@contextlib.asynccontextmanager
+async def _gateway(serve, hello: bool, frames: list = (), **kwargs):
+    gateway = FakeGateway(hello, frames, **kwargs)
+    app = web.Application()
+    app.router.add_get('/api/v3/gateway/index', gateway.index)
+    app.router.add_get('/gateway', gateway.ws)
+    async with serve(app) as url:
+        gateway.url = url.replace('http', 'ws', 1) + '/gateway'
+        yield gateway
+
+
+async def _run_until(receiver: WebsocketReceiver, done, timeout: float = 5):
+    if getattr(receiver, '_queue', None) is None:
+        receiver.pkg_queue = asyncio.Queue()
+    task = asyncio.ensure_future(receiver.start())
+    try:
+        deadline = time.monotonic() + timeout
+        while not done() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def test_backoff_bounds():
+    backoff = Backoff(base=1, cap=8)
+    for _ in range(100):
+        backoff.reset()
+        for upper in (1, 2, 4, 8, 8, 8):
+            assert upper / 2 <= backoff.next_delay() <= upper
+    backoff = Backoff(base=1, cap=8, jitter=False)
+    assert [backoff.next_delay() for _ in range(5)] == [1, 2, 4, 8, 8]
+    backoff.reset()
+    assert backoff.next_delay() == 1
+
+
+def test_gateway_url_reused(serve):
+
+    async def run():
+        async with _gateway(serve, hello=True) as gateway:
+            receiver = WebsocketReceiver(Cert(token='t'), False, reconnect_backoff=Backoff(base=0.01, cap=0.02))
+            await _run_until(receiver, lambda: gateway.connections >= 3)
+        assert gateway.connections >= 3
+        assert len(gateway.fetched_at) == 1  # the url brought a session: reused by the later connections
+
+    asyncio.run(run())
+
+
+def test_gateway_fetch_rate_capped(serve):
+    interval = 0.2
+
+    async def run():
+        async with _gateway(serve, hello=False) as gateway:
+            receiver = WebsocketReceiver(Cert(token='t'),
+                                         False,
+                                         reconnect_backoff=Backoff(base=0.01, cap=0.02),
+                                         gateway_fetch_interval=interval)
+            await _run_until(receiver, lambda: len(gateway.fetched_at) >= 4)
+        fetched_at = gateway.fetched_at
+        assert len(fetched_at) >= 4  # no hello: the url is not trusted, every reconnect fetches a new one
+        assert gateway.connections >= len(fetched_at) - 1
+        gaps = [b - a for a, b in zip(fetched_at, fetched_at[1:])]
+        assert min(gaps) >= interval * 0.9  # loop timers may fire a bit early
+
+    asyncio.run(run())
+
+
+def _event(sn: int) -> dict:
+    return {'s': 0, 'sn': sn, 'd': {'type': 1, 'content': str(sn)}}
+
+
+def _receiver() -> WebsocketReceiver:
+    return WebsocketReceiver(Cert(token='t'), False)
+
+
+def _order(receiver: WebsocketReceiver, *sns: int) -> list:
+    """sn of the events ready to deliver after each of ``sns`` comes in, flattened"""
+    return [pkg['sn'] for sn in sns for pkg in receiver._order_event(_event(sn))]
+
+
+def test_sn_in_order_and_dup_dropped():
+    receiver = _receiver()
+    assert _order(receiver, 1, 2, 3) == [1, 2, 3]
+    assert _order(receiver, 3, 2) == []  # replayed
+    assert _order(receiver, 4) == [4]
+
+
+def test_sn_reordered():
+    receiver = _receiver()
+    assert _order(receiver, 1, 3, 4) == [1]
+    assert _order(receiver, 4) == []  # already buffered
+    assert _order(receiver, 2) == [2, 3, 4]
+    assert not receiver._sn_buffer
+
+
+def test_sn_wraps_around():
+    receiver = _receiver()
+    assert _order(receiver, 65534, 65535, 1, 2) == [65534, 65535, 1, 2]
+
+
+def test_sn_gap_timeout():
+    receiver = _receiver()
+    assert _order(receiver, 1, 3, 5) == [1]
+    assert receiver._drain_sn_buffer(timed_out_only=True) == []  # still waiting for 2
+    receiver._sn_buffer_since -= receiver._SN_BUFFER_TIMEOUT + 1
+    assert [p['sn'] for p in receiver._drain_sn_buffer(timed_out_only=True)] == [3, 5]  # gaps given up
+    assert receiver._NEWEST_SN == 5
+    assert _order(receiver, 2, 6) == [6]  # late ones are taken as replays
+
+
+def test_sn_buffer_overflow():
+    receiver = _receiver()
+    receiver._SN_BUFFER_SIZE = 2
+    assert _order(receiver, 1, 3, 4) == [1]
+    assert _order(receiver, 6) == [3, 4, 6]  # full: stop waiting for 2 and 5
+    assert receiver._NEWEST_SN == 6 and not receiver._sn_buffer
+
+
+def test_new_session_resets_sn():
+    receiver = _receiver()
+
+    async def run():
+        await receiver._handle_hello({'code': 0, 'session_id': 'old'})
+        _order(receiver, 7, 8, 10)
+        await receiver._handle_hello({'code': 0, 'session_id': 'old'})  # resumed: sn goes on
+        assert receiver._NEWEST_SN == 8 and receiver._sn_buffer
+        await receiver._handle_hello({'code': 0, 'session_id': 'new'})
+        assert receiver._NEWEST_SN == 0 and not receiver._sn_buffer
+        assert _order(receiver, 1) == [1]
+
+    asyncio.run(run())
+
+
+def test_resume_url():
+    receiver = _receiver()
+    receiver._RAW_GATEWAY = 'wss://gateway/x?compress=0'
+    assert receiver._gateway_url() == 'wss://gateway/x?compress=0'
+    receiver._session_id, receiver._NEWEST_SN = 'session', 42
+    assert receiver._gateway_url() == 'wss://gateway/x?compress=0&resume=1&sn=42&session_id=session'
+    receiver._RAW_GATEWAY = 'wss://gateway/x'
+    assert receiver._gateway_url() == 'wss://gateway/x?resume=1&sn=42&session_id=session'
+
+
+def test_reconnect_instructed():
+    receiver = _receiver()
+
+    async def run():
+        await receiver._handle_hello({'code': 0, 'session_id': 'session'})
+        _order(receiver, 1, 3)
+        receiver._gateway_stale = False
+        await receiver._handle_raw(WSMessage(WSMsgType.BINARY, json.dumps({'s': 5, 'd': {}}).encode(), None))
+
+    asyncio.run(run())
+    assert (receiver._session_id, receiver._NEWEST_SN, receiver._sn_buffer) == ('', 0, {})
+    assert receiver._gateway_stale  # from scratch: a new url, no resume
+
+
+def test_resume_round_trip(serve):
+    frames = [
+        [_event(1), _event(2)],
+        [{'s': 6, 'd': {'session_id': 'session'}}, _event(2), _event(3)],  # 2 is replayed after resuming
+    ]
+
+    async def run():
+        async with _gateway(serve, hello=True, frames=frames) as gateway:
+            receiver = WebsocketReceiver(Cert(token='t'), False, reconnect_backoff=Backoff(base=0.01, cap=0.02))
+            receiver.pkg_queue = asyncio.Queue()
+            await _run_until(receiver, lambda: receiver.pkg_queue.qsize() >= 3)
+        assert 'resume' not in gateway.queries[0]
+        assert gateway.queries[1] == {'resume': '1', 'sn': '2', 'session_id': 'session'}
+        return [receiver.pkg_queue.get_nowait()['content'] for _ in range(receiver.pkg_queue.qsize())]
+
+    assert asyncio.run(run()) == ['1', '2', '3']
+
+
+def _fast_heartbeat(receiver: WebsocketReceiver) -> WebsocketReceiver:
+    receiver._HEARTBEAT_INTERVAL = 0.02
+    receiver._PONG_RETRY_DELAYS = (0.02, 0.02)
+    receiver._PONG_TIMEOUT = 0.05
+    return receiver
+
+
+class FakeConnection:
+    """a websocket connection nothing answers"""
+
+    def __init__(self):
+        self.closed = False
+        self.sent = []
+
+    async def send_json(self, data: dict):
+        self.sent.append(data)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_missed_pongs_close_the_link(serve):
+
+    async def run():
+        async with _gateway(serve, hello=True, pings=100, pong=False) as gateway:
+            receiver = _fast_heartbeat(
+                WebsocketReceiver(Cert(token='t'), False, reconnect_backoff=Backoff(base=0.01, cap=0.02)))
+            await _run_until(receiver, lambda: gateway.connections >= 2)
+        assert gateway.closed_by_client >= 1
+        assert gateway.pinged[0] == 3  # the ping and 2 retries
+        assert gateway.queries[1]['resume'] == '1'
+
+    asyncio.run(run())
+
+
+def test_paused_reader_is_not_a_dead_link():
+
+    async def run():
+        receiver = _fast_heartbeat(_receiver())
+        conn = FakeConnection()
+        receiver._reader_paused = True  # the pong may be waiting behind a full outbox
+        heartbeat = asyncio.ensure_future(receiver.heartbeat(conn))
+        await asyncio.sleep(0.5)
+        assert not conn.closed and len(conn.sent) >= 4  # pings go on, missed pongs are not counted
+
+        receiver._reader_paused = False
+        await asyncio.wait_for(heartbeat, 1)
+        assert conn.closed
+
+    asyncio.run(run())
+
+
+def test_one_heartbeat_per_connection(serve):
+
+    class Receiver(WebsocketReceiver):
+        running = peak = 0
+
+        async def heartbeat(self, ws_conn):
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            try:
+                await super().heartbeat(ws_conn)
+            finally:
+                self.running -= 1
+
+    async def run():
+        async with _gateway(serve, hello=True, pings=2) as gateway:  # closed by the server after 2 pongs
+            receiver = _fast_heartbeat(Receiver(Cert(token='t'), False, reconnect_backoff=Backoff(base=0.01, cap=0.02)))
+            await _run_until(receiver, lambda: gateway.connections >= 4)
+            await asyncio.sleep(0.1)  # pings of heartbeats left behind would show up on the server
+        assert receiver.peak == 1
+        assert receiver.running == 0  # cancelled along with the connection
+        assert all(n <= 2 for n in gateway.pinged)
+
+    asyncio.run(run())
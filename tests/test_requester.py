@@ -0,0 +1,268 @@
+"""HTTPRequester: identical GETs share one request, consumers treat shared results as read-only, paged requests"""
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from khl import Cert, Client, HTTPRequester, RetryPolicy, api
+from khl.channel import PublicChannel
+from khl.gateway import Gateway
+
+
+class FakeServer:
+    """answers GET user/view after ``delay`` seconds, with ``status``"""
+
+    def __init__(self, delay: float = 0.1, status: int = 200):
+        self.delay = delay
+        self.status = status
+        self.hits = 0
+        self.app = web.Application()
+        self.app.router.add_get('/api/v3/user/view', self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.hits += 1
+        await asyncio.sleep(self.delay)
+        if self.status != 200:
+            return web.json_response({'code': 500, 'message': 'down', 'data': {}}, status=self.status)
+        return web.json_response({'code': 0, 'message': '', 'data': {'id': request.query['user_id'], 'hit': self.hits}})
+
+
+def _requester(**kwargs) -> HTTPRequester:
+    return HTTPRequester(Cert(token='t'), None, retry=RetryPolicy(max_attempts=1), **kwargs)
+
+
+def test_identical_gets_share_one_request(serve):
+    server = FakeServer()
+
+    async def run():
+        async with serve(server.app):
+            requester = _requester()
+            results = await asyncio.gather(*[requester.request('GET', 'user/view', params={'user_id': '1'})
+                                             for _ in range(10)])
+            other = await requester.request('GET', 'user/view', params={'user_id': '2'})
+            await requester.close()
+        assert server.hits == 2  # the other query is not shared
+        assert all(r is results[0] for r in results)
+        assert other['id'] == '2'
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_does_not_cancel_others(serve):
+    server = FakeServer()
+
+    async def run():
+        async with serve(server.app):
+            requester = _requester()
+            waiters = [asyncio.ensure_future(requester.request('GET', 'user/view', params={'user_id': '1'}))
+                       for _ in range(3)]
+            await asyncio.sleep(server.delay / 2)
+            waiters[0].cancel()
+            results = await asyncio.gather(*waiters, return_exceptions=True)
+            await requester.close()
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert results[1] == results[2] == {'id': '1', 'hit': 1}
+        assert server.hits == 1
+
+    asyncio.run(run())
+
+
+def test_error_reaches_every_waiter(serve):
+    server = FakeServer(status=500)
+
+    async def run():
+        async with serve(server.app):
+            requester = _requester()
+            results = await asyncio.gather(
+                *[requester.request('GET', 'user/view', params={'user_id': '1'}) for _ in range(5)],
+                return_exceptions=True)
+            assert not requester._inflight  # pylint: disable=protected-access
+            await requester.close()
+        assert all(isinstance(r, HTTPRequester.APIRequestFailed) and r.status == 500 for r in results)
+        assert server.hits == 1
+
+    asyncio.run(run())
+
+
+def test_response_ttl(serve):
+    server = FakeServer(delay=0)
+    ttl = 0.3
+
+    async def run():
+        async with serve(server.app):
+            requester = _requester(response_ttl=ttl)
+            params = {'user_id': '1'}
+            first = await requester.request('GET', 'user/view', params=params)
+            assert await requester.request('GET', 'user/view', params=params) is first  # a hit
+            await asyncio.sleep(ttl * 1.5)
+            assert (await requester.request('GET', 'user/view', params=params))['hit'] == 2  # expired
+            await requester.close()
+        assert server.hits == 2
+
+    asyncio.run(run())
+
+
+def _readonly(self, *args, **kwargs):
+    raise TypeError(f'a shared response is mutated: {type(self).__name__}')
+
+
+class FrozenDict(dict):
+    __setitem__ = __delitem__ = pop = popitem = clear = update = setdefault = __ior__ = _readonly
+
+
+class FrozenList(list):
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = pop = remove = clear = sort = \
+        reverse = _readonly
+
+
+def _freeze(o):
+    if isinstance(o, dict):
+        return FrozenDict((k, _freeze(v)) for k, v in o.items())
+    if isinstance(o, list):
+        return FrozenList(_freeze(i) for i in o)
+    return o
+
+
+class FrozenGateway(Gateway):
+    """answers requests with read-only data, the same objects each time, as coalesced/cached responses are"""
+
+    RESPONSES = {
+        'user/view': {'id': 'u', 'username': 'someone', 'roles': [1]},
+        'guild/view': {'id': 'g', 'name': 'guild', 'roles': [{'role_id': 1, 'position': 1}], 'channels': []},
+        'guild/list': [{'id': 'g', 'name': 'guild'}],
+        'guild/user-list': [{'id': 'u', 'username': 'someone'}],
+        'guild-role/list': [{'role_id': 1, 'position': 2}, {'role_id': 2, 'position': 1}],
+        'channel/view': {'id': 'c', 'guild_id': 'g', 'type': 1, 'parent_id': 'cat', 'permission_overwrites': [],
+                         'channels': []},
+        'channel/list': [{'id': 'cat', 'is_category': True, 'name': 'category', 'channels': []},
+                         {'id': 'c', 'is_category': False, 'type': 1, 'parent_id': 'cat'}],
+    }
+
+    def __init__(self):
+        super().__init__(None, None)
+        self.responses = {route: _freeze(data) for route, data in self.RESPONSES.items()}
+
+    async def exec_req(self, r):
+        return self.responses[r.route]
+
+    async def exec_paged_req(self, r, **kwargs):
+        return self.responses[r.route]
+
+    async def iter_paged_req(self, r, **kwargs):
+        for i in self.responses[r.route]:
+            yield i
+
+
+def test_consumers_do_not_mutate_responses():
+    """results are shared among callers and cached: objects built from them must copy what they change"""
+    gate = FrozenGateway()
+    client = Client(gate)
+
+    async def run():
+        # pylint: disable=protected-access
+        for _ in range(2):  # the second round is served by the entity cache
+            await client.fetch_user('u')
+            await client.fetch_public_channel('c')
+            category = await client.fetch_channel_category('c')
+            category.append(await client.fetch_public_channel('c'))
+            [g async for g in client.iter_guilds()]  # pylint: disable=expression-not-assigned
+
+            guild = await client.fetch_guild('g')
+            await guild.load()
+            await guild.fetch_user('u')
+            await guild.fetch_user_list()
+            await guild.fetch_roles()
+            guild._put_role({'role_id': 3, 'position': 0})
+            guild._remove_role(1)
+            await guild.fetch_channel_list()
+            guild._put_channel({'id': 'c2', 'is_category': False, 'type': 1, 'parent_id': 'cat'})
+            guild._put_channel({'id': 'c', 'is_category': False, 'type': 1, 'parent_id': ''})
+            guild._remove_channel('cat')
+            for c in await guild.fetch_channel_list(force_update=False):
+                if isinstance(c, PublicChannel):
+                    await c.load()
+
+    asyncio.run(run())
+    assert gate.responses == FrozenGateway.RESPONSES
+
+
+def test_frozen_responses_catch_mutation():
+    with pytest.raises(TypeError):
+        _freeze({'roles': []})['roles'].append(1)
+
+
+class PagedServer:
+    """GET guild/list in ``pages`` pages, by default later pages answer sooner: they complete out of order"""
+
+    def __init__(self, pages: int = 5, delay=None):
+        self.pages = pages
+        self.delay = delay or (lambda page: (self.pages - page) * 0.02)
+        self.requested = []
+
+    @property
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/api/v3/guild/list', self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        page, page_size = int(request.query['page']), int(request.query['page_size'])
+        self.requested.append(page)
+        await asyncio.sleep(self.delay(page))
+        data = {
+            'items': [f'{page}-{i}' for i in range(page_size)],
+            'meta': {'page': page, 'page_total': self.pages, 'page_size': page_size, 'total': self.pages * page_size}
+        }
+        return web.json_response({'code': 0, 'message': '', 'data': data})
+
+
+def _paged(serve, server: PagedServer, **kwargs) -> list:
+
+    async def run():
+        async with serve(server.app):
+            requester = _requester()
+            items = [i async for i in requester.iter_paged_req(api.Guild.list(), page_size=2, **kwargs)]
+            await requester.close()
+        return items
+
+    return asyncio.run(run())
+
+
+def test_pages_in_order(serve):
+    server = PagedServer()
+    items = _paged(serve, server, concurrency=4)
+    assert items == [f'{p}-{i}' for p in range(1, 6) for i in range(2)]
+    assert sorted(server.requested) == [1, 2, 3, 4, 5]
+
+
+def test_page_range(serve):
+    server = PagedServer()
+    assert _paged(serve, server, begin_page=3, end_page=2) == []
+    assert server.requested == []  # nothing requested for an empty range
+
+    assert _paged(serve, server, begin_page=2, end_page=3) == ['2-0', '2-1', '3-0', '3-1']
+    server.requested.clear()
+    assert len(_paged(serve, server, begin_page=4, end_page=100)) == 4  # clamped to page_total
+    assert sorted(server.requested) == [4, 5]
+
+
+def test_early_break_cancels_pages_in_flight(serve):
+    server = PagedServer(pages=20, delay=lambda page: 0 if page <= 2 else 0.5)
+
+    def in_flight():
+        tasks = asyncio.all_tasks()
+        return [t for t in tasks if not t.done() and t.get_coro().__qualname__ == 'HTTPRequester.exec_req']
+
+    async def run():
+        async with serve(server.app):
+            requester = _requester()
+            pages = requester.iter_paged_req(api.Guild.list(), page_size=2, concurrency=4)
+            items = [await pages.__anext__() for _ in range(3)]
+            assert len(in_flight()) == 4  # the window is kept full
+            await pages.aclose()  # what `break` in `async for` leads to
+            assert not in_flight()
+            await requester.close()
+        assert items == ['1-0', '1-1', '2-0']
+        assert set(server.requested) <= {1, 2, 3, 4, 5, 6}  # one page after the window at most
+
+    asyncio.run(run())
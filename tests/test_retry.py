@@ -0,0 +1,140 @@
+"""RetryPolicy, RetryBudget and Retry-After parsing"""
+import asyncio
+import email.utils
+import time
+
+import pytest
+from aiohttp import web
+
+from khl import Backoff, Cert, HTTPRequester, RetryBudget, RetryError, RetryPolicy, parse_retry_after
+
+
+class Failed(Exception):
+
+    def __init__(self, status=None, retry_after=None):
+        super().__init__(f'status: {status}')
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _run(policy: RetryPolicy, method: str, route: str, errors: list):
+    """run attempts failing with ``errors`` in turn, then succeeding, return (result or exception, attempts)"""
+    attempts = []
+
+    async def attempt():
+        attempts.append(time.monotonic())
+        if len(attempts) <= len(errors):
+            raise errors[len(attempts) - 1]
+        return 'ok'
+
+    async def run():
+        try:
+            return await policy.run(method, route, attempt)
+        except Exception as e:  # pylint: disable=broad-except
+            return e
+
+    return asyncio.run(run()), attempts
+
+
+def _fast(**kwargs) -> RetryPolicy:
+    return RetryPolicy(**{'backoff': Backoff(base=0.001, cap=0.001, jitter=False), 'budget': None, **kwargs})
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('') is None
+    assert parse_retry_after('2') == 2
+    assert parse_retry_after(' 1.5 ') == 1.5
+    assert parse_retry_after('-3') == 0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after('nan') is None
+    assert 8 < parse_retry_after(email.utils.formatdate(time.time() + 10, usegmt=True)) <= 10
+    assert parse_retry_after(email.utils.formatdate(time.time() - 10, usegmt=True)) == 0
+
+
+def test_should_retry():
+    policy = RetryPolicy()
+    assert policy.should_retry('get', Failed(503))
+    assert policy.should_retry('GET', Failed(429))
+    assert not policy.should_retry('GET', Failed(404))
+    assert not policy.should_retry('POST', Failed(503))  # not idempotent
+    assert policy.should_retry('GET', asyncio.TimeoutError())  # no response
+    assert policy.should_retry('GET', RetryError())
+    assert not policy.should_retry('GET', ValueError())
+    assert RetryPolicy(methods=['POST'], statuses=[404]).should_retry('POST', Failed(404))
+
+
+def test_route_prefix():
+    upload, message = RetryPolicy(max_attempts=1), RetryPolicy(max_attempts=5)
+    policy = RetryPolicy(routes={'asset': upload, 'message/': message, 'message/create': upload})
+    assert policy.for_route('asset/create') is upload
+    assert policy.for_route('message/update') is message
+    assert policy.for_route('message/create') is upload  # the longest prefix
+    assert policy.for_route('user/me') is policy
+
+
+def test_attempts():
+    result, attempts = _run(_fast(), 'GET', 'user/me', [Failed(500), Failed(503)])
+    assert (result, len(attempts)) == ('ok', 3)
+
+    result, attempts = _run(_fast(), 'GET', 'user/me', [Failed(500)] * 3)
+    assert isinstance(result, Failed) and len(attempts) == 3  # the last error is raised
+
+    result, attempts = _run(_fast(), 'GET', 'user/me', [Failed(404)])
+    assert isinstance(result, Failed) and len(attempts) == 1
+
+    policy = _fast(routes={'asset/': _fast(max_attempts=1)})
+    result, attempts = _run(policy, 'GET', 'asset/create', [Failed(500)])
+    assert isinstance(result, Failed) and len(attempts) == 1
+
+
+def test_retry_after_or_backoff_the_longer():
+    _, attempts = _run(_fast(), 'GET', 'user/me', [Failed(429, retry_after=0.2)])
+    assert attempts[1] - attempts[0] >= 0.2 * 0.9  # loop timers may fire a bit early
+
+    policy = RetryPolicy(backoff=Backoff(base=0.2, cap=0.2, jitter=False), budget=None)
+    _, attempts = _run(policy, 'GET', 'user/me', [Failed(429, retry_after=0.001)])
+    assert attempts[1] - attempts[0] >= 0.2 * 0.9
+
+
+def test_budget():
+    budget = RetryBudget(ratio=0.5, max_retries=2)
+    assert budget.withdraw() and budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()  # half a token
+    budget.deposit()
+    assert budget.withdraw()
+    for _ in range(10):
+        budget.deposit()
+    assert budget.withdraw() and budget.withdraw() and not budget.withdraw()  # capped at max_retries
+
+    policy = _fast(budget=RetryBudget(ratio=0, max_retries=1))
+    assert _run(policy, 'GET', 'user/me', [Failed(500)])[0] == 'ok'
+    result, attempts = _run(policy, 'GET', 'user/me', [Failed(500)])
+    assert isinstance(result, Failed) and len(attempts) == 1  # exhausted: given up at once
+
+
+@pytest.mark.parametrize('retry_after, expected', [
+    ('2', 2),
+    ('Wed, 21 Oct 2015 07:28:00 GMT', 0),  # in the past
+    ('later', None),
+])
+def test_requester_parses_retry_after(serve, retry_after, expected):
+
+    async def handle(_):
+        return web.json_response({}, status=503, headers={'Retry-After': retry_after})
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/api/v3/user/me', handle)
+        async with serve(app):
+            requester = HTTPRequester(Cert(token='t'), None, retry=RetryPolicy(max_attempts=1))
+            try:
+                with pytest.raises(HTTPRequester.APIRequestFailed) as e:
+                    await requester.request('GET', 'user/me')
+            finally:
+                await requester.close()
+        assert (e.value.status, e.value.retry_after) == (503, expected)
+
+    asyncio.run(run())
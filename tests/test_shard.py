@@ -0,0 +1,139 @@
+"""ShardedRunner: 2 worker processes fed by a fake ingress"""
+import asyncio
+import os
+import random
+import zlib
+
+import khl.requester
+from khl import Bot, Message
+from khl.bot.shard import ShardedRunner
+from khl.receiver import Receiver
+
+CHANNELS, PER_CHANNEL = 8, 20
+OUT_DIR_ENV = 'KHL_TEST_SHARD_OUT'
+
+
+def _pkg(channel: int, guild: int, n: int) -> dict:
+    return {
+        'channel_type': 'GROUP',
+        'type': 1,
+        'target_id': f'channel-{channel}',
+        'author_id': '2',
+        'content': str(n),
+        'msg_id': f'{channel}-{n}',
+        'msg_timestamp': 0,
+        'nonce': '',
+        'extra': {
+            'type': 1,
+            'guild_id': f'guild-{guild}',
+            'channel_name': 'general',
+            'mention': [],
+            'author': {
+                'id': '2',
+                'username': 'someone'
+            }
+        },
+    }
+
+
+def _make_bot() -> Bot:
+    """runs in the workers: logs starts and ends of handlers, and the shutdown, into a file per worker"""
+    khl.requester.API = 'http://127.0.0.1:1/api/v3'  # refused at once: no requests leave the box
+    out = os.path.join(os.environ[OUT_DIR_ENV], f'{os.getpid()}.log')
+    bot = Bot(token='t')
+    bot.client.ignore_self_msg = False
+
+    def log(line: str):
+        with open(out, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    @bot.on_message()
+    async def on_message(msg: Message):
+        log(f'start {msg.target_id} {msg.content}')
+        await asyncio.sleep(random.uniform(0, 0.2))  # many still running when the stop comes
+        log(f'done {msg.target_id} {msg.content}')
+
+    @bot.on_shutdown
+    async def on_shutdown(_):
+        log('shutdown')
+
+    return bot
+
+
+class FakeIngress(Receiver):
+    """puts the given pkgs into the pkg_queue, then idles as a receiver does"""
+
+    def __init__(self, pkgs):
+        super().__init__()
+        self.pkgs = pkgs
+        self.fed = False
+
+    @property
+    def type(self) -> str:
+        return 'fake'
+
+    async def start(self):
+        for pkg in self.pkgs:
+            await self.pkg_queue.put(pkg)
+        self.fed = True
+        await asyncio.Event().wait()
+
+
+def test_shard_of_is_stable():
+    by_channel = ShardedRunner(_make_bot, FakeIngress([]), workers=2)
+    by_guild = ShardedRunner(_make_bot, FakeIngress([]), workers=3, shard_by='guild')
+    for c in range(100):
+        pkg = _pkg(c, c % 7, 0)
+        assert by_channel.shard_of(pkg) == zlib.crc32(f'channel-{c}'.encode()) % 2
+        assert by_guild.shard_of(pkg) == zlib.crc32(f'guild-{c % 7}'.encode()) % 3
+        assert by_guild.shard_of(_pkg(c + 1, c % 7, 1)) == by_guild.shard_of(pkg)  # the guild decides, not channel
+    assert by_guild.shard_of({'target_id': 'channel-1'}) == zlib.crc32(b'channel-1') % 3  # no guild: the channel
+
+
+def test_private_messages_spread_by_chat():
+    runner = ShardedRunner(_make_bot, FakeIngress([]), workers=4)
+    for shard_by in ('channel', 'guild'):
+        runner.shard_by = shard_by
+        shards = set()
+        for i in range(100):
+            # the target of a private message is the bot itself: the chat code tells the chats apart
+            pkg = {'channel_type': 'PERSON', 'target_id': 'bot', 'author_id': f'u{i}', 'extra': {'code': f'chat-{i}'}}
+            assert runner.shard_of(pkg) == zlib.crc32(f'chat-{i}'.encode()) % 4
+            shards.add(runner.shard_of(pkg))
+        assert len(shards) == 4
+
+
+def test_two_workers(tmp_path, monkeypatch):
+    monkeypatch.setenv(OUT_DIR_ENV, str(tmp_path))
+    pkgs = [_pkg(c, c, n) for n in range(PER_CHANNEL) for c in range(CHANNELS)]
+    runner = ShardedRunner(_make_bot, FakeIngress(pkgs), workers=2, ratelimit_path=str(tmp_path / 'ratelimit'))
+
+    async def run():
+        task = asyncio.ensure_future(runner.start())
+        while not runner.receiver.fed:
+            await asyncio.sleep(0.01)
+        await asyncio.wait_for(runner.receiver.pkg_queue.join(), 10)  # routed to the workers
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    try:
+        asyncio.run(run())
+    finally:
+        runner.stop(timeout=30)
+    assert all(p.exitcode == 0 for p in runner._processes)  # pylint: disable=protected-access
+
+    logs = [(tmp_path / name).read_text(encoding='utf-8').splitlines() for name in os.listdir(tmp_path)
+            if name.endswith('.log')]
+    assert len(logs) == 2  # both workers got pkgs
+    handled = {}
+    for lines in logs:
+        assert lines[-1] == 'shutdown'  # drained: every handler finished before the shutdown handlers ran
+        assert lines.count('shutdown') == 1
+        starts = [line.split()[1:] for line in lines if line.startswith('start')]
+        assert sorted(starts) == sorted(line.split()[1:] for line in lines if line.startswith('done'))
+        shards = set()
+        for channel, n in starts:
+            handled.setdefault(channel, []).append(int(n))
+            shards.add(runner.shard_of({'target_id': channel}))
+        assert len(shards) == 1  # a worker only gets the channels of its shard
+    assert handled == {f'channel-{c}': list(range(PER_CHANNEL)) for c in range(CHANNELS)}  # once each, in order
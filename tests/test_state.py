@@ -0,0 +1,107 @@
+"""GuildState: a tracked guild patched by system events"""
+import asyncio
+
+import pytest
+
+from khl import Event
+from khl.state import GuildState
+
+GUILD = {'id': 'g', 'name': 'guild'}
+CHANNELS = [
+    {'id': 'cat-a', 'is_category': True, 'name': 'a'},
+    {'id': 'cat-b', 'is_category': True, 'name': 'b'},
+    {'id': 'c1', 'is_category': False, 'type': 1, 'parent_id': 'cat-a', 'name': 'c1'},
+    {'id': 'c2', 'is_category': False, 'type': 1, 'parent_id': 'cat-b', 'name': 'c2'},
+    {'id': 'c3', 'is_category': False, 'type': 2, 'parent_id': '', 'name': 'c3'},
+]
+ROLES = [{'role_id': 1, 'name': 'r1', 'position': 2}, {'role_id': 2, 'name': 'r2', 'position': 1}]
+
+
+def _event(event_type: str, body: dict, target_id: str = 'g') -> Event:
+    return Event(type=255, channel_type='GROUP', target_id=target_id, extra={'type': event_type, 'body': body})
+
+
+def _layout(guild) -> dict:
+    """category id('' for top-level) -> names of the channels in it"""
+    layout = {'': sorted(c.name for c in guild._channels)}  # pylint: disable=protected-access
+    for cid, cc in guild._channel_categories.items():  # pylint: disable=protected-access
+        layout[cid] = sorted(c.name for c in cc)
+    return layout
+
+
+@pytest.fixture
+def tracked(fake_gate):
+    gate = fake_gate({'guild/view': GUILD, 'channel/list': CHANNELS, 'guild-role/list': ROLES})
+    state = GuildState(gate)
+    guild = asyncio.run(state.fetch_guild('g'))
+    gate.requested.clear()
+    return state, guild, gate
+
+
+def test_loaded_once(tracked):
+    state, guild, gate = tracked
+    assert asyncio.run(state.fetch_guild('g')) is guild
+    assert _layout(guild) == {'': ['c3'], 'cat-a': ['c1'], 'cat-b': ['c2']}
+    assert state.get_channel('c2').name == 'c2'
+    assert gate.requested == []
+
+
+def test_channels(tracked):
+    state, guild, gate = tracked
+    c1 = state.get_channel('c1')
+
+    state.apply(_event('updated_channel', {**CHANNELS[2], 'parent_id': 'cat-b', 'name': 'c1 moved'}))
+    assert _layout(guild) == {'': ['c3'], 'cat-a': [], 'cat-b': ['c1 moved', 'c2']}
+    assert state.get_channel('c1') is c1  # updated in place
+
+    state.apply(_event('added_channel', {'id': 'c4', 'is_category': False, 'type': 1, 'parent_id': 'cat-a',
+                                         'name': 'c4', 'guild_id': 'g'}))
+    state.apply(_event('deleted_channel', {'id': 'c3'}))
+    assert _layout(guild) == {'': [], 'cat-a': ['c4'], 'cat-b': ['c1 moved', 'c2']}
+
+    state.apply(_event('deleted_channel', {'id': 'cat-b'}))  # its channels go top-level
+    assert _layout(guild) == {'': ['c1 moved', 'c2'], 'cat-a': ['c4']}
+
+    state.apply(_event('added_channel', {'id': 'cat-c', 'is_category': True, 'name': 'c', 'guild_id': 'g'}))
+    state.apply(_event('updated_channel', {**CHANNELS[3], 'parent_id': 'cat-c'}))
+    assert _layout(guild) == {'': ['c1 moved'], 'cat-a': ['c4'], 'cat-c': ['c2']}
+
+    assert {c.name for c in asyncio.run(guild.fetch_channel_list(force_update=False))} == {'c1 moved', 'c2', 'c4'}
+    assert gate.requested == []
+
+
+def test_roles(tracked):
+    state, guild, gate = tracked
+    state.apply(_event('added_role', {'role_id': 3, 'name': 'r3', 'position': 0}))
+    assert [r.name for r in guild._roles] == ['r3', 'r2', 'r1']  # pylint: disable=protected-access
+    state.apply(_event('updated_role', {'role_id': 3, 'name': 'r3', 'position': 5}))
+    state.apply(_event('deleted_role', {'role_id': 2}))
+    assert [r.name for r in asyncio.run(guild.fetch_roles(force_update=False))] == ['r1', 'r3']
+    assert gate.requested == []
+
+
+def test_guild_fields(tracked):
+    state, guild, _ = tracked
+    state.apply(_event('updated_guild', {'id': 'g', 'name': 'renamed'}))
+    assert guild.name == 'renamed'
+    assert _layout(guild) == {'': ['c3'], 'cat-a': ['c1'], 'cat-b': ['c2']}  # partial: the rest kept
+
+
+@pytest.mark.parametrize('event', [
+    _event('deleted_guild', {'id': 'g'}),
+    _event('self_exited_guild', {'guild_id': 'g'}, target_id='bot'),  # target_id is not the guild
+])
+def test_guild_gone(tracked, event):
+    state, _, _ = tracked
+    state.apply(event)
+    assert state.get_guild('g') is None
+    assert state.guilds == []
+
+
+def test_untracked_ignored(tracked):
+    state, guild, _ = tracked
+    state.apply(_event('deleted_channel', {'id': 'c3'}, target_id='other'))
+    state.apply(_event('deleted_guild', {'id': 'other'}))
+    state.apply(_event('message_btn_click', {}))  # changes no guild
+    assert state.get_guild('g') is guild
+    assert state.get_channel('c3') is not None
@@ -0,0 +1,48 @@
+"""spans of the websocket receiver: events start traces, control frames don't"""
+import asyncio
+import json
+
+from aiohttp import WSMessage, WSMsgType
+
+from khl import Cert, tracing
+from khl.receiver import WebsocketReceiver
+
+
+class ListExporter:
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def close(self):
+        pass
+
+
+def _frame(pkg: dict) -> WSMessage:
+    return WSMessage(WSMsgType.BINARY, json.dumps(pkg).encode(), None)
+
+
+def test_root_spans_for_events_only():
+    tracer = tracing.get_tracer()
+    exporter = ListExporter()
+    saved = tracer.exporter, tracer.sample_rate
+    tracer.exporter, tracer.sample_rate = exporter, 1.0
+
+    async def run():
+        receiver = WebsocketReceiver(Cert(token='t'), False)
+        receiver.pkg_queue = asyncio.Queue()
+        for _ in range(10):
+            await receiver._handle_raw(_frame({'s': 3}))  # pong
+        await receiver._handle_raw(_frame({'s': 1, 'd': {'code': 0, 'session_id': 'session'}}))
+        await receiver._handle_raw(_frame({'s': 0, 'sn': 1, 'd': {'type': 1, 'content': 'hi'}}))
+        return receiver._outbox.popleft()
+
+    try:
+        event = asyncio.run(run())
+    finally:
+        tracer.exporter, tracer.sample_rate = saved
+
+    assert [(s.name, s.attributes['sn']) for s in exporter.spans] == [('receiver.handle_raw', 1)]
+    assert tracing.detach(event) is exporter.spans[0]  # carried to the consumer
@@ -0,0 +1,192 @@
+"""WebhookReceiver: sn dedup, and fast ack against a local load generator"""
+import asyncio
+import base64
+import json
+import os
+import tracemalloc
+import zlib
+
+import pytest
+from aiohttp import ClientSession
+from Cryptodome.Cipher import AES
+from Cryptodome.Util import Padding
+
+from khl import Cert
+from khl.receiver import _DedupWindow, WebhookReceiver
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+def test_dedup_window(clock):
+    dedup = _DedupWindow(10, clock)
+    assert not dedup.check_and_add(1)
+    clock.now += 5
+    assert dedup.check_and_add(1)
+    assert not dedup.check_and_add(2)
+    clock.now += 5.5  # 1 expired, 2 not yet
+    assert not dedup.check_and_add(1)
+    assert dedup.check_and_add(2)
+    assert len(dedup) == 2
+    clock.now += 5  # 2 expired
+    assert list(dedup.snapshot()) == [1]
+
+
+def test_dedup_soak(clock):
+    """memory stays flat under steady traffic: bounded by the sns within one window, however long it runs"""
+    window, rate = 1, 1000  # sns per second
+    dedup = _DedupWindow(window, clock)
+
+    def feed(seconds: int, first: int) -> int:
+        sn = first
+        for _ in range(seconds * rate):
+            clock.now += 1 / rate
+            assert not dedup.check_and_add(sn % 65535 + 1)  # sn cycles as KOOK's does, cycles are longer than window
+            assert len(dedup) <= window * rate + 1
+            sn += 1
+        return sn
+
+    tracemalloc.start()
+    try:
+        sn = feed(5, 0)  # warm up to the steady state
+        steady = tracemalloc.get_traced_memory()[0]
+        feed(60, sn)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert after - steady < 64 * 1024
+
+
+def test_sn_dup_map():
+    receiver = WebhookReceiver(Cert(token='t', verify_token='v'), port=0, route='/', compress=False)
+    assert not receiver._is_dup({'sn': 1})  # pylint: disable=protected-access
+    with pytest.deprecated_call():
+        sn_dup_map = receiver.sn_dup_map
+    assert list(sn_dup_map) == [1]
+    with pytest.raises(TypeError):
+        sn_dup_map[2] = 0
+
+
+KEY, VERIFY_TOKEN = 'encrypt_key', 'verify_token'
+
+
+def _body(d: dict, sn: int = None) -> bytes:
+    pkg = {'s': 0, 'd': {'verify_token': VERIFY_TOKEN, **d}}
+    if sn is not None:
+        pkg['sn'] = sn
+    iv = os.urandom(16)
+    cipher = AES.new(KEY.encode().ljust(32, b'\x00'), AES.MODE_CBC, iv=iv)
+    encrypted = base64.b64encode(iv + base64.b64encode(cipher.encrypt(Padding.pad(json.dumps(pkg).encode(), 16))))
+    return zlib.compress(json.dumps({'encrypt': encrypted.decode()}).encode())
+
+
+def _event(sn: int) -> bytes:
+    content = os.urandom(256).hex()  # incompressible: larger than a challenge, so it's acknowledged before decoded
+    return _body({'type': 1, 'channel_type': 'GROUP', 'target_id': '1', 'author_id': '2', 'content': content}, sn)
+
+
+def _challenge(challenge: str) -> bytes:
+    return _body({'type': 255, 'channel_type': 'WEBHOOK_CHALLENGE', 'challenge': challenge})
+
+
+class _Fixture:
+    """a fast ack WebhookReceiver listening on a free local port"""
+
+    def __init__(self, port: int, **kwargs):
+        self.url = f'http://127.0.0.1:{port}/khl-wh'
+        cert = Cert(token='t', verify_token=VERIFY_TOKEN, encrypt_key=KEY)
+        self.receiver = WebhookReceiver(cert, port=port, route='/khl-wh', compress=True, fast_ack=True, **kwargs)
+        self.receiver.pkg_queue = asyncio.Queue()
+
+    async def __aenter__(self) -> '_Fixture':
+        self.task = asyncio.ensure_future(self.receiver.start())
+        self.session = ClientSession()
+        for _ in range(100):  # until listening
+            try:
+                async with self.session.post(self.url, data=b''):
+                    break
+            except OSError:
+                await asyncio.sleep(0.01)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    async def post(self, data: bytes):
+        async with self.session.post(self.url, data=data) as res:
+            return res.status, await res.read()
+
+
+def test_fast_ack_challenge(free_port):
+
+    async def run():
+        async with _Fixture(free_port) as f:
+            assert len(_challenge('c' * 16)) <= WebhookReceiver._INLINE_MAX_SIZE  # pylint: disable=protected-access
+            status, body = await f.post(_challenge('first'))
+            assert (status, json.loads(body)) == (200, {'challenge': 'first'})
+            assert (await f.post(_event(1)))[0] == 200
+            await asyncio.wait_for(f.receiver.pkg_queue.get(), 1)
+            status, body = await f.post(_challenge('again'))  # events came in between: still answered
+            assert (status, json.loads(body)) == (200, {'challenge': 'again'})
+
+    asyncio.run(run())
+
+
+def test_workers_stopped_with_start(free_port):
+
+    async def run():
+        async with _Fixture(free_port, decode_workers=3) as f:
+            workers = list(f.receiver._workers)  # pylint: disable=protected-access
+            assert len(workers) == 3 and not any(w.done() for w in workers)
+        assert all(w.cancelled() for w in workers)
+        assert not f.receiver._workers  # pylint: disable=protected-access
+
+    asyncio.run(run())
+
+
+def test_fast_ack_malformed(free_port):
+
+    async def run():
+        async with _Fixture(free_port, max_body_size=4096) as f:
+            assert (await f.post(b''))[0] == 400
+            assert (await f.post(b'{"s": 0}' * 100))[0] == 400  # not compressed
+            assert (await f.post(b'\x78\x9c' + os.urandom(4000)))[0] == 200  # looks like zlib: decoded later
+            assert (await f.post(b'\x78\x9c' + os.urandom(5000)))[0] == 413
+
+    asyncio.run(run())
+
+
+def test_fast_ack_load(free_port):
+    n, concurrency = 2000, 64
+
+    async def run():
+        async with _Fixture(free_port, decode_workers=4) as f:
+            bodies = [_event(sn) for sn in range(1, n + 1)]
+            bodies += bodies[:100]  # redelivered
+            pending = iter(bodies)
+            statuses = []
+
+            async def client():
+                for body in pending:
+                    statuses.append((await f.post(body))[0])
+
+            await asyncio.gather(*[client() for _ in range(concurrency)])
+            await asyncio.wait_for(f.receiver._raw_queue.join(), 10)  # pylint: disable=protected-access
+
+            assert statuses == [200] * len(bodies)
+            assert f.receiver.pkg_queue.qsize() == n  # redelivered ones are dropped
+
+    asyncio.run(run())